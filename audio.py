@@ -0,0 +1,265 @@
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+from log_config import logger
+from utils import identify_audio_format
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def get_file_size(file):
+    position = file.tell()
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(position)
+    return size
+
+class MultipartFileBody:
+    """
+    把表单字段和一个文件编码成 multipart/form-data 请求体。
+    文件按块读取，不会整体载入内存；每次迭代都从文件开头开始，失败重试时可以重新发送。
+    """
+    def __init__(self, fields, file, field_name="file"):
+        filename, self.file, content_type = file
+        filename = (filename or "upload").replace('"', "%22")
+        self.boundary = os.urandom(16).hex()
+        head = b""
+        for name, value in fields.items():
+            head += (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode("utf-8")
+        head += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type or 'application/octet-stream'}\r\n\r\n"
+        ).encode("utf-8")
+        self.head = head
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self.file_size = get_file_size(self.file)
+
+    @property
+    def headers(self):
+        return {
+            "Content-Type": f"multipart/form-data; boundary={self.boundary}",
+            "Content-Length": str(len(self.head) + self.file_size + len(self.tail)),
+        }
+
+    async def __aiter__(self):
+        yield self.head
+        # UploadFile 超过阈值后落盘，读文件放到线程里避免阻塞事件循环
+        await asyncio.to_thread(self.file.seek, 0)
+        while True:
+            chunk = await asyncio.to_thread(self.file.read, UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield self.tail
+
+class UploadLimiter:
+    """限制同时转发给上游的上传字节总数，超过上限的请求排队等待"""
+    def __init__(self, max_file_bytes=25 * 1024 * 1024, max_inflight_bytes=256 * 1024 * 1024):
+        self.max_file_bytes = max_file_bytes
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = 0
+        self.condition = asyncio.Condition()
+
+    @classmethod
+    def from_config(cls, upload_config):
+        if not isinstance(upload_config, dict):
+            upload_config = {}
+        return cls(
+            max_file_bytes=int(upload_config.get("max_file_bytes", 25 * 1024 * 1024)),
+            max_inflight_bytes=int(upload_config.get("max_inflight_bytes", 256 * 1024 * 1024)),
+        )
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, size):
+        if size > self.max_file_bytes:
+            raise HTTPException(status_code=413, detail=f"File too large, the maximum size is {self.max_file_bytes} bytes")
+        # 单个文件超过总上限时按总上限计，保证它能在空闲时单独发送
+        size = min(size, self.max_inflight_bytes)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.inflight_bytes + size <= self.max_inflight_bytes)
+            self.inflight_bytes += size
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.inflight_bytes -= size
+                self.condition.notify_all()
+
+AUDIO_FORMAT_MEDIA_TYPES = {
+    "MP3": "audio/mpeg",
+    "MP3 with ID3": "audio/mpeg",
+    "OPUS": "audio/ogg",
+    "AAC (ADIF)": "audio/aac",
+    "AAC (ADTS)": "audio/aac",
+    "FLAC": "audio/flac",
+    "WAV": "audio/wav",
+}
+
+RESPONSE_FORMAT_MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg",
+    "aac": "audio/aac",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+    "pcm": "audio/pcm",
+}
+
+def get_audio_media_type(first_chunk, response_format=None):
+    """只根据第一个音频块识别格式，识别不出时使用请求的 response_format"""
+    audio_format = identify_audio_format(bytes(first_chunk[:16]))
+    if audio_format in AUDIO_FORMAT_MEDIA_TYPES:
+        return AUDIO_FORMAT_MEDIA_TYPES[audio_format]
+    return RESPONSE_FORMAT_MEDIA_TYPES.get(response_format or "mp3", "application/octet-stream")
+
+async def prepend_chunk(first_chunk, generator):
+    yield first_chunk
+    async for chunk in generator:
+        yield chunk
+
+MEDIA_TYPE_FORMATS = {media_type: audio_format for audio_format, media_type in RESPONSE_FORMAT_MEDIA_TYPES.items()}
+
+class SpeechCache:
+    """
+    按 hash(上游渠道和模型, voice, speed, response_format, input) 把合成好的音频保存到磁盘。
+    文件名为 {key}.{格式}，按最近使用顺序淘汰，总大小不超过 max_bytes；命中时直接用 FileResponse 返回文件。
+    文件写入在线程池中进行，self.lock 保护 files 和 total_bytes。
+    """
+    def __init__(self, path="./data/speech_cache", max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()  # {key: (filename, size)}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @classmethod
+    def from_config(cls, cache_config):
+        if not cache_config:
+            return None
+        if not isinstance(cache_config, dict):
+            cache_config = {}
+        return cls(
+            path=cache_config.get("path", "./data/speech_cache"),
+            max_bytes=int(cache_config.get("max_bytes", 1024 * 1024 * 1024)),
+        )
+
+    def _load(self):
+        entries = []
+        for filename in os.listdir(self.path):
+            file_path = os.path.join(self.path, filename)
+            if filename.endswith(".tmp"):
+                # 上次进程退出时没写完的文件
+                os.remove(file_path)
+                continue
+            stat = os.stat(file_path)
+            entries.append((stat.st_mtime, filename, stat.st_size))
+        for _, filename, size in sorted(entries):
+            self.files[filename.split(".", 1)[0]] = (filename, size)
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def make_key(request, scope):
+        """scope 是已通过权限检查的上游渠道和模型，不使用请求里的模型别名"""
+        data = json.dumps([scope, request.voice, request.speed, request.response_format, request.input], ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """返回 (文件路径, media_type)，未命中返回 None"""
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self.files.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        filename, _ = entry
+        file_path = os.path.join(self.path, filename)
+        try:
+            # 更新 mtime，重启后仍能按最近使用顺序淘汰
+            os.utime(file_path)
+        except FileNotFoundError:
+            self._discard(key)
+            self.misses += 1
+            return None
+        self.files.move_to_end(key)
+        self.hits += 1
+        audio_format = filename.split(".", 1)[1]
+        return file_path, RESPONSE_FORMAT_MEDIA_TYPES.get(audio_format, "application/octet-stream")
+
+    def _discard(self, key):
+        filename, size = self.files.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(os.path.join(self.path, filename))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.files and self.total_bytes > self.max_bytes:
+            self._discard(next(iter(self.files)))
+
+    def _add(self, key, tmp_path, media_type):
+        with self.lock:
+            self._add_file(key, tmp_path, media_type)
+
+    def _add_file(self, key, tmp_path, media_type):
+        filename = f"{key}.{MEDIA_TYPE_FORMATS.get(media_type, 'bin')}"
+        size = os.path.getsize(tmp_path)
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        if key in self.files:
+            self._discard(key)
+        os.replace(tmp_path, os.path.join(self.path, filename))
+        self.files[key] = (filename, size)
+        self.total_bytes += size
+        self._evict()
+
+    async def tee(self, key, generator, media_type):
+        """把上游音频原样转发给客户端，同时在线程池中写入临时文件，完整结束后才放入缓存"""
+        tmp_path = os.path.join(self.path, f"{key}.{uuid.uuid4().hex}.tmp")
+        complete = False
+        file = await asyncio.to_thread(open, tmp_path, "wb")
+        try:
+            async for chunk in generator:
+                await asyncio.to_thread(file.write, chunk)
+                yield chunk
+            complete = True
+        finally:
+            await asyncio.to_thread(self._finish, key, file, tmp_path, media_type, complete)
+
+    def _finish(self, key, file, tmp_path, media_type, complete):
+        file.close()
+        if not complete:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        try:
+            self._add(key, tmp_path, media_type)
+        except OSError as e:
+            logger.error(f"Error saving speech cache: {str(e)}")
+
+    def stats(self):
+        return {
+            "files": len(self.files),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
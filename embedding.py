@@ -0,0 +1,561 @@
+import os
+import json
+import base64
+import asyncio
+import hashlib
+import threading
+
+import httpx
+import numpy as np
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from log_config import logger
+from utils import LRUCache, safe_get, provider_api_circular_list
+from request import get_payload
+from response import fetch_response
+
+def normalize_embedding_input(embedding_input):
+    """把 EmbeddingRequest.input 统一成输入项列表，每一项是字符串或 token id 列表"""
+    if isinstance(embedding_input, str):
+        return [embedding_input]
+    if embedding_input and all(isinstance(item, int) for item in embedding_input):
+        # 单个 token 数组
+        return [list(embedding_input)]
+    return list(embedding_input)
+
+def decode_embedding(value):
+    """上游返回的向量可能是 float 列表，也可能是 base64 编码的 float32"""
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype="<f4")
+    return np.asarray(value, dtype=np.float32)
+
+def decode_embeddings(values):
+    """把整批向量一次性转成 float32 矩阵，维度不一致时返回 None"""
+    if not values:
+        return np.zeros((0, 0), dtype=np.float32)
+    if all(isinstance(value, str) for value in values):
+        raw = b"".join(base64.b64decode(value) for value in values)
+        if len(raw) % len(values):
+            return None
+        return np.frombuffer(raw, dtype="<f4").reshape(len(values), -1)
+    try:
+        return np.asarray(values, dtype=np.float32)
+    except ValueError:
+        return None
+
+def truncate_embeddings(matrix, dimensions):
+    """Matryoshka 式截断：只保留前 dimensions 维，再做 L2 归一化"""
+    if not dimensions or matrix.ndim != 2 or matrix.shape[1] <= dimensions:
+        return matrix
+    matrix = matrix[:, :dimensions]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def encode_embeddings(matrix, encoding_format="float"):
+    if encoding_format == "base64":
+        raw = np.ascontiguousarray(matrix, dtype="<f4").tobytes()
+        row_bytes = matrix.shape[1] * 4
+        return [
+            base64.b64encode(raw[offset:offset + row_bytes]).decode("ascii")
+            for offset in range(0, len(raw), row_bytes)
+        ]
+    return matrix.tolist()
+
+def encode_embedding(vector, encoding_format="float"):
+    return encode_embeddings(np.asarray(vector, dtype=np.float32).reshape(1, -1), encoding_format)[0]
+
+def format_embedding_response(response_json, encoding_format="float", dimensions=None):
+    """
+    在本地完成 encoding_format 和 dimensions 的处理，上游统一按默认的 float 格式返回。
+    """
+    data = response_json.get("data") if isinstance(response_json, dict) else None
+    if not data:
+        return response_json
+    values = [item.get("embedding") for item in data]
+    needs_truncate = bool(dimensions) and any(len(value) > dimensions for value in values if isinstance(value, list))
+    is_float = all(isinstance(value, list) for value in values)
+    if is_float and encoding_format != "base64" and not needs_truncate:
+        return response_json
+
+    matrix = decode_embeddings(values)
+    if matrix is None:
+        return response_json
+    matrix = truncate_embeddings(matrix, dimensions)
+    for item, embedding in zip(data, encode_embeddings(matrix, encoding_format)):
+        item["embedding"] = embedding
+    return response_json
+
+async def read_response_json(response):
+    if hasattr(response, "body_iterator"):
+        body = b""
+        async for chunk in response.body_iterator:
+            body += chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+    else:
+        body = response.body
+    return json.loads(body)
+
+class EmbeddingDiskStore:
+    """按向量维度分文件存储的追加式向量库，读取时使用内存映射"""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index = {}  # {key: (dim, row, tokens)}
+        self.rows = {}  # {dim: row_count}
+        self.maps = {}  # {dim: np.memmap}
+        self.lock = threading.Lock()  # 写入在线程池中进行
+        for filename in os.listdir(directory):
+            if filename.startswith("index-") and filename.endswith(".tsv"):
+                dim = int(filename[len("index-"):-len(".tsv")])
+                self._load_index(dim)
+
+    def _vector_path(self, dim):
+        return os.path.join(self.directory, f"vectors-{dim}.f32")
+
+    def _index_path(self, dim):
+        return os.path.join(self.directory, f"index-{dim}.tsv")
+
+    def _load_index(self, dim):
+        vector_rows = os.path.getsize(self._vector_path(dim)) // (dim * 4) if os.path.exists(self._vector_path(dim)) else 0
+        with open(self._index_path(dim), "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 3:
+                    continue
+                key, row, tokens = parts[0], int(parts[1]), int(parts[2])
+                # 忽略写入向量前进程中断留下的索引行
+                if row < vector_rows:
+                    self.index[key] = (dim, row, tokens)
+        self.rows[dim] = vector_rows
+
+    def get(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        dim, row, tokens = entry
+        vectors = self.maps.get(dim)
+        if vectors is None or vectors.shape[0] <= row:
+            vectors = np.memmap(self._vector_path(dim), dtype=np.float32, mode="r", shape=(self.rows[dim], dim))
+            self.maps[dim] = vectors
+        return np.array(vectors[row]), tokens
+
+    def set(self, key, vector, tokens=0):
+        with self.lock:
+            if key in self.index:
+                return
+            dim = int(vector.shape[0])
+            row = self.rows.get(dim, 0)
+            with open(self._vector_path(dim), "ab") as f:
+                f.write(np.ascontiguousarray(vector, dtype=np.float32).tobytes())
+            with open(self._index_path(dim), "a", encoding="utf-8") as f:
+                f.write(f"{key}\t{row}\t{tokens}\n")
+            # 先更新行数再写索引，事件循环里读到索引时向量一定已经写入
+            self.rows[dim] = row + 1
+            self.index[key] = (dim, row, tokens)
+
+class EmbeddingCache:
+    """按 (模型, 维度, 文本哈希) 缓存单条 embedding 结果"""
+    def __init__(self, max_items=100000, max_bytes=512 * 1024 * 1024, disk_path=None):
+        self.memory = LRUCache(max_items=max_items, max_bytes=max_bytes)
+        self.disk = EmbeddingDiskStore(disk_path) if disk_path else None
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.upstream_tokens = 0
+
+    @classmethod
+    def from_config(cls, cache_config):
+        if not cache_config:
+            return None
+        if not isinstance(cache_config, dict):
+            cache_config = {}
+        return cls(
+            max_items=int(cache_config.get("max_items", 100000)),
+            max_bytes=int(cache_config.get("max_bytes", 512 * 1024 * 1024)),
+            disk_path=cache_config.get("disk_path"),
+        )
+
+    @staticmethod
+    def make_key(scope, dimensions, item):
+        text = item if isinstance(item, str) else json.dumps(item)
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{scope}:{dimensions or 0}:{digest}"
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.disk:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory.set(key, entry, entry[0].nbytes)
+        return entry
+
+    def set(self, key, vector, tokens=0):
+        self.memory.set(key, (vector, tokens), vector.nbytes)
+        if self.disk:
+            self.write_disk([(key, vector, tokens)])
+
+    async def set_many(self, entries):
+        """entries 为 [(key, vector, tokens)]，磁盘写入放到线程池中，不阻塞事件循环"""
+        for key, vector, tokens in entries:
+            self.memory.set(key, (vector, tokens), vector.nbytes)
+        if self.disk:
+            await asyncio.to_thread(self.write_disk, entries)
+
+    def write_disk(self, entries):
+        try:
+            for key, vector, tokens in entries:
+                self.disk.set(key, vector, tokens)
+        except OSError as e:
+            logger.error(f"Error writing embedding cache to disk: {str(e)}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0,
+            "saved_tokens": self.saved_tokens,
+            "upstream_tokens": self.upstream_tokens,
+            "cached_items": len(self.memory),
+            "cached_bytes": self.memory.total_bytes,
+            "disk_items": len(self.disk.index) if self.disk else 0,
+        }
+
+def estimate_item_tokens(items, total_tokens):
+    """上游只返回整批的 token 数，按文本长度把它分摊到每一项"""
+    lengths = [len(item) for item in items]
+    total_length = sum(lengths) or 1
+    return [round(total_tokens * length / total_length) for length in lengths]
+
+async def get_cached_embeddings(request, cache, request_upstream, scope):
+    """
+    命中缓存的输入直接使用缓存向量，只把未命中的输入发给上游，再按原顺序拼回结果。
+
+    request_upstream(sub_request) 返回上游的 Response，出错时原样返回给客户端。
+    scope 是已通过权限检查的上游渠道和模型，缓存键按 scope 区分，而不是按请求里的模型别名。
+    """
+    items = normalize_embedding_input(request.input)
+    keys = [cache.make_key(scope, request.dimensions, item) for item in items]
+
+    vectors = [None] * len(items)
+    miss_positions = {}  # {key: [positions]}，同一批次里重复的输入只请求一次
+    for position, key in enumerate(keys):
+        entry = cache.get(key)
+        if entry is not None:
+            vectors[position] = entry[0]
+            cache.hits += 1
+            cache.saved_tokens += entry[1]
+        else:
+            miss_positions.setdefault(key, []).append(position)
+            cache.misses += 1
+
+    prompt_tokens = 0
+    model = request.model
+    if miss_positions:
+        miss_keys = list(miss_positions.keys())
+        miss_items = [items[miss_positions[key][0]] for key in miss_keys]
+        sub_request = request.model_copy(update={"input": miss_items})
+        response = await request_upstream(sub_request)
+        if response.status_code >= 400:
+            return response, None
+
+        response_json = await read_response_json(response)
+        data = sorted(response_json.get("data", []), key=lambda x: x.get("index", 0))
+        if len(data) != len(miss_items):
+            logger.error(f"Embedding response has {len(data)} items, expected {len(miss_items)}")
+            return JSONResponse(status_code=502, content={
+                "error": "Invalid embedding response",
+                "details": f"Upstream returned {len(data)} embeddings for {len(miss_items)} inputs",
+            }), None
+        prompt_tokens = safe_get(response_json, "usage", "prompt_tokens", default=0) or 0
+        model = response_json.get("model", model)
+        cache.upstream_tokens += prompt_tokens
+
+        item_tokens = estimate_item_tokens(miss_items, prompt_tokens)
+        entries = []
+        for key, item, tokens in zip(miss_keys, data, item_tokens):
+            vector = decode_embedding(item["embedding"])
+            entries.append((key, vector, tokens))
+            for position in miss_positions[key]:
+                vectors[position] = vector
+        await cache.set_many(entries)
+
+    if len({vector.shape[0] for vector in vectors}) == 1:
+        embeddings = encode_embeddings(np.stack(vectors), request.encoding_format)
+    else:
+        embeddings = [encode_embedding(vector, request.encoding_format) for vector in vectors]
+    response_json = {
+        "object": "list",
+        "data": [
+            {
+                "object": "embedding",
+                "index": index,
+                "embedding": embedding,
+            } for index, embedding in enumerate(embeddings)
+        ],
+        "model": model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+    cache_status = {"hits": len(items) - sum(len(p) for p in miss_positions.values()), "misses": len(miss_positions)}
+    return response_json, cache_status
+
+def estimate_tokens(item):
+    """没有分词器时按 4 个字符约 1 个 token 粗略估算"""
+    if isinstance(item, str):
+        return max(1, len(item) // 4)
+    return len(item)
+
+class _PendingBatch:
+    def __init__(self, send_batch):
+        self.send_batch = send_batch
+        self.items = []
+        self.futures = []
+        self.tokens = 0
+        self.timer = None
+
+class EmbeddingBatcher:
+    """
+    把同一 (渠道, 模型) 下并发的单条 embedding 请求合并成一次上游批量请求。
+
+    批次在等待 max_wait_ms 毫秒、攒满 max_items 条或超过 max_tokens 预算时发出。
+    """
+    def __init__(self, max_items=64, max_wait_ms=5, max_tokens=8000):
+        self.max_items = max_items
+        self.max_wait = max_wait_ms / 1000
+        self.max_tokens = max_tokens
+        self.pending = {}  # {batch_key: _PendingBatch}
+        self.tasks = set()
+        self.batches = 0
+        self.batched_items = 0
+
+    @classmethod
+    def from_config(cls, batch_config):
+        if not batch_config:
+            return None
+        if not isinstance(batch_config, dict):
+            batch_config = {}
+        return cls(
+            max_items=int(batch_config.get("max_items", 64)),
+            max_wait_ms=float(batch_config.get("max_wait_ms", 5)),
+            max_tokens=int(batch_config.get("max_tokens", 8000)),
+        )
+
+    async def submit(self, batch_key, item, send_batch):
+        loop = asyncio.get_running_loop()
+        tokens = estimate_tokens(item)
+        batch = self.pending.get(batch_key)
+        if batch and batch.items and batch.tokens + tokens > self.max_tokens:
+            self._flush(batch_key)
+            batch = None
+        if batch is None:
+            batch = _PendingBatch(send_batch)
+            batch.timer = loop.call_later(self.max_wait, self._flush, batch_key)
+            self.pending[batch_key] = batch
+
+        future = loop.create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        batch.tokens += tokens
+        if len(batch.items) >= self.max_items or batch.tokens >= self.max_tokens:
+            self._flush(batch_key)
+        return await future
+
+    def _flush(self, batch_key):
+        batch = self.pending.pop(batch_key, None)
+        if batch is None:
+            return
+        if batch.timer:
+            batch.timer.cancel()
+        task = asyncio.create_task(self._run(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.batched_items += len(batch.items)
+        try:
+            results = await batch.send_batch(batch.items)
+        except BaseException as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        for future, result in zip(batch.futures, results):
+            if not future.done():
+                future.set_result(result)
+
+embedding_batchers = {}
+
+def get_embedding_batcher(provider):
+    channel_id = provider['provider']
+    batch_config = safe_get(provider, "preferences", "embedding_batch", default=None)
+    if not batch_config:
+        return None
+    if channel_id not in embedding_batchers:
+        embedding_batchers[channel_id] = EmbeddingBatcher.from_config(batch_config)
+    return embedding_batchers[channel_id]
+
+def get_single_embedding_input(embedding_input):
+    if isinstance(embedding_input, str):
+        return embedding_input
+    if isinstance(embedding_input, list) and len(embedding_input) == 1 and isinstance(embedding_input[0], str):
+        return embedding_input[0]
+    return None
+
+def get_embedding_batch_key(url, model, headers, payload):
+    """
+    只有请求头和除 input 外的所有参数（dimensions、encoding_format、user 等）都相同的请求才能合并。
+    Authorization 不参与分组，API key 在批次发出时统一选取。
+    """
+    options = json.dumps({key: value for key, value in payload.items() if key != "input"}, sort_keys=True, default=str)
+    headers = {key: value for key, value in headers.items() if key.lower() != "authorization"}
+    return (url, model, tuple(sorted(headers.items())), options)
+
+# 只有这些错误可能是某一条输入引起的，拆成单条重发；429、5xx 等整批错误原样返回给所有调用方
+INPUT_ERROR_STATUS_CODES = (400, 413, 422)
+
+async def send_embedding_batch(client, url, headers, payload, items, model):
+    """
+    发送一批输入并拆分成每条输入各自的响应。
+
+    整批因输入错误（400、413、422）失败且批次多于一条时，逐条重发，只有真正失败的输入才会拿到错误；
+    其他错误直接返回给批次内的所有请求，由各自的渠道重试逻辑处理。
+    """
+    response_json = None
+    async for chunk in fetch_response(client, url, headers, {**payload, "input": items}, "embedding", model):
+        response_json = chunk
+        break
+
+    if not isinstance(response_json, dict) or "error" in response_json or len(response_json.get("data") or []) != len(items):
+        if isinstance(response_json, dict) and "error" in response_json:
+            error = response_json
+        else:
+            error = {"error": "embedding batch HTTP Error", "status_code": 502, "details": "Invalid embedding response"}
+        if len(items) == 1 or error.get("status_code") not in INPUT_ERROR_STATUS_CODES:
+            return [dict(error) for _ in items]
+        logger.warning(f"Embedding batch of {len(items)} items failed with {error.get('status_code')}, retrying items one by one")
+        results = await asyncio.gather(*[
+            send_embedding_batch(client, url, headers, payload, [item], model) for item in items
+        ])
+        return [result[0] for result in results]
+
+    data = sorted(response_json["data"], key=lambda x: x.get("index", 0))
+    prompt_tokens = safe_get(response_json, "usage", "prompt_tokens", default=0) or 0
+    item_tokens = estimate_item_tokens(items, prompt_tokens)
+    results = []
+    for item, tokens in zip(data, item_tokens):
+        results.append({
+            "object": "list",
+            "data": [{**item, "index": 0}],
+            "model": response_json.get("model", model),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+    return results
+
+async def fetch_batched_embedding_response(batcher, batch_key, client, url, headers, payload, model, provider=None):
+    item = get_single_embedding_input(payload["input"])
+
+    async def send_batch(items):
+        batch_headers = headers
+        if provider and provider.get("api"):
+            # 每个批次只取一次 API key，整批共用
+            api_key = await provider_api_circular_list[provider['provider']].next(payload.get("model"))
+            batch_headers = {**headers, "Authorization": f"Bearer {api_key}"}
+        return await send_embedding_batch(client, url, batch_headers, payload, items, model)
+
+    yield await batcher.submit(batch_key, item, send_batch)
+
+def split_embedding_shards(items, max_items=2048, max_tokens=300000):
+    """按条数和估算 token 数把输入切成若干分片，返回 [(起始下标, 分片输入)]"""
+    shards = []
+    offset = 0
+    current = []
+    current_tokens = 0
+    for item in items:
+        tokens = estimate_tokens(item)
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            shards.append((offset, current))
+            offset += len(current)
+            current = []
+            current_tokens = 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        shards.append((offset, current))
+    return shards
+
+def get_embedding_shards(request, provider):
+    """输入超过渠道单次请求的上限时返回分片列表，否则返回 None"""
+    if isinstance(request.input, str) or not request.input or isinstance(request.input[0], int):
+        return None
+    shard_config = safe_get(provider, "preferences", "embedding_shard", default={})
+    if not isinstance(shard_config, dict):
+        shard_config = {}
+    shards = split_embedding_shards(
+        request.input,
+        max_items=int(shard_config.get("max_items", 2048)),
+        max_tokens=int(shard_config.get("max_tokens", 300000)),
+    )
+    if len(shards) <= 1:
+        return None
+    return shards
+
+async def fetch_sharded_embedding_response(client, request, engine, provider, shards, model):
+    """
+    并发发送所有分片，每个分片单独取 API key、单独重试，最后按下标顺序拼回结果并合并 usage。
+    """
+    shard_config = safe_get(provider, "preferences", "embedding_shard", default={})
+    if not isinstance(shard_config, dict):
+        shard_config = {}
+    retries = int(shard_config.get("retries", 2))
+    key_count = provider_api_circular_list[provider['provider']].get_items_count()
+    concurrency = int(shard_config.get("concurrency", max(key_count, 1) * 4))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_shard(offset, shard_items):
+        result = None
+        for attempt in range(retries + 1):
+            sub_request = request.model_copy(update={"input": shard_items})
+            async with semaphore:
+                try:
+                    url, headers, payload = await get_payload(sub_request, engine, provider)
+                    async for chunk in fetch_response(client, url, headers, payload, engine, model):
+                        result = chunk
+                        break
+                except (httpx.HTTPError, HTTPException) as e:
+                    result = {
+                        "error": "fetch_sharded_embedding_response HTTP Error",
+                        "status_code": getattr(e, "status_code", 502),
+                        "details": getattr(e, "detail", None) or str(e) or e.__class__.__name__,
+                    }
+            if isinstance(result, dict) and "error" not in result and len(result.get("data") or []) == len(shard_items):
+                return offset, result
+            logger.warning(f"provider: {provider['provider']:<11} embedding shard at {offset} failed (attempt {attempt + 1}/{retries + 1}): {str(result)[:200]}")
+        if not isinstance(result, dict) or "error" not in result:
+            result = {"error": "fetch_sharded_embedding_response HTTP Error", "status_code": 502, "details": "Invalid embedding response"}
+        return offset, result
+
+    results = await asyncio.gather(*[run_shard(offset, shard_items) for offset, shard_items in shards])
+
+    data = []
+    prompt_tokens = 0
+    total_tokens = 0
+    response_model = model
+    for offset, result in results:
+        if "error" in result:
+            yield result
+            return
+        for item in sorted(result["data"], key=lambda x: x.get("index", 0)):
+            data.append({**item, "index": offset + item.get("index", 0)})
+        prompt_tokens += safe_get(result, "usage", "prompt_tokens", default=0) or 0
+        total_tokens += safe_get(result, "usage", "total_tokens", default=0) or 0
+        response_model = result.get("model", response_model)
+
+    yield {
+        "object": "list",
+        "data": data,
+        "model": response_model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": total_tokens},
+    }
@@ -0,0 +1,118 @@
+"""
+事件循环延迟监控：事件循环里的探测任务每隔 interval 睡眠一次，实际醒来时间比预期晚多少就是调度延迟（lag），
+每次探测都写入 /metrics。
+
+看门狗线程检查探测任务的心跳，心跳超过 warn_ms 没有更新说明事件循环正被同步代码阻塞，
+此时直接在看门狗线程里读取事件循环线程的调用栈写入日志，记录的是阻塞发生时正在执行的代码。
+延迟警告和调用栈各自每 log_interval 秒最多记录一次，持续高延迟时不会刷屏。
+
+设置 shed_ms 后开启降载：连续 shed_after 次探测延迟超过 shed_ms 时，新的非管理员请求直接返回 503 和 Retry-After，
+连续 shed_after 次探测低于 shed_ms 后恢复。
+"""
+import sys
+import asyncio
+import threading
+import traceback
+from time import perf_counter, time
+
+from log_config import logger
+from metrics import metrics
+
+class LoopLagMonitor:
+    def __init__(self, enabled=True, interval_ms=100, warn_ms=200, shed_ms=None, shed_after=3, retry_after=5, log_interval=60):
+        self.enabled = enabled
+        self.interval = interval_ms / 1000
+        self.warn_seconds = warn_ms / 1000 if warn_ms else None
+        self.shed_seconds = shed_ms / 1000 if shed_ms else None
+        self.shed_after = max(int(shed_after), 1)
+        self.retry_after = retry_after
+        self.log_interval = log_interval
+        self.lag = 0.0
+        self.shedding = False
+        self.streak = 0  # 连续超过（正数）或低于（负数）shed_ms 的探测次数
+        self.heartbeat = perf_counter()
+        self.last_lag_log = 0.0
+        self.last_stack_log = 0.0
+        self.loop_ident = None
+        self.task = None
+        self.stop_event = None
+
+    @classmethod
+    def from_config(cls, monitor_config):
+        if not isinstance(monitor_config, dict):
+            monitor_config = {}
+        return cls(
+            enabled=monitor_config.get("enabled", True),
+            interval_ms=float(monitor_config.get("interval_ms", 100)),
+            warn_ms=monitor_config.get("warn_ms", 200),
+            shed_ms=monitor_config.get("shed_ms"),
+            shed_after=monitor_config.get("shed_after", 3),
+            retry_after=int(monitor_config.get("retry_after", 5)),
+            log_interval=float(monitor_config.get("log_interval", 60)),
+        )
+
+    def start(self):
+        """在事件循环线程中调用"""
+        if not self.enabled or self.task is not None:
+            return
+        self.loop_ident = threading.get_ident()
+        self.heartbeat = perf_counter()
+        self.task = asyncio.create_task(self.run())
+        if self.warn_seconds:
+            self.stop_event = threading.Event()
+            threading.Thread(target=self.watch, args=(self.stop_event,), name="uni-api-loop-monitor", daemon=True).start()
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.stop_event is not None:
+            self.stop_event.set()
+            self.stop_event = None
+
+    async def run(self):
+        while True:
+            expected = perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = perf_counter()
+            self.heartbeat = now
+            self.record(max(now - expected, 0.0))
+
+    def record(self, lag):
+        self.lag = lag
+        metrics.loop_lag.set((), lag)
+        metrics.loop_lag_histogram.observe((), lag)
+        if self.warn_seconds and lag >= self.warn_seconds and time() - self.last_lag_log >= self.log_interval:
+            self.last_lag_log = time()
+            logger.warning("Event loop lag %.0f ms", lag * 1000)
+        if not self.shed_seconds:
+            return
+        if lag >= self.shed_seconds:
+            self.streak = self.streak + 1 if self.streak > 0 else 1
+        else:
+            self.streak = self.streak - 1 if self.streak < 0 else -1
+        if not self.shedding and self.streak >= self.shed_after:
+            self.shedding = True
+            logger.warning("Event loop lag %.0f ms above %.0f ms, shedding new non-admin requests", lag * 1000, self.shed_seconds * 1000)
+        elif self.shedding and -self.streak >= self.shed_after:
+            self.shedding = False
+            logger.info("Event loop lag back to %.0f ms, stop shedding requests", lag * 1000)
+        metrics.load_shedding.set((), 1 if self.shedding else 0)
+
+    def watch(self, stop_event):
+        """看门狗线程：心跳超时就记录一次事件循环线程的调用栈，同一次阻塞只记录一次"""
+        logged_heartbeat = None
+        while not stop_event.wait(self.interval):
+            heartbeat = self.heartbeat
+            blocked = perf_counter() - heartbeat - self.interval
+            if blocked < self.warn_seconds or heartbeat == logged_heartbeat:
+                continue
+            logged_heartbeat = heartbeat
+            if time() - self.last_stack_log < self.log_interval:
+                continue
+            frame = sys._current_frames().get(self.loop_ident)
+            if frame is None:
+                continue
+            self.last_stack_log = time()
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning("Event loop blocked for %.0f ms, current stack:\n%s", blocked * 1000, stack)
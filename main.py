@@ -3,22 +3,39 @@ from log_config import logger
 import copy
 import httpx
 import secrets
-from time import time
+from time import time, perf_counter
 from contextlib import asynccontextmanager
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, Depends, Request, APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, APIRouter, Query
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.responses import StreamingResponse as FastAPIStreamingResponse
 from starlette.responses import StreamingResponse as StarletteStreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.exceptions import RequestValidationError
 
 from models import RequestModel, ImageGenerationRequest, AudioTranscriptionRequest, ModerationRequest, TextToSpeechRequest, UnifiedRequest, EmbeddingRequest
-from request import get_payload
+from request import get_payload, close_image_client
 from response import fetch_response, fetch_response_stream
+from metrics import metrics
+from profiler import Profiler
+from loop_monitor import LoopLagMonitor
+from stats_sink import SegmentStatsSink, schema_from_table, compact_segments, iter_parquet, parse_timestamp
+from audio import UploadLimiter, SpeechCache, get_file_size, get_audio_media_type, prepend_chunk
+from embedding import (
+    EmbeddingCache,
+    get_cached_embeddings,
+    get_embedding_batcher,
+    get_single_embedding_input,
+    get_embedding_batch_key,
+    fetch_batched_embedding_response,
+    get_embedding_shards,
+    fetch_sharded_embedding_response,
+    format_embedding_response,
+)
 from utils import (
+    BaseAPI,
     safe_get,
     load_config,
     save_api_yaml,
@@ -29,15 +46,28 @@ from utils import (
     rate_limiter,
     provider_api_circular_list,
     ThreadSafeCircularList,
+    prefix_affinity,
+    rendezvous_order,
+    LRUCache,
+    get_prefix_affinity_key,
+    split_moderation_input,
+    ApiKeyIndex,
+    RequestTimings,
+    prepare_logged_text,
+    compress_text,
+    decompress_text,
 )
 
 from collections import defaultdict
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Optional
 from urllib.parse import urlparse
 
 import os
 import string
+import gzip
+import importlib.util
 import json
+import hashlib
 
 DEFAULT_TIMEOUT = int(os.getenv("TIMEOUT", 100))
 is_debug = bool(os.getenv("DEBUG", False))
@@ -48,6 +78,7 @@ from sqlalchemy.sql import sqltypes
 
 # 添加新的环境变量检查
 DISABLE_DATABASE = os.getenv("DISABLE_DATABASE", "false").lower() == "true"
+METRICS_ENABLED = os.getenv("DISABLE_METRICS", "false").lower() != "true"
 IS_VERCEL = os.path.dirname(os.path.abspath(__file__)).startswith('/var/task')
 logger.info("IS_VERCEL: %s", IS_VERCEL)
 logger.info("DISABLE_DATABASE: %s", DISABLE_DATABASE)
@@ -64,12 +95,16 @@ async def create_tables():
     if DISABLE_DATABASE:
         return
     async with db_engine.begin() as conn:
+        existing_tables = await conn.run_sync(lambda connection: inspect(connection).get_table_names())
+        if not existing_tables:
+            # auto_vacuum 只能在建表前设置，新数据库直接开启增量 vacuum
+            await conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
         await conn.run_sync(Base.metadata.create_all)
 
         # 检查并添加缺失的列
         def check_and_add_columns(connection):
             inspector = inspect(connection)
-            for table in [RequestStat, ChannelStat]:
+            for table in [RequestStat, ChannelStat, RequestRollup, ChannelRollup]:
                 table_name = table.__tablename__
                 existing_columns = {col['name']: col['type'] for col in inspector.get_columns(table_name)}
 
@@ -79,7 +114,13 @@ async def create_tables():
                         default = _get_default_sql(column.default)
                         connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {col_type}{default}"))
 
+                # create_all 不会给已存在的表补索引
+                for index in table.__table__.indexes:
+                    index.create(connection, checkfirst=True)
+
         await conn.run_sync(check_and_add_columns)
+        if "request_rollups" not in existing_tables:
+            await backfill_rollups(conn)
 
 def _map_sa_type_to_sql_type(sa_type):
     type_map = {
@@ -114,14 +155,25 @@ async def lifespan(app: FastAPI):
     #     print(f"Route: {route.path}, methods: {route.methods}")
 
     # 启动时的代码
+    background_tasks = []
     if not DISABLE_DATABASE:
         await create_tables()
+        background_tasks.append(asyncio.create_task(stats_maintenance_loop()))
+    if segment_sink:
+        background_tasks.append(asyncio.create_task(stats_compaction_loop()))
 
     yield
+    for task in background_tasks:
+        task.cancel()
+    if hasattr(app.state, "loop_monitor"):
+        app.state.loop_monitor.stop()
+    if segment_sink:
+        await segment_sink.close()
     # 关闭时的代码
     # await app.state.client.aclose()
     if hasattr(app.state, 'client_manager'):
         await app.state.client_manager.close()
+    await close_image_client()
 
 app = FastAPI(lifespan=lifespan, debug=is_debug)
 
@@ -176,7 +228,7 @@ async def parse_request_body(request: Request):
     if request.method == "POST" and "application/json" in request.headers.get("content-type", ""):
         try:
             return await request.json()
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, UnicodeDecodeError):
             return None
     return None
 
@@ -217,8 +269,10 @@ class ChannelManager:
 
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, Float, DateTime, select, Boolean, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, select, Boolean, Text, Index, and_, or_, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.sql import func
+from datetime import datetime, timedelta, timezone
 
 # 定义数据库模型
 Base = declarative_base()
@@ -237,11 +291,33 @@ class RequestStat(Base):
     api_key = Column(String)
     is_flagged = Column(Boolean, default=False)
     text = Column(Text)
+    # text 的压缩方式：为空表示原文，zlib 或 zstd 表示 base64 编码的压缩数据
+    text_encoding = Column(String)
     prompt_tokens = Column(Integer, default=0)
     completion_tokens = Column(Integer, default=0)
     total_tokens = Column(Integer, default=0)
+    cache_read_tokens = Column(Integer, default=0)
+    cache_creation_tokens = Column(Integer, default=0)
+    scheduling = Column(String)
+    # 各阶段耗时（秒），upstream 开头的三列取最后一次上游尝试
+    auth_time = Column(Float)
+    parse_time = Column(Float)
+    moderation_time = Column(Float)
+    routing_time = Column(Float)
+    payload_time = Column(Float)
+    connect_time = Column(Float)
+    upstream_ttfb = Column(Float)
+    stream_time = Column(Float)
+    failover_time = Column(Float)
+    attempts = Column(Integer, default=0)
+    stage_timings = Column(Text)
     # cost = Column(Float, default=0)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (
+        Index('ix_request_stats_timestamp', 'timestamp'),
+        Index('ix_request_stats_provider_model', 'provider', 'model'),
+        Index('ix_request_stats_api_key', 'api_key'),
+    )
 
 class ChannelStat(Base):
     __tablename__ = 'channel_stats'
@@ -252,6 +328,234 @@ class ChannelStat(Base):
     api_key = Column(String)
     success = Column(Boolean, default=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (
+        Index('ix_channel_stats_timestamp', 'timestamp'),
+        Index('ix_channel_stats_provider_model', 'provider', 'model'),
+        Index('ix_channel_stats_api_key', 'api_key'),
+    )
+
+# 预聚合表：按分钟和小时分桶，写入统计时增量更新，/v1/stats 和 /data 只读这两张表
+# 维度列用空字符串代替 NULL，否则唯一索引无法触发 upsert
+REQUEST_ROLLUP_KEYS = ("granularity", "bucket", "provider", "model", "endpoint", "api_key", "client_ip", "scheduling")
+REQUEST_ROLLUP_SUMS = (
+    "request_count", "success_count", "flagged_count", "prompt_tokens", "completion_tokens", "total_tokens",
+    "cache_read_tokens", "cache_creation_tokens", "process_time_sum", "first_response_time_sum", "first_response_count",
+)
+CHANNEL_ROLLUP_KEYS = ("granularity", "bucket", "provider", "model", "api_key")
+CHANNEL_ROLLUP_SUMS = ("total", "success_count")
+
+class RequestRollup(Base):
+    __tablename__ = 'request_rollups'
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String)  # minute 或 hour
+    bucket = Column(DateTime)  # 桶的开始时间（UTC）
+    provider = Column(String, default="")
+    model = Column(String, default="")
+    endpoint = Column(String, default="")
+    api_key = Column(String, default="")
+    client_ip = Column(String, default="")
+    scheduling = Column(String, default="")
+    request_count = Column(Integer, default=0)
+    success_count = Column(Integer, default=0)
+    flagged_count = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    cache_read_tokens = Column(Integer, default=0)
+    cache_creation_tokens = Column(Integer, default=0)
+    process_time_sum = Column(Float, default=0)
+    first_response_time_sum = Column(Float, default=0)
+    first_response_count = Column(Integer, default=0)
+    __table_args__ = (Index('ix_request_rollups_key', *REQUEST_ROLLUP_KEYS, unique=True),)
+
+class ChannelRollup(Base):
+    __tablename__ = 'channel_rollups'
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String)
+    bucket = Column(DateTime)
+    provider = Column(String, default="")
+    model = Column(String, default="")
+    api_key = Column(String, default="")
+    total = Column(Integer, default=0)
+    success_count = Column(Integer, default=0)
+    __table_args__ = (Index('ix_channel_rollups_key', *CHANNEL_ROLLUP_KEYS, unique=True),)
+
+def rollup_buckets(now):
+    now = now.astimezone(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+    return (("minute", now), ("hour", now.replace(minute=0)))
+
+async def upsert_rollups(session, table, keys, sums, values):
+    rows = [{**values, "granularity": granularity, "bucket": bucket} for granularity, bucket in rollup_buckets(datetime.now(timezone.utc))]
+    stmt = sqlite_insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={column: getattr(table, column) + getattr(stmt.excluded, column) for column in sums},
+    )
+    await session.execute(stmt)
+
+async def add_request_rollups(session, current_info):
+    first_response_time = current_info.get("first_response_time") or 0
+    await upsert_rollups(session, RequestRollup, REQUEST_ROLLUP_KEYS, REQUEST_ROLLUP_SUMS, {
+        "provider": current_info.get("provider") or "",
+        "model": current_info.get("model") or "",
+        "endpoint": current_info.get("endpoint") or "",
+        "api_key": current_info.get("api_key") or "",
+        "client_ip": current_info.get("client_ip") or "",
+        "scheduling": current_info.get("scheduling") or "",
+        "request_count": 1,
+        "success_count": int(bool(current_info.get("success"))),
+        "flagged_count": int(bool(current_info.get("is_flagged"))),
+        "prompt_tokens": current_info.get("prompt_tokens") or 0,
+        "completion_tokens": current_info.get("completion_tokens") or 0,
+        "total_tokens": current_info.get("total_tokens") or 0,
+        "cache_read_tokens": current_info.get("cache_read_tokens") or 0,
+        "cache_creation_tokens": current_info.get("cache_creation_tokens") or 0,
+        "process_time_sum": current_info.get("process_time") or 0,
+        "first_response_time_sum": first_response_time if first_response_time > 0 else 0,
+        "first_response_count": int(first_response_time > 0),
+    })
+
+async def add_channel_rollups(session, provider, model, api_key, success):
+    await upsert_rollups(session, ChannelRollup, CHANNEL_ROLLUP_KEYS, CHANNEL_ROLLUP_SUMS, {
+        "provider": provider or "",
+        "model": model or "",
+        "api_key": api_key or "",
+        "total": 1,
+        "success_count": int(bool(success)),
+    })
+
+def rollup_window(table, start_time):
+    """起点之后的整小时用小时桶，起点所在小时剩下的部分用分钟桶"""
+    start_time = start_time.astimezone(timezone.utc).replace(tzinfo=None)
+    start_minute = start_time.replace(second=0, microsecond=0)
+    if start_minute < start_time:
+        start_minute += timedelta(minutes=1)
+    first_hour = start_minute.replace(minute=0)
+    if first_hour < start_minute:
+        first_hour += timedelta(hours=1)
+    return or_(
+        and_(table.granularity == "hour", table.bucket >= first_hour),
+        and_(table.granularity == "minute", table.bucket >= start_minute, table.bucket < first_hour),
+    )
+
+async def backfill_rollups(connection):
+    """首次创建预聚合表时，用已有的原始记录补齐"""
+    bucket_formats = {"minute": "%Y-%m-%d %H:%M:00.000000", "hour": "%Y-%m-%d %H:00:00.000000"}
+    for granularity, bucket_format in bucket_formats.items():
+        await connection.execute(text(f"""
+            INSERT INTO request_rollups ({", ".join(REQUEST_ROLLUP_KEYS + REQUEST_ROLLUP_SUMS)})
+            SELECT '{granularity}', strftime('{bucket_format}', timestamp), COALESCE(provider, ''), COALESCE(model, ''),
+                COALESCE(endpoint, ''), COALESCE(api_key, ''), COALESCE(client_ip, ''), COALESCE(scheduling, ''),
+                COUNT(*), SUM(CASE WHEN provider IS NOT NULL THEN 1 ELSE 0 END), SUM(CASE WHEN is_flagged THEN 1 ELSE 0 END),
+                SUM(COALESCE(prompt_tokens, 0)), SUM(COALESCE(completion_tokens, 0)), SUM(COALESCE(total_tokens, 0)),
+                SUM(COALESCE(cache_read_tokens, 0)), SUM(COALESCE(cache_creation_tokens, 0)), SUM(COALESCE(process_time, 0)),
+                SUM(CASE WHEN first_response_time > 0 THEN first_response_time ELSE 0 END),
+                SUM(CASE WHEN first_response_time > 0 THEN 1 ELSE 0 END)
+            FROM request_stats WHERE timestamp IS NOT NULL
+            GROUP BY 2, 3, 4, 5, 6, 7, 8
+        """))
+        await connection.execute(text(f"""
+            INSERT INTO channel_rollups ({", ".join(CHANNEL_ROLLUP_KEYS + CHANNEL_ROLLUP_SUMS)})
+            SELECT '{granularity}', strftime('{bucket_format}', timestamp), COALESCE(provider, ''), COALESCE(model, ''),
+                COALESCE(api_key, ''), COUNT(*), SUM(CASE WHEN success THEN 1 ELSE 0 END)
+            FROM channel_stats WHERE timestamp IS NOT NULL
+            GROUP BY 2, 3, 4, 5
+        """))
+
+# 数据库维护：原始记录保留天数（0 表示永久保留），过期记录可先归档到另一个 SQLite 文件
+STATS_RETENTION_DAYS = float(os.getenv("STATS_RETENTION_DAYS", 0))
+STATS_ARCHIVE_PATH = os.getenv("STATS_ARCHIVE_PATH")
+# 分钟粒度的预聚合只用于 /v1/stats 时间范围的起点，最多 720 小时，小时粒度永久保留
+STATS_ROLLUP_RETENTION_DAYS = float(os.getenv("STATS_ROLLUP_RETENTION_DAYS", 31))
+STATS_MAINTENANCE_INTERVAL = float(os.getenv("STATS_MAINTENANCE_INTERVAL", 3600))
+STATS_DELETE_BATCH = 5000
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL 模式下写入不阻塞读取，synchronous=NORMAL 在 WAL 下只在检查点时 fsync
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={int(os.getenv('DB_MMAP_SIZE', 256 * 1024 * 1024))}")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+async def expire_rows(conn, table_name, cutoff, archive=False):
+    """分批删除 cutoff 之前的记录，每批单独提交并持有写锁，避免长时间阻塞统计写入"""
+    expired = f"SELECT id FROM {table_name} WHERE timestamp < :cutoff ORDER BY id LIMIT {STATS_DELETE_BATCH}"
+    columns = None
+    if archive:
+        await conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS archive.{table_name} AS SELECT * FROM main.{table_name} WHERE 0")
+        main_columns = [row[1] for row in (await conn.exec_driver_sql(f"PRAGMA main.table_info({table_name})")).fetchall()]
+        archive_columns = {row[1] for row in (await conn.exec_driver_sql(f"PRAGMA archive.table_info({table_name})")).fetchall()}
+        for column in main_columns:
+            if column not in archive_columns:
+                await conn.exec_driver_sql(f"ALTER TABLE archive.{table_name} ADD COLUMN {column}")
+        columns = ", ".join(main_columns)
+        await conn.commit()
+
+    total = 0
+    while True:
+        async with db_semaphore:
+            if columns:
+                await conn.execute(text(f"INSERT INTO archive.{table_name} ({columns}) SELECT {columns} FROM main.{table_name} WHERE id IN ({expired})"), {"cutoff": cutoff})
+            result = await conn.execute(text(f"DELETE FROM {table_name} WHERE id IN ({expired})"), {"cutoff": cutoff})
+            await conn.commit()
+        total += result.rowcount
+        if result.rowcount < STATS_DELETE_BATCH:
+            return total
+        await asyncio.sleep(0)
+
+async def run_stats_maintenance(engine, retention_days=0, rollup_retention_days=31, archive_path=None):
+    """删除或归档过期的原始记录和分钟预聚合，然后增量 vacuum 归还空间"""
+    now = datetime.now(timezone.utc)
+    deleted = {}
+    async with engine.connect() as conn:
+        if retention_days > 0:
+            cutoff = (now - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+            if archive_path:
+                await conn.exec_driver_sql(f"ATTACH DATABASE '{archive_path}' AS archive")
+            try:
+                for table_name in ("request_stats", "channel_stats"):
+                    deleted[table_name] = await expire_rows(conn, table_name, cutoff, archive=bool(archive_path))
+            finally:
+                if archive_path:
+                    await conn.commit()
+                    await conn.exec_driver_sql("DETACH DATABASE archive")
+
+        if rollup_retention_days > 0:
+            cutoff = (now - timedelta(days=rollup_retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+            for table_name in ("request_rollups", "channel_rollups"):
+                async with db_semaphore:
+                    result = await conn.execute(text(f"DELETE FROM {table_name} WHERE granularity = 'minute' AND bucket < :cutoff"), {"cutoff": cutoff})
+                    await conn.commit()
+                deleted[table_name] = result.rowcount
+
+        if any(deleted.values()):
+            auto_vacuum = (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+            async with db_semaphore:
+                if auto_vacuum != 2:
+                    # 旧数据库需要完整 VACUUM 一次才能切换到增量模式
+                    logger.info("Converting stats database to incremental auto_vacuum, running VACUUM once")
+                    await conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                    await conn.exec_driver_sql("VACUUM")
+                else:
+                    await conn.exec_driver_sql("PRAGMA incremental_vacuum")
+                await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+                await conn.commit()
+    return deleted
+
+async def stats_maintenance_loop():
+    while True:
+        try:
+            deleted = await run_stats_maintenance(db_engine, STATS_RETENTION_DAYS, STATS_ROLLUP_RETENTION_DAYS, STATS_ARCHIVE_PATH)
+            if any(deleted.values()):
+                logger.info("Stats maintenance removed expired rows: %s", deleted)
+        except Exception as e:
+            logger.error(f"Error running stats maintenance: {str(e)}")
+            if is_debug:
+                import traceback
+                traceback.print_exc()
+        await asyncio.sleep(STATS_MAINTENANCE_INTERVAL)
 
 
 if not DISABLE_DATABASE:
@@ -265,6 +569,7 @@ if not DISABLE_DATABASE:
     # 创建异步引擎和会话
     # db_engine = create_async_engine('sqlite+aiosqlite:///' + db_path, echo=False)
     db_engine = create_async_engine('sqlite+aiosqlite:///' + db_path, echo=is_debug)
+    event.listen(db_engine.sync_engine, "connect", set_sqlite_pragma)
     async_session = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
 
 from starlette.types import Scope, Receive, Send
@@ -272,10 +577,67 @@ from starlette.responses import Response
 
 from asyncio import Semaphore
 
+# 统计数据写到哪里：sqlite 为原始记录表，segments 为追加写入的 JSONL 分段（可合并成 Parquet）
+# 预聚合表总是写入 SQLite，供 /v1/stats 和 /data 使用
+STATS_SINKS = {name.strip() for name in os.getenv("STATS_SINK", "sqlite").split(",") if name.strip()}
+STATS_SEGMENT_DIR = os.getenv("STATS_SEGMENT_DIR", "./data/segments")
+STATS_COMPACTION_INTERVAL = float(os.getenv("STATS_COMPACTION_INTERVAL", 3600))
+STATS_FIELDS = {"request": schema_from_table(RequestStat.__table__), "channel": schema_from_table(ChannelStat.__table__)}
+REQUEST_STAT_COLUMNS = frozenset(STATS_FIELDS["request"])
+segment_sink = SegmentStatsSink(STATS_SEGMENT_DIR) if "segments" in STATS_SINKS else None
+
+async def write_segment(kind, record):
+    if segment_sink is None:
+        return
+    try:
+        await segment_sink.write(kind, {**record, "timestamp": datetime.now(timezone.utc).isoformat()})
+    except Exception as e:
+        logger.error(f"Error writing stats segment: {str(e)}")
+
+async def stats_compaction_loop():
+    while True:
+        await asyncio.sleep(STATS_COMPACTION_INTERVAL)
+        try:
+            compacted = await asyncio.to_thread(compact_segments, STATS_SEGMENT_DIR, STATS_FIELDS)
+            if compacted:
+                logger.info("Compacted stats segments into Parquet: %s", compacted)
+        except Exception as e:
+            logger.error(f"Error compacting stats segments: {str(e)}")
+
 # 创建一个信号量来控制数据库访问
 db_semaphore = Semaphore(1)  # 限制同时只有1个写入操作
 
+async def get_logged_text(current_info):
+    """按 API key 的 TEXT_LOG_* 设置处理要写入数据库的请求文本，返回 (文本, 压缩方式)，压缩放到线程池中执行"""
+    api_index = current_info.get("api_index")
+    preferences = safe_get(app.state.config, 'api_keys', api_index, "preferences", default={}) if api_index is not None else {}
+    text = prepare_logged_text(
+        current_info.get("text"),
+        sample_rate=float(preferences.get("TEXT_LOG_SAMPLE_RATE", 1)),
+        max_chars=int(preferences.get("TEXT_LOG_MAX_CHARS", 0)),
+        hash_text=preferences.get("TEXT_LOG_HASH", False),
+    )
+    compression = preferences.get("TEXT_LOG_COMPRESSION")
+    if text and compression and not preferences.get("TEXT_LOG_HASH", False):
+        return await asyncio.to_thread(compress_text, text, compression)
+    return text, None
+
 async def update_stats(current_info):
+    if DISABLE_DATABASE and segment_sink is None:
+        return
+
+    try:
+        logged_text, text_encoding = await get_logged_text(current_info)
+    except Exception as e:
+        logger.error(f"Error preparing request text for stats: {str(e)}")
+        logged_text, text_encoding = None, None
+
+    filtered_info = {k: v for k, v in current_info.items() if k in REQUEST_STAT_COLUMNS}
+    if current_info.get("timings"):
+        filtered_info.update(current_info["timings"].to_stats())
+    filtered_info["text"] = logged_text
+    filtered_info["text_encoding"] = text_encoding
+    await write_segment("request", filtered_info)
     if DISABLE_DATABASE:
         return
 
@@ -285,10 +647,10 @@ async def update_stats(current_info):
             async with async_session() as session:
                 async with session.begin():
                     try:
-                        columns = [column.key for column in RequestStat.__table__.columns]
-                        filtered_info = {k: v for k, v in current_info.items() if k in columns}
-                        new_request_stat = RequestStat(**filtered_info)
-                        session.add(new_request_stat)
+                        # 直接用 Core insert 写入，不构造 ORM 对象
+                        if "sqlite" in STATS_SINKS:
+                            await session.execute(RequestStat.__table__.insert(), filtered_info)
+                        await add_request_rollups(session, current_info)
                         await session.commit()
                     except Exception as e:
                         await session.rollback()
@@ -303,6 +665,17 @@ async def update_stats(current_info):
             traceback.print_exc()
 
 async def update_channel_stats(request_id, provider, model, api_key, success):
+    if DISABLE_DATABASE and segment_sink is None:
+        return
+
+    channel_stat = {
+        "request_id": request_id,
+        "provider": provider,
+        "model": model,
+        "api_key": api_key,
+        "success": success,
+    }
+    await write_segment("channel", channel_stat)
     if DISABLE_DATABASE:
         return
 
@@ -311,14 +684,9 @@ async def update_channel_stats(request_id, provider, model, api_key, success):
             async with async_session() as session:
                 async with session.begin():
                     try:
-                        channel_stat = ChannelStat(
-                            request_id=request_id,
-                            provider=provider,
-                            model=model,
-                            api_key=api_key,
-                            success=success,
-                        )
-                        session.add(channel_stat)
+                        if "sqlite" in STATS_SINKS:
+                            await session.execute(ChannelStat.__table__.insert(), channel_stat)
+                        await add_channel_rollups(session, provider, model, api_key, success)
                         await session.commit()
                     except Exception as e:
                         await session.rollback()
@@ -332,12 +700,20 @@ async def update_channel_stats(request_id, provider, model, api_key, success):
             import traceback
             traceback.print_exc()
 
+# 这些端点返回的不是模型输出，不解析 usage，原样发送
+RAW_RESPONSE_PATHS = ("/v1/audio/speech", "/v1/stats/export", "/v1/profile")
+
+def finish_profile(current_info):
+    if "profile_start" in current_info:
+        app.state.profiler.finish_request(current_info)
+
 class LoggingStreamingResponse(Response):
     def __init__(self, content, status_code=200, headers=None, media_type=None, current_info=None):
         super().__init__(content=None, status_code=status_code, headers=headers, media_type=media_type)
         self.body_iterator = content
         self._closed = False
         self.current_info = current_info
+        self.stream_start = perf_counter()
 
         # Remove Content-Length header if it exists
         if 'content-length' in self.headers:
@@ -371,6 +747,11 @@ class LoggingStreamingResponse(Response):
 
             process_time = time() - self.current_info["start_time"]
             self.current_info["process_time"] = process_time
+            timings = self.current_info.get("timings")
+            if timings:
+                timings.add("stream", self.stream_start)
+            metrics.observe_request(self.current_info, self.status_code)
+            finish_profile(self.current_info)
             await update_stats(self.current_info)
 
     async def _logging_iterator(self):
@@ -378,7 +759,7 @@ class LoggingStreamingResponse(Response):
             async for chunk in self.body_iterator:
                 if isinstance(chunk, str):
                     chunk = chunk.encode('utf-8')
-                if self.current_info.get("endpoint") == "/v1/audio/speech":
+                if self.current_info.get("endpoint", "").split(" ")[-1].startswith(RAW_RESPONSE_PATHS):
                     yield chunk
                     continue
                 line = chunk.decode('utf-8')
@@ -397,6 +778,11 @@ class LoggingStreamingResponse(Response):
                         self.current_info["prompt_tokens"] = input_tokens
                         self.current_info["completion_tokens"] = output_tokens
                         self.current_info["total_tokens"] = total_tokens
+                        usage = resp.get("usage")
+                        if usage:
+                            # OpenAI 兼容格式在 prompt_tokens_details 中，Claude 原生格式在 usage 顶层
+                            self.current_info["cache_read_tokens"] = safe_get(usage, "prompt_tokens_details", "cached_tokens", default=0) or usage.get("cache_read_input_tokens") or 0
+                            self.current_info["cache_creation_tokens"] = safe_get(usage, "prompt_tokens_details", "cache_creation_tokens", default=0) or usage.get("cache_creation_input_tokens") or 0
                     except Exception as e:
                         logger.error(f"Error parsing response: {str(e)}, line: {repr(line)}")
                         continue
@@ -418,6 +804,7 @@ class StatsMiddleware(BaseHTTPMiddleware):
 
     async def dispatch(self, request: Request, call_next):
         start_time = time()
+        timings = RequestTimings()
 
         enable_moderation = False  # 默认不开启道德审查
 
@@ -438,17 +825,14 @@ class StatsMiddleware(BaseHTTPMiddleware):
             token = None
 
         api_index = None
+        role = None
         if token:
-            try:
-                api_list = app.state.api_list
-                api_index = api_list.index(token)
-            except ValueError:
-                # 如果 token 不在 api_list 中，检查是否以 api_list 中的任何一个开头
-                api_index = next((i for i, api in enumerate(api_list) if token.startswith(api)), None)
-                # token不在api_list中，使用默认值（不开启）
-                pass
-
+            api_index = app.state.api_key_index.lookup(token)
             if api_index is not None:
+                # 认证结果放到请求状态里，路由的 verify_api_key 直接复用，不再重复查找
+                request.state.api_token = token
+                request.state.api_index = api_index
+                role = safe_get(config, 'api_keys', api_index, "role", default=token[:8])
                 enable_moderation = safe_get(config, 'api_keys', api_index, "preferences", "ENABLE_MODERATION", default=False)
             else:
                 return JSONResponse(
@@ -458,6 +842,16 @@ class StatsMiddleware(BaseHTTPMiddleware):
         else:
             # 如果token为None，检查全局设置
             enable_moderation = config.get('ENABLE_MODERATION', False)
+        timings.add("auth", timings.start)
+
+        # 事件循环延迟持续过高时拒绝非管理员的 /v1 接口请求，前端配置页面和管理员请求不受影响
+        if app.state.loop_monitor.shedding and role != "admin" and request.url.path.startswith("/v1"):
+            metrics.shed_requests.inc((role or "",))
+            return JSONResponse(
+                status_code=503,
+                content={"error": "Server is overloaded, please retry later"},
+                headers={"Retry-After": str(app.state.loop_monitor.retry_after)}
+            )
 
         # 在 app.state 中存储此请求的信息
         request_id = str(uuid.uuid4())
@@ -479,79 +873,105 @@ class StatsMiddleware(BaseHTTPMiddleware):
             "prompt_tokens": 0,
             "completion_tokens": 0,
             # "cost": 0,
-            "total_tokens": 0
+            "total_tokens": 0,
+            "cache_read_tokens": 0,
+            "cache_creation_tokens": 0,
+            "scheduling": None,
+            "role": role,
+            "api_index": api_index,
+            "timings": timings,
         }
 
         # 设置请求信息到上下文
         current_request_info = request_info.set(request_info_data)
         current_info = request_info.get()
+        moderation_task = None
+        response = None
+        try:
+            if app.state.profiler.request_enabled:
+                app.state.profiler.start_request(current_info)
 
-        parsed_body = await parse_request_body(request)
-        if parsed_body:
-            try:
-                request_model = UnifiedRequest.model_validate(parsed_body).data
-                if is_debug:
-                    logger.info("request_model: %s", json.dumps(request_model.model_dump(exclude_unset=True), indent=2, ensure_ascii=False))
-                model = request_model.model
-                current_info["model"] = model
-
-                final_api_key = app.state.api_list[api_index]
+            stage_start = perf_counter()
+            parsed_body = await parse_request_body(request)
+            if parsed_body:
                 try:
-                    await app.state.user_api_keys_rate_limit[final_api_key].next(model)
-                except Exception as e:
-                    return JSONResponse(
-                        status_code=429,
-                        content={"error": "Too many requests"}
-                    )
-
-                moderated_content = None
-                if request_model.request_type == "chat":
-                    moderated_content = request_model.get_last_text_message()
-                elif request_model.request_type == "image":
-                    moderated_content = request_model.prompt
-                elif request_model.request_type == "tts":
-                    moderated_content = request_model.input
-                elif request_model.request_type == "moderation":
-                    pass
-                elif request_model.request_type == "embedding":
-                    if isinstance(request_model.input, list) and len(request_model.input) > 0 and isinstance(request_model.input[0], str):
-                        moderated_content = "\n".join(request_model.input)
-                    else:
-                        moderated_content = request_model.input
-                else:
-                    logger.error(f"Unknown request type: {request_model.request_type}")
-
-                if moderated_content:
-                    current_info["text"] = moderated_content
+                    request_model = UnifiedRequest.model_validate(parsed_body).data
+                    if is_debug:
+                        logger.info("request_model: %s", json.dumps(request_model.model_dump(exclude_unset=True), indent=2, ensure_ascii=False))
+                    model = request_model.model
+                    current_info["model"] = model
 
-                if enable_moderation and moderated_content:
-                    moderation_response = await self.moderate_content(moderated_content, api_index)
-                    is_flagged = moderation_response.get('results', [{}])[0].get('flagged', False)
-
-                    if is_flagged:
-                        logger.error(f"Content did not pass the moral check: %s", moderated_content)
-                        process_time = time() - start_time
-                        current_info["process_time"] = process_time
-                        current_info["is_flagged"] = is_flagged
-                        await update_stats(current_info)
+                    final_api_key = app.state.api_list[api_index]
+                    try:
+                        await app.state.user_api_keys_rate_limit[final_api_key].next(model)
+                    except Exception as e:
+                        metrics.rate_limit_rejections.inc((model, role or ""))
                         return JSONResponse(
-                            status_code=400,
-                            content={"error": "Content did not pass the moral check, please modify and try again."}
+                            status_code=429,
+                            content={"error": "Too many requests"}
                         )
-            except RequestValidationError:
-                logger.error(f"Invalid request body: {parsed_body}")
-                pass
-            except Exception as e:
-                if is_debug:
-                    import traceback
-                    traceback.print_exc()
 
-                logger.error(f"Error processing request or performing moral check: {str(e)}")
+                    moderated_content = None
+                    if request_model.request_type == "chat":
+                        moderated_content = request_model.get_last_text_message()
+                    elif request_model.request_type == "image":
+                        moderated_content = request_model.prompt
+                    elif request_model.request_type == "tts":
+                        moderated_content = request_model.input
+                    elif request_model.request_type == "moderation":
+                        pass
+                    elif request_model.request_type == "embedding":
+                        if isinstance(request_model.input, list) and len(request_model.input) > 0 and isinstance(request_model.input[0], str):
+                            moderated_content = "\n".join(request_model.input)
+                        else:
+                            moderated_content = request_model.input
+                    else:
+                        logger.error(f"Unknown request type: {request_model.request_type}")
+
+                    if moderated_content:
+                        current_info["text"] = moderated_content
+
+                    timings.add("parse", stage_start)
+                    if enable_moderation and moderated_content:
+                        stage_start = perf_counter()
+                        moderation_mode = safe_get(config, 'api_keys', api_index, "preferences", "MODERATION_MODE", default="blocking") if api_index is not None else "blocking"
+                        if moderation_mode == "optimistic":
+                            # 审查和上游请求并发进行，返回响应前再检查审查结果
+                            moderation_task = asyncio.create_task(self.moderate_in_background(moderated_content, api_index))
+                        elif await self.is_flagged(moderated_content, api_index):
+                            return await self.flagged_response(current_info, moderated_content, start_time)
+                        timings.add("moderation", stage_start)
+                except RequestValidationError:
+                    logger.error(f"Invalid request body: {parsed_body}")
+                    pass
+                except Exception as e:
+                    if is_debug:
+                        import traceback
+                        traceback.print_exc()
+
+                    logger.error(f"Error processing request or performing moral check: {str(e)}")
 
-        try:
             response = await call_next(request)
 
-            if request.url.path.startswith("/v1") and not DISABLE_DATABASE:
+            if moderation_task:
+                stage_start = perf_counter()
+                try:
+                    is_flagged = await moderation_task
+                except Exception as e:
+                    logger.error(f"Error performing moral check: {str(e)}")
+                    is_flagged = False
+                # optimistic 模式只记录上游响应后还需要等待审查的时间
+                timings.add("moderation", stage_start)
+                if is_flagged:
+                    # 丢弃已经生成的响应，不发送给客户端
+                    if hasattr(response, "body_iterator") and hasattr(response.body_iterator, "aclose"):
+                        await response.body_iterator.aclose()
+                    return await self.flagged_response(current_info, current_info["text"], start_time)
+
+            # 渠道名只对管理员或调试模式输出
+            response.headers["Server-Timing"] = timings.server_timing(include_provider=role == "admin" or is_debug)
+            # 指标不依赖数据库，关闭数据库时流式响应同样需要包装以统计 token 和耗时
+            if request.url.path.startswith("/v1") and (not DISABLE_DATABASE or METRICS_ENABLED):
                 if isinstance(response, (FastAPIStreamingResponse, StarletteStreamingResponse)) or type(response).__name__ == '_StreamingResponse':
                     response = LoggingStreamingResponse(
                         content=response.body_iterator,
@@ -567,14 +987,90 @@ class StatsMiddleware(BaseHTTPMiddleware):
 
             return response
         finally:
+            # 提前返回或 call_next 出错时 optimistic 审查任务没有被等待，取消任务或取出异常，避免任务泄漏
+            if moderation_task:
+                if not moderation_task.done():
+                    moderation_task.cancel()
+                elif not moderation_task.cancelled():
+                    moderation_task.exception()
+            # 没有被 LoggingStreamingResponse 包装的响应在这里结束分析，包装的响应在发送完成后结束
+            if not isinstance(response, LoggingStreamingResponse):
+                finish_profile(current_info)
             # print("current_request_info", current_request_info)
             request_info.reset(current_request_info)
 
+    async def flagged_response(self, current_info, moderated_content, start_time):
+        logger.error(f"Content did not pass the moral check: %s", moderated_content)
+        process_time = time() - start_time
+        current_info["process_time"] = process_time
+        current_info["is_flagged"] = True
+        metrics.observe_request(current_info, 400)
+        finish_profile(current_info)
+        await update_stats(current_info)
+        return JSONResponse(
+            status_code=400,
+            content={"error": "Content did not pass the moral check, please modify and try again."}
+        )
+
+    async def is_flagged(self, content, api_index):
+        # 长文本按句子切块并发审查，任意一块违规即返回，其余请求取消
+        if api_index is not None:
+            chunk_size = safe_get(app.state.config, 'api_keys', api_index, "preferences", "MODERATION_CHUNK_SIZE", default=8000)
+            parallelism = safe_get(app.state.config, 'api_keys', api_index, "preferences", "MODERATION_PARALLELISM", default=4)
+        else:
+            chunk_size, parallelism = 8000, 4
+        chunks = split_moderation_input(content, int(chunk_size))
+        if len(chunks) == 1:
+            return await self.is_chunk_flagged(chunks[0], api_index)
+
+        semaphore = asyncio.Semaphore(max(1, int(parallelism)))
+        async def check(chunk):
+            async with semaphore:
+                # 每个块的审查请求使用独立的 request_info 副本
+                request_info.set(dict(request_info.get()))
+                return await self.is_chunk_flagged(chunk, api_index)
+
+        tasks = [asyncio.create_task(check(chunk)) for chunk in chunks]
+        try:
+            for future in asyncio.as_completed(tasks):
+                if await future:
+                    return True
+            return False
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def is_chunk_flagged(self, content, api_index):
+        moderation_cache = getattr(app.state, "moderation_cache", None)
+        cache_key = None
+        if moderation_cache is not None:
+            cache_key = hashlib.sha256(json.dumps(content, ensure_ascii=False).encode("utf-8")).hexdigest()
+            cached = moderation_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        moderation_response = await self.moderate_content(content, api_index)
+        results = moderation_response.get('results')
+        is_flagged = any(result.get('flagged', False) for result in results or [{}])
+        if cache_key and results:
+            moderation_cache.set(cache_key, is_flagged)
+        return is_flagged
+
+    async def moderate_in_background(self, content, api_index):
+        # 任务拥有独立的上下文，换成 request_info 的副本，避免审查请求覆盖当前请求的统计信息
+        request_info.set(dict(request_info.get()))
+        return await self.is_flagged(content, api_index)
+
     async def moderate_content(self, content, api_index):
         moderation_request = ModerationRequest(input=content)
 
-        # 直接调用 moderations 函数
-        response = await moderations(moderation_request, api_index)
+        # 审查请求使用独立的 request_info 和计时，不计入当前请求的上游尝试
+        token = request_info.set({**request_info.get(), "timings": RequestTimings()})
+        try:
+            # 直接调用 moderations 函数
+            response = await moderations(moderation_request, api_index)
+        finally:
+            request_info.reset(token)
 
         # 读取流式响应的内容
         moderation_result = b""
@@ -600,6 +1096,24 @@ app.add_middleware(
 
 app.add_middleware(StatsMiddleware)
 
+async def trace_upstream_request(request):
+    """通过 httpcore 的 trace 扩展记录当前上游尝试等待连接（含建连）和等待响应头的时间"""
+    timings = request_info.get().get("timings")
+    if not timings:
+        return
+    sent = perf_counter()
+    headers_sent = None
+
+    async def trace(event_name, info):
+        nonlocal headers_sent
+        if event_name.endswith("send_request_headers.started"):
+            headers_sent = perf_counter()
+            timings.add_attempt("connect", sent)
+        elif event_name.endswith("receive_response_headers.complete") and headers_sent:
+            timings.add_attempt("ttfb", headers_sent)
+
+    request.extensions["trace"] = trace
+
 class ClientManager:
     def __init__(self, pool_size=100):
         self.pool_size = pool_size
@@ -636,7 +1150,8 @@ class ClientManager:
             client_config = {
                 **self.default_config,
                 "timeout": timeout,
-                "limits": limits
+                "limits": limits,
+                "event_hooks": {"request": [trace_upstream_request]},
             }
 
             if proxy:
@@ -682,6 +1197,7 @@ async def ensure_config(request: Request, call_next):
     if app and not hasattr(app.state, 'config'):
         # logger.warning("Config not found, attempting to reload")
         app.state.config, app.state.api_keys_db, app.state.api_list = await load_config(app)
+        app.state.api_key_index = ApiKeyIndex(app.state.api_list)
 
         if app.state.api_list:
             app.state.user_api_keys_rate_limit = defaultdict(ThreadSafeCircularList)
@@ -764,6 +1280,28 @@ async def ensure_config(request: Request, call_next):
 
         app.state.channel_manager = ChannelManager(cooldown_period=COOLDOWN_PERIOD)
 
+    if app and not hasattr(app.state, "moderation_cache"):
+        moderation_cache_config = safe_get(app.state.config, "preferences", "moderation_cache", default=True)
+        if moderation_cache_config:
+            if not isinstance(moderation_cache_config, dict):
+                moderation_cache_config = {}
+            app.state.moderation_cache = LRUCache(
+                max_items=int(moderation_cache_config.get("max_items", 10000)),
+                ttl=moderation_cache_config.get("ttl", 3600),
+            )
+        else:
+            app.state.moderation_cache = None
+
+    if app and not hasattr(app.state, "speech_cache"):
+        app.state.speech_cache = SpeechCache.from_config(safe_get(app.state.config, "preferences", "speech_cache"))
+
+    if app and not hasattr(app.state, "upload_limiter"):
+        app.state.upload_limiter = UploadLimiter.from_config(safe_get(app.state.config, "preferences", "upload"))
+
+    if app and not hasattr(app.state, "embedding_cache"):
+        embedding_cache_config = safe_get(app.state.config, "preferences", "embedding_cache", default=None)
+        app.state.embedding_cache = EmbeddingCache.from_config(embedding_cache_config)
+
     if app and not hasattr(app.state, "error_triggers"):
         if app.state.config and 'preferences' in app.state.config:
             ERROR_TRIGGERS = app.state.config['preferences'].get('error_triggers', [])
@@ -771,13 +1309,23 @@ async def ensure_config(request: Request, call_next):
             ERROR_TRIGGERS = []
         app.state.error_triggers = ERROR_TRIGGERS
 
+    if app and not hasattr(app.state, "profiler"):
+        app.state.profiler = Profiler.from_config(safe_get(app.state.config, "preferences", "profiling"))
+
+    if app and not hasattr(app.state, "loop_monitor"):
+        app.state.loop_monitor = LoopLagMonitor.from_config(safe_get(app.state.config, "preferences", "loop_monitor"))
+        app.state.loop_monitor.start()
+
+    if app and not hasattr(app.state, "models_responses"):
+        app.state.models_responses = {}
+
     if app and app.state.api_keys_db and not hasattr(app.state, "models_list"):
         app.state.models_list = {}
         for item in app.state.api_keys_db:
             api_key_model_list = item.get("model", [])
             for provider_rule in api_key_model_list:
                 provider_name = provider_rule.split("/")[0]
-                if provider_name.startswith("sk-") and provider_name in app.state.api_list:
+                if provider_name.startswith("sk-") and provider_name in app.state.api_key_index:
                     models_list = []
                     try:
                         # 构建请求头
@@ -800,6 +1348,8 @@ async def ensure_config(request: Request, call_next):
                         if str(e):
                             logger.error(f"获取模型列表失败: {str(e)}")
                     app.state.models_list[provider_name] = models_list
+        # 获取子 key 模型列表时缓存的是不完整的结果，全部获取完后重新生成
+        app.state.models_responses.clear()
 
     return await call_next(request)
 
@@ -887,7 +1437,22 @@ async def process_request(request: Union[RequestModel, ImageGenerationRequest, A
     if engine != "moderation":
         logger.info(f"provider: {channel_id:<11} model: {request.model:<22} engine: {engine} role: {role}")
 
-    url, headers, payload = await get_payload(request, engine, provider)
+    stage_start = perf_counter()
+    embedding_shards = get_embedding_shards(request, provider) if engine == "embedding" else None
+    embedding_batcher = None
+    if engine == "embedding" and not embedding_shards and not request.stream and get_single_embedding_input(request.input) is not None:
+        embedding_batcher = get_embedding_batcher(provider)
+    if embedding_shards:
+        # 每个分片在发送时各自生成请求体并轮换 API key
+        url, headers, payload = BaseAPI(provider['base_url']).embeddings, {}, {}
+    elif embedding_batcher:
+        # 合并发送的请求在批次发出时才取 API key，这里生成不带 Authorization 的请求体
+        url, headers, payload = await get_payload(request, engine, {**provider, "api": None})
+    else:
+        url, headers, payload = await get_payload(request, engine, provider)
+    timings = request_info.get().get("timings")
+    if timings:
+        timings.add_attempt("payload", stage_start)
     if is_debug:
         logger.info(url)
         logger.info(json.dumps(headers, indent=4, ensure_ascii=False))
@@ -910,25 +1475,39 @@ async def process_request(request: Union[RequestModel, ImageGenerationRequest, A
     # print("proxy", proxy)
 
     try:
+        upstream_start = perf_counter()
         async with app.state.client_manager.get_client(timeout_value, url, proxy) as client:
             if request.stream:
                 generator = fetch_response_stream(client, url, headers, payload, engine, original_model)
                 wrapped_generator, first_response_time = await error_handling_wrapper(generator, channel_id, engine, request.stream, app.state.error_triggers)
                 response = StarletteStreamingResponse(wrapped_generator, media_type="text/event-stream")
             else:
-                generator = fetch_response(client, url, headers, payload, engine, original_model)
+                if embedding_shards:
+                    logger.info(f"provider: {channel_id:<11} split {len(request.input)} embedding inputs into {len(embedding_shards)} shards")
+                    generator = fetch_sharded_embedding_response(client, request, engine, provider, embedding_shards, original_model)
+                elif embedding_batcher:
+                    batch_key = get_embedding_batch_key(url, original_model, headers, payload)
+                    generator = fetch_batched_embedding_response(embedding_batcher, batch_key, client, url, headers, payload, original_model, provider)
+                else:
+                    generator = fetch_response(client, url, headers, payload, engine, original_model)
                 wrapped_generator, first_response_time = await error_handling_wrapper(generator, channel_id, engine, request.stream, app.state.error_triggers)
 
                 # 处理音频和其他二进制响应
                 if endpoint == "/v1/audio/speech":
-                    if isinstance(wrapped_generator, bytes):
-                        response = Response(content=wrapped_generator, media_type="audio/mpeg")
+                    # 音频边收边发，只用第一个块识别格式
+                    first_chunk = await anext(wrapped_generator)
+                    media_type = get_audio_media_type(first_chunk, request.response_format)
+                    response = StarletteStreamingResponse(prepend_chunk(first_chunk, wrapped_generator), media_type=media_type)
                 else:
                     first_element = await anext(wrapped_generator)
                     first_element = first_element.lstrip("data: ")
                     first_element = json.loads(first_element)
+                    if engine == "embedding":
+                        first_element = format_embedding_response(first_element, request.encoding_format, request.dimensions)
                     response = StarletteStreamingResponse(iter([json.dumps(first_element)]), media_type="application/json")
 
+            if timings:
+                timings.add_attempt("first_chunk", upstream_start)
             # 更新成功计数和首次响应时间
             await update_channel_stats(current_info["request_id"], channel_id, request.model, current_info["api_key"], success=True)
             current_info["first_response_time"] = first_response_time
@@ -1001,7 +1580,7 @@ async def get_provider_rules(model_rule, config, request_model):
             models_list = []
 
             # api_keys 中 api 为 sk- 时，表示继承 api_keys，将 api_keys 中的 api key 当作 渠道
-            if provider_name.startswith("sk-") and provider_name in app.state.api_list:
+            if provider_name.startswith("sk-") and provider_name in app.state.api_key_index:
                 if app.state.models_list.get(provider_name):
                     models_list = app.state.models_list[provider_name]
                 else:
@@ -1046,7 +1625,7 @@ def get_provider_list(provider_rules, config, request_model):
     # print("provider_rules", provider_rules)
     for item in provider_rules:
         provider_name = item.split("/")[0]
-        if provider_name.startswith("sk-") and provider_name in app.state.api_list:
+        if provider_name.startswith("sk-") and provider_name in app.state.api_key_index:
             provider_list.append({"provider": provider_name, "base_url": "http://127.0.0.1:8000/v1/chat/completions", "model": [{request_model: request_model}], "tools": True})
         else:
             for provider in config['providers']:
@@ -1078,6 +1657,20 @@ async def get_matching_providers(request_model, config, api_index):
     # print("provider_list", provider_list)
     return provider_list
 
+async def get_cache_scope(request_model, config, api_index):
+    """
+    响应缓存的作用域：先按 request_model 相同的规则检查模型权限，无权访问时返回 404，
+    再用可路由到的上游渠道和上游模型名组成作用域，别名不同但上游相同的请求共享缓存。
+    """
+    if not safe_get(config, 'api_keys', api_index, 'model'):
+        raise HTTPException(status_code=404, detail=f"No matching model found: {request_model}")
+    matching_providers = await get_matching_providers(request_model, config, api_index)
+    if not matching_providers:
+        raise HTTPException(status_code=404, detail=f"No matching model found: {request_model}")
+    return ",".join(sorted(set(
+        f"{provider['provider']}/{next(iter(provider['model'][0]))}" for provider in matching_providers
+    )))
+
 async def get_right_order_providers(request_model, config, api_index, scheduling_algorithm):
     matching_providers = await get_matching_providers(request_model, config, api_index)
 
@@ -1094,6 +1687,11 @@ async def get_right_order_providers(request_model, config, api_index, scheduling
     if scheduling_algorithm == "random":
         matching_providers = random.sample(matching_providers, num_matching_providers)
 
+    affinity_key = prefix_affinity.get()
+    if scheduling_algorithm == "prefix_affinity" and affinity_key:
+        # 同一个对话前缀固定到同一个渠道，冷却中的渠道已被过滤，按哈希顺序回退
+        matching_providers = rendezvous_order(matching_providers, affinity_key, lambda provider: provider['provider'])
+
     weights = safe_get(config, 'api_keys', api_index, "weights")
 
     if weights:
@@ -1154,15 +1752,28 @@ class ModelRequestHandler:
             raise HTTPException(status_code=404, detail=f"No matching model found: {request_model}")
 
         scheduling_algorithm = safe_get(config, 'api_keys', api_index, "preferences", "SCHEDULING_ALGORITHM", default="fixed_priority")
+        if scheduling_algorithm == "prefix_affinity":
+            affinity_messages = safe_get(config, 'api_keys', api_index, "preferences", "PREFIX_AFFINITY_MESSAGES", default=1)
+            affinity_key = get_prefix_affinity_key(request, affinity_messages)
+            if affinity_key:
+                prefix_affinity.set(affinity_key)
+            else:
+                # 没有消息的请求（图片、语音、embedding 等）按 round_robin 调度
+                scheduling_algorithm = "round_robin"
+        request_info.get()["scheduling"] = scheduling_algorithm
 
+        timings = request_info.get().get("timings")
+        stage_start = perf_counter()
         matching_providers = await get_right_order_providers(request_model, config, api_index, scheduling_algorithm)
         num_matching_providers = len(matching_providers)
+        if timings:
+            timings.add("routing", stage_start)
 
         status_code = 500
         error_message = None
 
         start_index = 0
-        if scheduling_algorithm != "fixed_priority":
+        if scheduling_algorithm not in ("fixed_priority", "prefix_affinity"):
             async with self.locks[request_model]:
                 self.last_provider_indices[request_model] = (self.last_provider_indices[request_model] + 1) % num_matching_providers
                 start_index = self.last_provider_indices[request_model]
@@ -1186,8 +1797,12 @@ class ModelRequestHandler:
             current_index = (start_index + index) % num_matching_providers
             index += 1
             provider = matching_providers[current_index]
+            if timings:
+                timings.start_attempt(provider['provider'])
             try:
                 response = await process_request(request, provider, endpoint, role)
+                if timings:
+                    timings.end_attempt(response.status_code)
                 return response
             except (Exception, HTTPException, asyncio.CancelledError, httpx.ReadError, httpx.RemoteProtocolError, httpx.ReadTimeout, httpx.ConnectError) as e:
 
@@ -1214,12 +1829,15 @@ class ModelRequestHandler:
                 else:
                     status_code = 500  # Internal Server Error
                     error_message = str(e) or f"Unknown error: {e.__class__.__name__}"
+                if timings:
+                    timings.end_attempt(status_code)
 
                 channel_id = f"{provider['provider']}"
                 if app.state.channel_manager.cooldown_period > 0 and num_matching_providers > 1:
                     # 获取源模型名称（实际配置的模型名）
                     # source_model = list(provider['model'][0].keys())[0]
                     await app.state.channel_manager.exclude_model(channel_id, request_model)
+                    metrics.cooldowns.inc((channel_id, request_model, "channel"))
                     matching_providers = await get_right_order_providers(request_model, config, api_index, scheduling_algorithm)
                     last_num_matching_providers = num_matching_providers
                     num_matching_providers = len(matching_providers)
@@ -1231,12 +1849,14 @@ class ModelRequestHandler:
                 current_api = await provider_api_circular_list[channel_id].after_next_current()
                 if cooling_time > 0 and api_key_count > 1:
                     await provider_api_circular_list[channel_id].set_cooling(current_api, cooling_time=cooling_time)
+                    metrics.cooldowns.inc((channel_id, request_model, "api_key"))
 
                 logger.error(f"Error {status_code} with provider {channel_id} API key: {current_api}: {error_message}")
                 if is_debug:
                     import traceback
                     traceback.print_exc()
                 if auto_retry:
+                    metrics.failovers.inc((channel_id, request_model, role, str(status_code)))
                     continue
                 else:
                     return JSONResponse(
@@ -1257,28 +1877,21 @@ model_handler = ModelRequestHandler()
 
 security = HTTPBearer()
 
-def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    api_list = app.state.api_list
-    token = credentials.credentials
-    api_index = None
-    try:
-        api_index = api_list.index(token)
-    except ValueError:
-        # 如果 token 不在 api_list 中，检查是否以 api_list 中的任何一个开头
-        api_index = next((i for i, api in enumerate(api_list) if token.startswith(api)), None)
+def get_api_index(request: Request, token):
+    # StatsMiddleware 已经用同一个 token 认证过时直接使用它的结果
+    if getattr(request.state, "api_token", None) == token:
+        return request.state.api_index
+    return app.state.api_key_index.lookup(token)
+
+def verify_api_key(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    api_index = get_api_index(request, credentials.credentials)
     if api_index is None:
         raise HTTPException(status_code=403, detail="Invalid or missing API Key")
     return api_index
 
-def verify_admin_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    api_list = app.state.api_list
+def verify_admin_api_key(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
-    api_index = None
-    try:
-        api_index = api_list.index(token)
-    except ValueError:
-        # 如果 token 不在 api_list 中，检查是否以 api_list 中的任何一个开头
-        api_index = next((i for i, api in enumerate(api_list) if token.startswith(api)), None)
+    api_index = get_api_index(request, token)
     if api_index is None:
         raise HTTPException(status_code=403, detail="Invalid or missing API Key")
     # for api_key in app.state.api_keys_db:
@@ -1295,13 +1908,50 @@ async def request_model(request: RequestModel, api_index: int = Depends(verify_a
 async def options_handler():
     return JSONResponse(status_code=200, content={"detail": "OPTIONS allowed"})
 
+def get_models_response(api_index):
+    """每个 API key 的模型列表只在第一次请求时生成，缓存序列化后的 JSON、gzip 压缩结果和 ETag"""
+    models_responses = app.state.models_responses
+    if api_index not in models_responses:
+        models = post_all_models(api_index, app.state.config, app.state.api_list, app.state.models_list)
+        body = json.dumps({"object": "list", "data": models}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        models_responses[api_index] = (body, gzip.compress(body, mtime=0), f'"{digest}"', f'"{digest}-gzip"')
+    return models_responses[api_index]
+
+def etag_matches(if_none_match, etags):
+    for etag in if_none_match.split(","):
+        etag = etag.strip()
+        if etag == "*" or etag.removeprefix("W/") in etags:
+            return True
+    return False
+
+def accepts_gzip(accept_encoding):
+    for encoding in accept_encoding.lower().split(","):
+        name, _, params = encoding.strip().partition(";")
+        if name.strip() in ("gzip", "*"):
+            quality = params.replace(" ", "").removeprefix("q=")
+            try:
+                return float(quality or 1) > 0
+            except ValueError:
+                return True
+    return False
+
 @app.get("/v1/models")
-async def list_models(api_index: int = Depends(verify_api_key)):
-    models = post_all_models(api_index, app.state.config, app.state.api_list, app.state.models_list)
-    return JSONResponse(content={
-        "object": "list",
-        "data": models
-    })
+async def list_models(request: Request, api_index: int = Depends(verify_api_key)):
+    body, gzip_body, etag, gzip_etag = get_models_response(api_index)
+    use_gzip = accepts_gzip(request.headers.get("accept-encoding", ""))
+    headers = {
+        "ETag": gzip_etag if use_gzip else etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, (etag, gzip_etag)):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=gzip_body, media_type="application/json", headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.post("/v1/images/generations")
 async def images_generations(
@@ -1315,14 +1965,42 @@ async def embeddings(
     request: EmbeddingRequest,
     api_index: int = Depends(verify_api_key)
 ):
-    return await model_handler.request_model(request, api_index, endpoint="/v1/embeddings")
+    if app.state.embedding_cache is None:
+        return await model_handler.request_model(request, api_index, endpoint="/v1/embeddings")
+
+    async def request_upstream(sub_request):
+        return await model_handler.request_model(sub_request, api_index, endpoint="/v1/embeddings")
+
+    scope = await get_cache_scope(request.model, app.state.config, api_index)
+    response_json, cache_status = await get_cached_embeddings(request, app.state.embedding_cache, request_upstream, scope)
+    if cache_status is None:
+        return response_json
+    return JSONResponse(
+        content=response_json,
+        headers={"X-Embedding-Cache": f"hits={cache_status['hits']}, misses={cache_status['misses']}"}
+    )
 
 @app.post("/v1/audio/speech")
 async def audio_speech(
     request: TextToSpeechRequest,
     api_index: str = Depends(verify_api_key)
 ):
-    return await model_handler.request_model(request, api_index, endpoint="/v1/audio/speech")
+    speech_cache = app.state.speech_cache
+    if not speech_cache:
+        return await model_handler.request_model(request, api_index, endpoint="/v1/audio/speech")
+
+    scope = await get_cache_scope(request.model, app.state.config, api_index)
+    cache_key = speech_cache.make_key(request, scope)
+    cached = speech_cache.get(cache_key)
+    if cached:
+        file_path, media_type = cached
+        return FileResponse(file_path, media_type=media_type, headers={"X-TTS-Cache": "hit"})
+
+    response = await model_handler.request_model(request, api_index, endpoint="/v1/audio/speech")
+    if isinstance(response, StarletteStreamingResponse) and response.status_code == 200:
+        response.body_iterator = speech_cache.tee(cache_key, response.body_iterator, response.media_type)
+        response.headers["X-TTS-Cache"] = "miss"
+    return response
 
 @app.post("/v1/moderations")
 async def moderations(
@@ -1332,7 +2010,6 @@ async def moderations(
     return await model_handler.request_model(request, api_index, endpoint="/v1/moderations")
 
 from fastapi import UploadFile, File, Form, HTTPException
-import io
 @app.post("/v1/audio/transcriptions")
 async def audio_transcriptions(
     file: UploadFile = File(...),
@@ -1340,17 +2017,16 @@ async def audio_transcriptions(
     api_index: int = Depends(verify_api_key)
 ):
     try:
-        # 读取上传的文件内容
-        content = await file.read()
-        file_obj = io.BytesIO(content)
-
-        # 创建AudioTranscriptionRequest对象
+        # UploadFile 本身是 SpooledTemporaryFile，超过阈值的部分在磁盘上，直接按块转发，不整体读入内存
         request = AudioTranscriptionRequest(
-            file=(file.filename, file_obj, file.content_type),
+            file=(file.filename, file.file, file.content_type),
             model=model
         )
 
-        return await model_handler.request_model(request, api_index, endpoint="/v1/audio/transcriptions")
+        async with app.state.upload_limiter.reserve(get_file_size(file.file)):
+            return await model_handler.request_model(request, api_index, endpoint="/v1/audio/transcriptions")
+    except HTTPException:
+        raise
     except UnicodeDecodeError:
         raise HTTPException(status_code=400, detail="Invalid audio file encoding")
     except Exception as e:
@@ -1368,9 +2044,90 @@ def generate_api_key():
     api_key = "sk-" + random_string
     return JSONResponse(content={"api_key": api_key})
 
+# 分析接口都声明为 async，和请求路径上的 start_request 一样在事件循环线程中修改分析器状态
+@app.get("/v1/profile/requests")
+async def list_request_profiles(token: str = Depends(verify_admin_api_key)):
+    '''
+    ## 慢请求分析
+
+    返回慢请求分析的当前设置，以及最近保留下来的请求采样摘要。需要 admin API key。
+    '''
+    return JSONResponse(content={"settings": app.state.profiler.settings(), "requests": app.state.profiler.list_requests()})
+
+@app.post("/v1/profile/requests")
+async def configure_request_profiles(
+    token: str = Depends(verify_admin_api_key),
+    slow_request_ms: Optional[float] = Query(default=None, gt=0, description="Keep stacks of requests slower than this, unset to disable"),
+    model: Optional[str] = Query(default=None),
+    endpoint: Optional[str] = Query(default=None, description='For example "POST /v1/chat/completions"'),
+    provider: Optional[str] = Query(default=None),
+    role: Optional[str] = Query(default=None),
+):
+    '''
+    设置慢请求分析：耗时超过 `slow_request_ms` 的请求，或者同时符合所有过滤条件（model、endpoint、provider、role）的请求会保留采样。
+    不带任何参数则关闭。
+    '''
+    app.state.profiler.configure(slow_request_ms, {"model": model, "endpoint": endpoint, "provider": provider, "role": role})
+    return JSONResponse(content={"settings": app.state.profiler.settings()})
+
+@app.get("/v1/profile/requests/{request_id}")
+async def get_request_profile(
+    request_id: str,
+    token: str = Depends(verify_admin_api_key),
+    format: str = Query(default="speedscope", pattern="^(speedscope|collapsed)$")
+):
+    profile = app.state.profiler.get_request(request_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    content, media_type = await asyncio.to_thread(app.state.profiler.export, profile["stacks"], f"{profile['endpoint']} {profile['model']} {profile['duration']}s", format)
+    return Response(content=content, media_type=media_type)
+
+@app.post("/v1/profile/start")
+async def start_process_profile(
+    token: str = Depends(verify_admin_api_key),
+    duration: float = Query(default=30, gt=0, le=600, description="Seconds to sample before stopping automatically")
+):
+    '''
+    ## 进程分析
+
+    开始采样进程内所有线程的调用栈，`duration` 秒后自动结束，之后用 `/v1/profile` 下载结果。需要 admin API key。
+    '''
+    profile = app.state.profiler.start_process(duration)
+    loop = asyncio.get_running_loop()
+    loop.call_later(duration, lambda: app.state.profiler.process_profile is profile and app.state.profiler.stop_process())
+    return JSONResponse(content=app.state.profiler.process_status())
+
+@app.post("/v1/profile/stop")
+async def stop_process_profile(token: str = Depends(verify_admin_api_key)):
+    if app.state.profiler.stop_process() is None:
+        raise HTTPException(status_code=404, detail="No process profile")
+    return JSONResponse(content=app.state.profiler.process_status())
+
+@app.get("/v1/profile")
+async def get_process_profile(
+    token: str = Depends(verify_admin_api_key),
+    format: str = Query(default="speedscope", pattern="^(speedscope|collapsed)$")
+):
+    '''
+    下载最近一次进程分析的结果，分析还在进行时返回目前为止的采样。
+    '''
+    status = app.state.profiler.process_status()
+    if status is None:
+        raise HTTPException(status_code=404, detail="No process profile")
+    content, media_type = await asyncio.to_thread(app.state.profiler.export, app.state.profiler.process_profile.stacks, f"uni-api process {status['duration']}s", format)
+    return Response(content=content, media_type=media_type)
+
+@app.get("/metrics")
+def get_metrics(token: str = Depends(verify_admin_api_key)):
+    '''
+    Prometheus 文本格式的指标，数据保存在内存中，抓取时不访问数据库。需要带上 admin API key。
+    '''
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # 在 /stats 路由中返回成功和失败百分比
-from datetime import datetime, timedelta, timezone
-from sqlalchemy import func, desc, case
+from sqlalchemy import func
 from fastapi import Query
 
 @app.get("/v1/stats")
@@ -1391,109 +2148,209 @@ async def get_stats(
     3. 每个模型在所有渠道总的请求次数。
     4. 每个端点的请求次数。
     5. 每个ip请求的次数。
+    6. 每个渠道下面每个模型的 prompt 缓存读写 token 数和缓存命中比例（只列出有缓存记录的模型）。
+    7. 每种调度算法的请求数、平均首字时间和 prompt 缓存命中比例，用来比较 prefix_affinity 和其他调度算法。
 
     `/v1/stats?hours=48` 参数 `hours` 可以控制返回最近多少小时的数据统计，不传 `hours` 这个参数，默认统计最近 24 小时的统计数据。
 
+    统计只读取按分钟和小时预聚合的 request_rollups、channel_rollups 表，不扫描原始记录。
+
     还有其他统计数据，可以自己写sql在数据库自己查。其他数据包括：首字时间，每个请求的总处理时间，每次请求是否成功，每次请求是否符合道德审查，每次请求的文本内容，每次请求的 API key，每次请求的输入 token，输出 token 数量。
     '''
     if DISABLE_DATABASE:
         return JSONResponse(content={"stats": {}})
+    # 计算指定时间范围的开始时间
+    start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
     async with async_session() as session:
-        # 计算指定时间范围的开始时间
-        start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
+        channel_rows = (await session.execute(
+            select(
+                ChannelRollup.provider,
+                ChannelRollup.model,
+                func.sum(ChannelRollup.total).label('total'),
+                func.sum(ChannelRollup.success_count).label('success_count')
+            )
+            .where(rollup_window(ChannelRollup, start_time))
+            .group_by(ChannelRollup.provider, ChannelRollup.model)
+        )).fetchall()
 
-        # 1. 每个渠道下面每个模型的成功率
-        channel_model_stats = await session.execute(
+        request_rows = (await session.execute(
             select(
-                ChannelStat.provider,
-                ChannelStat.model,
-                func.count().label('total'),
-                func.sum(case((ChannelStat.success == True, 1), else_=0)).label('success_count')
+                RequestRollup.provider,
+                RequestRollup.model,
+                RequestRollup.endpoint,
+                RequestRollup.client_ip,
+                RequestRollup.scheduling,
+                func.sum(RequestRollup.request_count).label('count'),
+                func.sum(RequestRollup.prompt_tokens).label('prompt_tokens'),
+                func.sum(RequestRollup.cache_read_tokens).label('cache_read_tokens'),
+                func.sum(RequestRollup.cache_creation_tokens).label('cache_creation_tokens'),
+                func.sum(RequestRollup.first_response_time_sum).label('first_response_time_sum'),
+                func.sum(RequestRollup.first_response_count).label('first_response_count')
             )
-            .where(ChannelStat.timestamp >= start_time)
-            .group_by(ChannelStat.provider, ChannelStat.model)
-        )
-        channel_model_stats = channel_model_stats.fetchall()
+            .where(rollup_window(RequestRollup, start_time))
+            .group_by(RequestRollup.provider, RequestRollup.model, RequestRollup.endpoint, RequestRollup.client_ip, RequestRollup.scheduling)
+        )).fetchall()
+
+    return JSONResponse(content={**build_stats(channel_rows, request_rows, hours), **cache_stats()})
 
-        # 2. 每个渠道总的成功率
-        channel_stats = await session.execute(
+@app.get("/v1/stats/requests")
+async def get_recent_requests(
+    request: Request,
+    token: str = Depends(verify_admin_api_key),
+    limit: int = Query(default=50, ge=1, le=500, description="Number of most recent requests to return (1-500)")
+):
+    '''
+    ## 最近的请求记录
+
+    返回最近 `limit` 条请求的原始记录，压缩存储的请求文本会自动解压。需要 admin API key。
+    '''
+    if DISABLE_DATABASE:
+        return JSONResponse(content={"requests": []})
+    async with async_session() as session:
+        rows = (await session.execute(
             select(
-                ChannelStat.provider,
-                func.count().label('total'),
-                func.sum(case((ChannelStat.success == True, 1), else_=0)).label('success_count')
+                RequestStat.timestamp,
+                RequestStat.request_id,
+                RequestStat.endpoint,
+                RequestStat.provider,
+                RequestStat.model,
+                RequestStat.api_key,
+                RequestStat.is_flagged,
+                RequestStat.prompt_tokens,
+                RequestStat.completion_tokens,
+                RequestStat.first_response_time,
+                RequestStat.process_time,
+                RequestStat.text,
+                RequestStat.text_encoding
             )
-            .where(ChannelStat.timestamp >= start_time)
-            .group_by(ChannelStat.provider)
-        )
-        channel_stats = channel_stats.fetchall()
+            .order_by(RequestStat.id.desc())
+            .limit(limit)
+        )).fetchall()
 
-        # 3. 每个模型在所有渠道总的请求次数
-        model_stats = await session.execute(
-            select(RequestStat.model, func.count().label('count'))
-            .where(RequestStat.timestamp >= start_time)
-            .group_by(RequestStat.model)
-            .order_by(desc('count'))
-        )
-        model_stats = model_stats.fetchall()
+    texts = await asyncio.to_thread(lambda: [decompress_text(row.text, row.text_encoding) for row in rows])
+    return JSONResponse(content={"requests": [
+        {
+            **{key: value for key, value in row._mapping.items() if key not in ("timestamp", "text", "text_encoding")},
+            "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+            "text": text,
+        } for row, text in zip(rows, texts)
+    ]})
+
+@app.get("/v1/stats/export")
+async def export_stats(
+    request: Request,
+    token: str = Depends(verify_admin_api_key),
+    start: Optional[str] = Query(default=None, description="ISO start time (inclusive), defaults to 7 days ago"),
+    end: Optional[str] = Query(default=None, description="ISO end time (exclusive), defaults to now"),
+    kind: str = Query(default="request", pattern="^(request|channel)$")
+):
+    '''
+    ## 导出统计数据
 
-        # 4. 每个端点的请求次数
-        endpoint_stats = await session.execute(
-            select(RequestStat.endpoint, func.count().label('count'))
-            .where(RequestStat.timestamp >= start_time)
-            .group_by(RequestStat.endpoint)
-            .order_by(desc('count'))
-        )
-        endpoint_stats = endpoint_stats.fetchall()
-
-        # 5. 每个ip请求的次数
-        ip_stats = await session.execute(
-            select(RequestStat.client_ip, func.count().label('count'))
-            .where(RequestStat.timestamp >= start_time)
-            .group_by(RequestStat.client_ip)
-            .order_by(desc('count'))
-        )
-        ip_stats = ip_stats.fetchall()
+    以 Parquet 流的形式导出 `[start, end)` 时间范围内的原始记录，需要设置 `STATS_SINK` 包含 `segments` 并安装 pyarrow。需要 admin API key。
+    '''
+    if segment_sink is None:
+        raise HTTPException(status_code=404, detail="Stats segments are disabled, set STATS_SINK=sqlite,segments")
+    try:
+        end_time = parse_timestamp(end) or datetime.now(timezone.utc)
+        start_time = parse_timestamp(start) or end_time - timedelta(days=7)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid time: {str(e)}")
+    if importlib.util.find_spec("pyarrow") is None:
+        raise HTTPException(status_code=501, detail="pyarrow package is required for Parquet export")
+    # 先把内存中的记录写入分段，导出结果包含刚刚完成的请求
+    await segment_sink.flush()
+    filename = f"{kind}-{start_time:%Y%m%d%H%M}-{end_time:%Y%m%d%H%M}.parquet"
+    return StarletteStreamingResponse(
+        iter_parquet(STATS_SEGMENT_DIR, kind, STATS_FIELDS[kind], start_time, end_time),
+        media_type="application/vnd.apache.parquet",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
-    # 处理统计数据并返回
-    stats = {
+def cache_stats():
+    stats = {}
+    if getattr(app.state, "embedding_cache", None):
+        stats["embedding_cache"] = app.state.embedding_cache.stats()
+    if getattr(app.state, "speech_cache", None):
+        stats["speech_cache"] = app.state.speech_cache.stats()
+    return stats
+
+def success_rate(item):
+    return item["success_count"] / item["total"] if item["total"] > 0 else 0
+
+def build_stats(channel_rows, request_rows, hours):
+    """一次遍历预聚合结果，生成 /v1/stats 的各项统计"""
+    channel_models = []
+    channels = defaultdict(lambda: {"total": 0, "success_count": 0})
+    for row in channel_rows:
+        channel_models.append({"provider": row.provider, "model": row.model, "total": row.total, "success_count": row.success_count})
+        channels[row.provider]["total"] += row.total
+        channels[row.provider]["success_count"] += row.success_count
+
+    models = defaultdict(int)
+    endpoints = defaultdict(int)
+    ips = defaultdict(int)
+    prompt_cache = defaultdict(lambda: [0, 0, 0])
+    scheduling = defaultdict(lambda: [0, 0.0, 0, 0, 0])
+    for row in request_rows:
+        models[row.model or None] += row.count
+        endpoints[row.endpoint or None] += row.count
+        ips[row.client_ip or None] += row.count
+        cache = prompt_cache[(row.provider or None, row.model or None)]
+        cache[0] += row.prompt_tokens
+        cache[1] += row.cache_read_tokens
+        cache[2] += row.cache_creation_tokens
+        if row.scheduling:
+            item = scheduling[row.scheduling]
+            item[0] += row.count
+            item[1] += row.first_response_time_sum
+            item[2] += row.first_response_count
+            item[3] += row.prompt_tokens
+            item[4] += row.cache_read_tokens
+
+    def by_count(counts):
+        return sorted(counts.items(), key=lambda x: x[1], reverse=True)
+
+    return {
         "time_range": f"Last {hours} hours",
         "channel_model_success_rates": [
             {
-                "provider": stat.provider,
-                "model": stat.model,
-                "success_rate": stat.success_count / stat.total if stat.total > 0 else 0,
-                "total_requests": stat.total
-            } for stat in sorted(channel_model_stats, key=lambda x: x.success_count / x.total if x.total > 0 else 0, reverse=True)
+                "provider": stat["provider"],
+                "model": stat["model"],
+                "success_rate": success_rate(stat),
+                "total_requests": stat["total"]
+            } for stat in sorted(channel_models, key=success_rate, reverse=True)
         ],
         "channel_success_rates": [
             {
-                "provider": stat.provider,
-                "success_rate": stat.success_count / stat.total if stat.total > 0 else 0,
-                "total_requests": stat.total
-            } for stat in sorted(channel_stats, key=lambda x: x.success_count / x.total if x.total > 0 else 0, reverse=True)
-        ],
-        "model_request_counts": [
-            {
-                "model": stat.model,
-                "count": stat.count
-            } for stat in model_stats
+                "provider": provider,
+                "success_rate": success_rate(stat),
+                "total_requests": stat["total"]
+            } for provider, stat in sorted(channels.items(), key=lambda x: success_rate(x[1]), reverse=True)
         ],
-        "endpoint_request_counts": [
+        "model_request_counts": [{"model": model, "count": count} for model, count in by_count(models)],
+        "endpoint_request_counts": [{"endpoint": endpoint, "count": count} for endpoint, count in by_count(endpoints)],
+        "ip_request_counts": [{"ip": ip, "count": count} for ip, count in by_count(ips)],
+        "prompt_cache": [
             {
-                "endpoint": stat.endpoint,
-                "count": stat.count
-            } for stat in endpoint_stats
+                "provider": provider,
+                "model": model,
+                "cache_read_tokens": cache_read_tokens,
+                "cache_creation_tokens": cache_creation_tokens,
+                "cached_ratio": cache_read_tokens / prompt_tokens if prompt_tokens else 0
+            } for (provider, model), (prompt_tokens, cache_read_tokens, cache_creation_tokens) in prompt_cache.items()
+            if cache_read_tokens + cache_creation_tokens > 0
         ],
-        "ip_request_counts": [
+        "scheduling_stats": [
             {
-                "ip": stat.client_ip,
-                "count": stat.count
-            } for stat in ip_stats
+                "scheduling": name,
+                "count": count,
+                "avg_first_response_time": first_response_time_sum / first_response_count if first_response_count else None,
+                "cached_ratio": cache_read_tokens / prompt_tokens if prompt_tokens else 0
+            } for name, (count, first_response_time_sum, first_response_count, prompt_tokens, cache_read_tokens) in scheduling.items()
         ]
     }
 
-    return JSONResponse(content=stats)
-
 
 
 from fastapi import FastAPI, Request
@@ -1720,6 +2577,26 @@ async def data_page(x_api_key: str = Depends(get_api_key)):
 
     return result
 
+def build_hourly_chart(model_stats, first_hour, hours=24):
+    """一次遍历小时桶，生成按时间正序的图表数据，标签使用本地时间的小时"""
+    chart_data = []
+    for i in range(hours):
+        hour = (first_hour + timedelta(hours=i)).replace(tzinfo=timezone.utc).astimezone()
+        chart_data.append({"label": f"{hour.hour:02d}"})
+    models = set()
+    for stat in model_stats:
+        if not stat.model:
+            continue
+        index = int((stat.bucket - first_hour).total_seconds() // 3600)
+        if 0 <= index < hours:
+            chart_data[index][stat.model] = chart_data[index].get(stat.model, 0) + stat.count
+            models.add(stat.model)
+    models = sorted(models)
+    for data_point in chart_data:
+        for model in models:
+            data_point.setdefault(model, 0)
+    return chart_data, models
+
 @frontend_router.get("/data", response_class=HTMLResponse, dependencies=[Depends(frontend_rate_limit_dependency)])
 async def data_page(x_api_key: str = Depends(get_api_key)):
     if not x_api_key:
@@ -1728,51 +2605,22 @@ async def data_page(x_api_key: str = Depends(get_api_key)):
     if DISABLE_DATABASE:
         return HTMLResponse("数据库已禁用")
 
+    # 当前小时和之前 23 个小时的小时桶
+    current_hour = datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0)
+    first_hour = current_hour - timedelta(hours=23)
     async with async_session() as session:
-        # 计算过去24小时的开始时间
-        start_time = datetime.now(timezone.utc) - timedelta(hours=24)
-
-        # 按小时统计每个模型的请求数据
         model_stats = await session.execute(
             select(
-                func.strftime('%H', RequestStat.timestamp).label('hour'),
-                RequestStat.model,
-                func.count().label('count')
+                RequestRollup.bucket,
+                RequestRollup.model,
+                func.sum(RequestRollup.request_count).label('count')
             )
-            .where(RequestStat.timestamp >= start_time)
-            .group_by('hour', RequestStat.model)
-            .order_by('hour')
+            .where(RequestRollup.granularity == "hour", RequestRollup.bucket >= first_hour)
+            .group_by(RequestRollup.bucket, RequestRollup.model)
         )
         model_stats = model_stats.fetchall()
 
-    # 获取所有唯一的模型名称
-    models = list(set(stat.model for stat in model_stats))
-
-    # 生成24小时的数据点
-    chart_data = []
-    current_hour = datetime.now().hour
-
-    for i in range(24):
-        # 计算小时标签(从当前小时往前推24小时)
-        hour = (current_hour - i) % 24
-        hour_str = f"{hour:02d}"
-
-        # 创建该小时的数据点
-        data_point = {"label": hour_str}
-
-        # 添加每个模型在该小时的请求数
-        for model in models:
-            count = next(
-                (stat.count for stat in model_stats
-                 if stat.hour == f"{hour:02d}" and stat.model == model),
-                0
-            )
-            data_point[model] = count
-
-        chart_data.append(data_point)
-
-    # 反转数据点顺序使其按时间正序显示
-    chart_data.reverse()
+    chart_data, models = build_hourly_chart(model_stats, first_hour)
 
     # 为每个模型配置显示属性
     chart_config = {
@@ -1805,7 +2653,6 @@ async def data_page(x_api_key: str = Depends(get_api_key)):
             )
         )
     ).render()
-    print(result)
 
     return result
 
@@ -1836,13 +2683,11 @@ async def get_columns_menu(menu_id: str, row_id: str):
         },
     ]
     result = dropdown.dropdown_menu_content(menu_id, columns).render()
-    print(result)
     return result
 
 @frontend_router.get("/dropdown-menu/{menu_id}", response_class=HTMLResponse, dependencies=[Depends(frontend_rate_limit_dependency)])
 async def get_columns_menu(menu_id: str):
     result = dropdown.dropdown_menu_content(menu_id, data_table_columns).render()
-    print(result)
     return result
 
 @frontend_router.get("/filter-table", response_class=HTMLResponse)
@@ -2065,6 +2910,12 @@ def update_row_data(row_id, updated_data):
     index = int(row_id)
     app.state.config["providers"][index] = updated_data
 
+async def save_config():
+    """前端修改配置后调用：/v1/models 缓存的响应和 ETag 已经过期，清空后按新配置重新生成"""
+    app.state.models_responses.clear()
+    if not DISABLE_DATABASE:
+        await asyncio.to_thread(save_api_yaml, app.state.config)
+
 @frontend_router.post("/submit/{row_id}", response_class=HTMLResponse, dependencies=[Depends(frontend_rate_limit_dependency)])
 async def submit_form(
     row_id: str,
@@ -2112,8 +2963,7 @@ async def submit_form(
         update_row_data(row_id, updated_data)
 
     # 保存更新后的配置
-    if not DISABLE_DATABASE:
-        save_api_yaml(app.state.config)
+    await save_config()
 
     return await root()
 
@@ -2126,8 +2976,7 @@ async def duplicate_row(row_id: str):
     app.state.config["providers"].insert(index + 1, new_data)
 
     # 保存更新后的配置
-    if not DISABLE_DATABASE:
-        save_api_yaml(app.state.config)
+    await save_config()
 
     return await root()
 
@@ -2137,8 +2986,7 @@ async def delete_row(row_id: str):
     del app.state.config["providers"][index]
 
     # 保存更新后的配置
-    if not DISABLE_DATABASE:
-        save_api_yaml(app.state.config)
+    await save_config()
 
     return await root()
 
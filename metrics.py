@@ -0,0 +1,146 @@
+"""
+进程内的指标注册表，以 Prometheus 文本格式在 /metrics 输出，抓取时不访问数据库。
+
+所有更新都在事件循环线程里进行，只做字典查找和数字加法，不需要加锁；
+直方图每次观测只给一个桶加一，累计值在抓取时再计算。
+"""
+from bisect import bisect_left
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labelnames, labels, extra=None):
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}  # {标签值元组: 计数}
+
+    def inc(self, labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in list(self.values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+class Gauge:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}  # {标签值元组: 当前值}
+
+    def set(self, labels, value):
+        self.values[labels] = value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in list(self.values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # {标签值元组: [各桶计数..., +Inf 桶计数, 总和]}
+
+    def observe(self, labels, value):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, counts in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + format_value(float(bound)) + '"'
+                yield f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(counts[-1])}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+class MetricsRegistry:
+    def __init__(self):
+        labels = ("provider", "model", "role")
+        self.requests = Counter("uniapi_requests_total", "Requests handled, by the provider that served them.", labels)
+        self.errors = Counter("uniapi_request_errors_total", "Requests that returned an error status.", labels + ("status",))
+        self.failovers = Counter("uniapi_failovers_total", "Upstream attempts that failed and moved on to the next provider or key.", labels + ("status",))
+        self.cooldowns = Counter("uniapi_cooldowns_total", "Channels or upstream API keys put into cooldown.", ("provider", "model", "kind"))
+        self.rate_limit_rejections = Counter("uniapi_rate_limit_rejections_total", "Requests rejected by the API key rate limit.", ("model", "role"))
+        self.tokens = Counter("uniapi_tokens_total", "Tokens reported by upstream usage.", labels + ("type",))
+        self.ttft = Histogram(
+            "uniapi_time_to_first_token_seconds", "Time until the first upstream chunk.", labels,
+            (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64),
+        )
+        self.latency = Histogram(
+            "uniapi_request_duration_seconds", "Total request duration, including streaming.", labels,
+            (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320),
+        )
+        self.tokens_per_second = Histogram(
+            "uniapi_completion_tokens_per_second", "Completion tokens per second after the first token.", labels,
+            (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500),
+        )
+        self.loop_lag = Gauge("uniapi_event_loop_lag_seconds", "Scheduling delay of the latest event loop lag probe.")
+        self.loop_lag_histogram = Histogram(
+            "uniapi_event_loop_lag_distribution_seconds", "Scheduling delay of event loop lag probes.", (),
+            (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+        )
+        self.load_shedding = Gauge("uniapi_load_shedding", "1 while new non-admin requests are rejected because of event loop lag.")
+        self.shed_requests = Counter("uniapi_shed_requests_total", "Requests rejected with 503 because of event loop lag.", ("role",))
+
+    def observe_request(self, info, status_code):
+        """请求结束时调用一次，info 是 request_info 中的当前请求信息"""
+        if not info.get("model"):
+            # /v1/models 等不请求模型的接口不计入
+            return
+        labels = (info.get("provider") or "", info.get("model") or "", info.get("role") or "")
+        self.requests.inc(labels)
+        # 缓存命中等不经过上游的请求没有 success 标记，只按状态码判断
+        if status_code >= 400:
+            self.errors.inc(labels + (str(status_code),))
+        prompt_tokens = info.get("prompt_tokens") or 0
+        completion_tokens = info.get("completion_tokens") or 0
+        if prompt_tokens:
+            self.tokens.inc(labels + ("prompt",), prompt_tokens)
+        if completion_tokens:
+            self.tokens.inc(labels + ("completion",), completion_tokens)
+        first_response_time = info.get("first_response_time", -1)
+        if first_response_time is not None and first_response_time >= 0:
+            self.ttft.observe(labels, first_response_time)
+        process_time = info.get("process_time") or 0
+        self.latency.observe(labels, process_time)
+        generation_time = process_time - max(first_response_time or 0, 0)
+        if completion_tokens and generation_time > 0:
+            self.tokens_per_second.observe(labels, completion_tokens / generation_time)
+
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.errors, self.failovers, self.cooldowns, self.rate_limit_rejections,
+                       self.tokens, self.ttft, self.latency, self.tokens_per_second,
+                       self.loop_lag, self.loop_lag_histogram, self.load_shedding, self.shed_requests):
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
@@ -0,0 +1,255 @@
+"""
+采样分析器：后台线程定时读取 sys._current_frames() 记录调用栈，只在有需要时运行。
+
+慢请求分析：开启后，请求进行期间持续采样事件循环线程，请求结束时如果耗时超过阈值或符合管理员设置的过滤条件，
+就保留该请求时间窗口内的采样（事件循环在这段时间里执行的所有代码），否则丢弃。
+进程分析：管理员手动开始，采样所有线程，到达时长后自动结束。
+
+结果可以导出为 speedscope（https://www.speedscope.app）JSON 或 collapsed stack（flamegraph.pl、speedscope 都能读取）格式。
+"""
+import os
+import sys
+import json
+import time
+import threading
+from collections import Counter, deque
+from time import perf_counter
+
+MAX_STACK_DEPTH = 128
+
+def capture_stack(frame):
+    """调用栈保存为从外到内的 code 对象元组，导出时再格式化，采样时尽量少做事"""
+    codes = []
+    while frame is not None and len(codes) < MAX_STACK_DEPTH:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+def frame_name(code):
+    if isinstance(code, str):
+        return code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def to_collapsed(stacks):
+    lines = [";".join(frame_name(code) for code in stack) + f" {count}" for stack, count in stacks.most_common()]
+    return "\n".join(lines) + "\n"
+
+def to_speedscope(stacks, interval, name):
+    frames = []
+    frame_index = {}
+    samples = []
+    weights = []
+    for stack, count in stacks.most_common():
+        sample = []
+        for code in stack:
+            index = frame_index.get(code)
+            if index is None:
+                index = frame_index[code] = len(frames)
+                if isinstance(code, str):
+                    frames.append({"name": code})
+                else:
+                    frames.append({"name": code.co_name, "file": code.co_filename, "line": code.co_firstlineno})
+            sample.append(index)
+        samples.append(sample)
+        weights.append(count * interval)
+    total = sum(weights)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled", "name": name, "unit": "seconds",
+            "startValue": 0, "endValue": total, "samples": samples, "weights": weights,
+        }],
+        "name": name,
+        "exporter": "uni-api",
+    }
+
+class Sampler:
+    """共享的采样线程，有使用者时才运行，使用者按引用计数登记"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.consumers = ()  # 写时复制，采样线程遍历时不需要加锁
+        self.thread = None
+        self.stop_event = None
+        self.lock = threading.Lock()  # 登记和移除使用者时加锁
+
+    def add(self, consumer):
+        with self.lock:
+            self.consumers = self.consumers + (consumer,)
+            if self.thread is None:
+                self.stop_event = threading.Event()
+                self.thread = threading.Thread(target=self.run, args=(self.stop_event,), name="uni-api-profiler", daemon=True)
+                self.thread.start()
+
+    def remove(self, consumer):
+        with self.lock:
+            consumers = list(self.consumers)
+            if consumer in consumers:
+                consumers.remove(consumer)
+            self.consumers = tuple(consumers)
+            if not self.consumers and self.thread is not None:
+                self.stop_event.set()
+                self.thread = None
+
+    def run(self, stop_event):
+        own_ident = threading.get_ident()
+        while not stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            frames.pop(own_ident, None)
+            now = perf_counter()
+            for consumer in self.consumers:
+                consumer(now, frames)
+
+class RequestWindow:
+    """保存事件循环线程最近的采样，请求结束时按时间窗口取出"""
+    def __init__(self, loop_ident, maxlen):
+        self.loop_ident = loop_ident
+        self.samples = deque(maxlen=maxlen)
+
+    def __call__(self, now, frames):
+        frame = frames.get(self.loop_ident)
+        if frame is not None:
+            self.samples.append((now, capture_stack(frame)))
+
+    def collect(self, start, end):
+        stacks = Counter()
+        # 采样线程可能同时在追加，先复制一份再遍历
+        for timestamp, stack in reversed(tuple(self.samples)):
+            if timestamp < start:
+                break
+            if timestamp <= end:
+                stacks[stack] += 1
+        return stacks
+
+class ProcessProfile:
+    def __init__(self, duration):
+        self.started_at = time.time()
+        self.deadline = perf_counter() + duration
+        self.duration = duration
+        self.stacks = Counter()
+        self.samples = 0
+        self.finished = False
+
+    def __call__(self, now, frames):
+        if now > self.deadline:
+            return
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in frames.items():
+            self.stacks[(f"thread {names.get(ident, ident)}",) + capture_stack(frame)] += 1
+        self.samples += 1
+
+class Profiler:
+    def __init__(self, slow_request_ms=None, request_filter=None, interval_ms=10, keep=20, window_seconds=120):
+        self.interval = interval_ms / 1000
+        self.sampler = Sampler(self.interval)
+        self.keep = keep
+        self.window_seconds = window_seconds
+        self.window = None
+        self.inflight = 0
+        self.profiles = deque(maxlen=keep)
+        self.process_profile = None
+        self.configure(slow_request_ms, request_filter)
+
+    @classmethod
+    def from_config(cls, profiling_config):
+        if not isinstance(profiling_config, dict):
+            profiling_config = {}
+        return cls(
+            slow_request_ms=profiling_config.get("slow_request_ms"),
+            request_filter=profiling_config.get("filter"),
+            interval_ms=float(profiling_config.get("interval_ms", 10)),
+            keep=int(profiling_config.get("keep", 20)),
+            window_seconds=float(profiling_config.get("window_seconds", 120)),
+        )
+
+    def configure(self, slow_request_ms=None, request_filter=None):
+        self.slow_request_seconds = slow_request_ms / 1000 if slow_request_ms else None
+        self.request_filter = {key: value for key, value in (request_filter or {}).items() if value is not None}
+        # 请求路径上只检查这一个布尔值，关闭时几乎没有开销
+        self.request_enabled = bool(self.slow_request_seconds or self.request_filter)
+
+    def settings(self):
+        return {
+            "slow_request_ms": self.slow_request_seconds * 1000 if self.slow_request_seconds else None,
+            "filter": self.request_filter,
+            "interval_ms": self.interval * 1000,
+            "keep": self.keep,
+            "window_seconds": self.window_seconds,
+        }
+
+    def start_request(self, current_info):
+        if self.window is None:
+            self.window = RequestWindow(threading.get_ident(), int(self.window_seconds / self.interval))
+            self.sampler.add(self.window)
+        self.inflight += 1
+        current_info["profile_start"] = perf_counter()
+
+    def finish_request(self, current_info):
+        """请求结束时调用，可以重复调用，只有第一次生效"""
+        start = current_info.pop("profile_start", None)
+        if start is None:
+            return
+        end = perf_counter()
+        duration = end - start
+        slow = self.slow_request_seconds is not None and duration >= self.slow_request_seconds
+        matched = bool(self.request_filter) and all(str(current_info.get(key)) == str(value) for key, value in self.request_filter.items())
+        if (slow or matched) and self.window is not None:
+            stacks = self.window.collect(start, end)
+            if stacks:
+                self.profiles.append({
+                    "request_id": current_info.get("request_id"),
+                    "endpoint": current_info.get("endpoint"),
+                    "model": current_info.get("model"),
+                    "provider": current_info.get("provider"),
+                    "role": current_info.get("role"),
+                    "duration": round(duration, 4),
+                    "reason": "slow" if slow else "filter",
+                    "started_at": time.time() - duration,
+                    "samples": sum(stacks.values()),
+                    "stacks": stacks,
+                })
+        self.inflight -= 1
+        if self.inflight <= 0:
+            self.inflight = 0
+            self.sampler.remove(self.window)
+            self.window = None
+
+    def list_requests(self):
+        return [{key: value for key, value in profile.items() if key != "stacks"} for profile in reversed(self.profiles)]
+
+    def get_request(self, request_id):
+        for profile in self.profiles:
+            if profile["request_id"] == request_id:
+                return profile
+        return None
+
+    def start_process(self, duration):
+        self.stop_process()
+        self.process_profile = ProcessProfile(duration)
+        self.sampler.add(self.process_profile)
+        return self.process_profile
+
+    def stop_process(self):
+        profile = self.process_profile
+        if profile and not profile.finished:
+            profile.finished = True
+            profile.duration = min(profile.duration, time.time() - profile.started_at)
+            self.sampler.remove(profile)
+        return profile
+
+    def process_status(self):
+        profile = self.process_profile
+        if profile is None:
+            return None
+        if not profile.finished and perf_counter() > profile.deadline:
+            self.stop_process()
+        return {"started_at": profile.started_at, "duration": round(profile.duration, 3), "samples": profile.samples, "finished": profile.finished}
+
+    def export(self, stacks, name, format="speedscope"):
+        """返回 (内容, media_type)，格式化比较耗时，可以放到线程池中执行"""
+        # 进程分析进行中时采样线程还在写入，先复制一份
+        stacks = Counter(dict(stacks))
+        if format == "collapsed":
+            return to_collapsed(stacks), "text/plain; charset=utf-8"
+        return json.dumps(to_speedscope(stacks, self.interval, name)), "application/json"
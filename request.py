@@ -1,55 +1,50 @@
-import os
 import re
 import json
 import httpx
 import base64
+import asyncio
+import hashlib
 import urllib.parse
 from PIL import Image
 import io
 
+from log_config import logger
 from models import RequestModel
-from utils import c35s, c3s, c3o, c3h, gemini1, gemini2, BaseAPI, get_model_dict, provider_api_circular_list, safe_get, ThreadSafeCircularList
-
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        file_content = image_file.read()
-        file_type = get_image_format(file_content)
-        base64_encoded = base64.b64encode(file_content).decode('utf-8')
+from utils import c35s, c3s, c3o, c3h, gemini1, gemini2, BaseAPI, get_model_dict, provider_api_circular_list, safe_get, ThreadSafeCircularList, LRUCache
+
+IMAGE_MAX_BYTES = 20 * 1024 * 1024
+image_cache = LRUCache(max_items=256, max_bytes=128 * 1024 * 1024)
+image_inflight = {}  # {cache_key: Future}，合并同一张图片的并发请求
+image_client = None
+
+def get_image_client():
+    global image_client
+    if image_client is None or image_client.is_closed:
+        image_client = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            timeout=httpx.Timeout(30.0, connect=15.0),
+            limits=httpx.Limits(max_connections=64),
+        )
+    return image_client
 
-        if file_type == 'png':
-            return f"data:image/png;base64,{base64_encoded}"
-        elif file_type in ['jpeg', 'jpg']:
-            return f"data:image/jpeg;base64,{base64_encoded}"
-        else:
-            raise ValueError(f"不支持的图片格式: {file_type}")
+async def close_image_client():
+    global image_client
+    if image_client is not None:
+        await image_client.aclose()
+        image_client = None
 
 async def get_doc_from_url(url):
-    filename = urllib.parse.unquote(url.split("/")[-1])
-    transport = httpx.AsyncHTTPTransport(
-        http2=True,
-        verify=False,
-        retries=1
-    )
-    async with httpx.AsyncClient(transport=transport) as client:
-        try:
-            response = await client.get(
-                url,
-                timeout=30.0
-            )
-            with open(filename, 'wb') as f:
-                f.write(response.content)
-
-        except httpx.RequestError as e:
-            print(f"An error occurred while requesting {e.request.url!r}.")
-
-    return filename
-
-async def get_encode_image(image_url):
-    filename = await get_doc_from_url(image_url)
-    image_path = os.getcwd() + "/" + filename
-    base64_image = encode_image(image_path)
-    os.remove(image_path)
-    return base64_image
+    """流式下载到内存，超过 IMAGE_MAX_BYTES 时报错，不落盘"""
+    client = get_image_client()
+    content = bytearray()
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            content.extend(chunk)
+            if len(content) > IMAGE_MAX_BYTES:
+                raise ValueError(f"图片超过 {IMAGE_MAX_BYTES} 字节: {url}")
+    return bytes(content)
 
 def get_image_format(file_content):
     try:
@@ -58,31 +53,93 @@ def get_image_format(file_content):
     except:
         return None
 
-async def get_image_message(base64_image, engine = None):
-    if base64_image.startswith("http"):
-        base64_image = await get_encode_image(base64_image)
-    colon_index = base64_image.index(":")
-    semicolon_index = base64_image.index(";")
-    image_type = base64_image[colon_index + 1:semicolon_index]
+def transcode_image(file_content, image_type=None):
+    """在线程池中运行：识别图片格式，webp 转为 png，返回 data URI"""
+    if image_type is None:
+        file_type = get_image_format(file_content)
+        if file_type in ['jpeg', 'jpg']:
+            image_type = "image/jpeg"
+        elif file_type in ['png', 'gif', 'webp']:
+            image_type = f"image/{file_type}"
+        else:
+            raise ValueError(f"不支持的图片格式: {file_type}")
 
     if image_type == "image/webp":
         # 将webp转换为png
-
-        # 解码base64获取图片数据
-        image_data = base64.b64decode(base64_image.split(",")[1])
-
-        # 使用PIL打开webp图片
-        image = Image.open(io.BytesIO(image_data))
-
-        # 转换为PNG格式
+        image = Image.open(io.BytesIO(file_content))
         png_buffer = io.BytesIO()
         image.save(png_buffer, format="PNG")
-        png_base64 = base64.b64encode(png_buffer.getvalue()).decode('utf-8')
-
-        # 返回PNG格式的base64
-        base64_image = f"data:image/png;base64,{png_base64}"
+        file_content = png_buffer.getvalue()
         image_type = "image/png"
 
+    base64_encoded = base64.b64encode(file_content).decode('utf-8')
+    return f"data:{image_type};base64,{base64_encoded}"
+
+async def load_image(image_url):
+    if image_url.startswith("http"):
+        file_content = await get_doc_from_url(image_url)
+        return await asyncio.to_thread(transcode_image, file_content)
+    # data URI 只有 webp 需要解码转换
+    header, data = image_url.split(",", 1)
+    image_type = header[header.index(":") + 1:header.index(";")]
+    return await asyncio.to_thread(transcode_image, base64.b64decode(data), image_type)
+
+def get_image_cache_key(image_url):
+    if image_url.startswith("http"):
+        return image_url
+    if image_url[image_url.index(":") + 1:image_url.index(";")] == "image/webp":
+        return hashlib.sha256(image_url.encode("utf-8")).hexdigest()
+    return None
+
+async def get_normalized_image(image_url):
+    """返回可直接使用的 data URI，下载和转码结果按 URL 或内容哈希缓存"""
+    cache_key = get_image_cache_key(image_url)
+    if cache_key is None:
+        return image_url
+    cached = image_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    if cache_key in image_inflight:
+        return await asyncio.shield(image_inflight[cache_key])
+
+    future = asyncio.get_running_loop().create_future()
+    image_inflight[cache_key] = future
+    try:
+        result = await load_image(image_url)
+        image_cache.set(cache_key, result, len(result))
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        # 没有其他等待者时避免 "Future exception was never retrieved" 警告
+        future.exception()
+        raise
+    finally:
+        image_inflight.pop(cache_key, None)
+
+async def prefetch_images(messages, provider):
+    """并发下载和转码一组消息中的所有图片，之后逐条转换消息时直接命中缓存"""
+    if not provider.get("image", True) or not messages:
+        return
+    image_urls = set()
+    for msg in messages:
+        if isinstance(msg.content, list):
+            for item in msg.content:
+                if item.type == "image_url" and item.image_url:
+                    image_urls.add(item.image_url.url)
+    if len(image_urls) < 2:
+        return
+    results = await asyncio.gather(*[get_normalized_image(url) for url in image_urls], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Error prefetching image: {str(result)}")
+
+async def get_image_message(base64_image, engine = None):
+    base64_image = await get_normalized_image(base64_image)
+    colon_index = base64_image.index(":")
+    semicolon_index = base64_image.index(";")
+    image_type = base64_image[colon_index + 1:semicolon_index]
+
     if "gpt" == engine or "openrouter" == engine or "azure" == engine:
         return {
             "type": "image_url",
@@ -119,6 +176,80 @@ async def get_text_message(role, message, engine = None):
         return message
     raise ValueError("Unknown engine")
 
+MESSAGE_CACHE_ENGINES = ("gpt", "claude", "gemini", "vertex-claude", "vertex-gemini")
+message_cache = LRUCache(max_items=1024, max_bytes=256 * 1024 * 1024)
+
+def get_message_prefix_hashes(messages):
+    """返回每个消息前缀的滚动哈希，第 i 项对应 messages[:i + 1]"""
+    digest = hashlib.sha256()
+    hashes = []
+    for msg in messages:
+        data = msg.model_dump_json(exclude_none=True).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+        hashes.append(digest.hexdigest())
+    return hashes
+
+def get_message_cache_scope(request, engine, provider, model):
+    """影响消息转换结果的设置都要放进缓存范围，同样的消息前缀带不带 tools 分开缓存"""
+    return (engine, provider['provider'], model, provider.get("image", True), provider.get("tools"), bool(request.tools))
+
+async def convert_messages(request, provider, scope, state, convert_message):
+    """
+    增量转换 request.messages。
+    已转换过的最长前缀直接从缓存复用，只对新增消息调用 convert_message(msg, messages, state)。
+    缓存中的消息会被后续请求共享，调用方不能原地修改返回列表里的元素。
+    """
+    hashes = get_message_prefix_hashes(request.messages)
+    messages = []
+    start = 0
+    for index in range(len(hashes), 0, -1):
+        cached = message_cache.get((scope, hashes[index - 1]))
+        if cached is not None:
+            cached_messages, cached_state = cached
+            messages = list(cached_messages)
+            state.update(cached_state)
+            start = index
+            break
+
+    new_messages = request.messages[start:]
+    converted_start = len(messages)
+    await prefetch_images(new_messages, provider)
+    for msg in new_messages:
+        await convert_message(msg, messages, state)
+
+    if hashes and start < len(hashes):
+        # 按本次新转换出的消息大小计费（图片已转成 base64），前缀部分与之前的缓存项共享
+        # 相邻消息合并时会改写前缀的最后一条，从它开始计算
+        converted = messages[max(converted_start - 1, 0):]
+        size = len(json.dumps(converted, ensure_ascii=False, default=str)) + 64 * len(messages)
+        message_cache.set((scope, hashes[-1]), (tuple(messages), dict(state)), size)
+    return messages
+
+def merge_same_role_messages(messages):
+    """合并相邻的同角色消息（Claude 要求 user/assistant 交替），不修改传入的消息对象"""
+    conversation_len = len(messages) - 1
+    message_index = 0
+    while message_index < conversation_len:
+        if messages[message_index]["role"] == messages[message_index + 1]["role"]:
+            if messages[message_index].get("content"):
+                current = dict(messages[message_index])
+                next_content = messages[message_index + 1]["content"]
+                if isinstance(current["content"], list):
+                    if isinstance(next_content, str):
+                        next_content = [{"type": "text", "text": next_content}]
+                    current["content"] = current["content"] + next_content
+                elif isinstance(current["content"], str) and isinstance(next_content, list):
+                    current["content"] = [{"type": "text", "text": current["content"]}] + next_content
+                else:
+                    current["content"] = current["content"] + next_content
+                messages[message_index] = current
+            messages.pop(message_index + 1)
+            conversation_len = conversation_len - 1
+        else:
+            message_index = message_index + 1
+    return messages
+
 async def get_gemini_payload(request, engine, provider):
     headers = {
         'Content-Type': 'application/json'
@@ -136,10 +267,7 @@ async def get_gemini_payload(request, engine, provider):
     # https://generativelanguage.googleapis.com/v1beta/models/
     url = f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}/models/{model}:{gemini_stream}?key={await provider_api_circular_list[provider['provider']].next(model)}"
 
-    messages = []
-    systemInstruction = None
-    function_arguments = None
-    for msg in request.messages:
+    async def convert_message(msg, messages, state):
         if msg.role == "assistant":
             msg.role = "model"
         tool_calls = None
@@ -158,7 +286,7 @@ async def get_gemini_payload(request, engine, provider):
 
         if tool_calls:
             tool_call = tool_calls[0]
-            function_arguments = {
+            state["function_arguments"] = {
                 "functionCall": {
                     "name": tool_call.function.name,
                     "args": json.loads(tool_call.function.arguments)
@@ -167,11 +295,11 @@ async def get_gemini_payload(request, engine, provider):
             messages.append(
                 {
                     "role": "model",
-                    "parts": [function_arguments]
+                    "parts": [state["function_arguments"]]
                 }
             )
         elif msg.role == "tool":
-            function_call_name = function_arguments["functionCall"]["name"]
+            function_call_name = state["function_arguments"]["functionCall"]["name"]
             messages.append(
                 {
                     "role": "function",
@@ -192,7 +320,12 @@ async def get_gemini_payload(request, engine, provider):
             messages.append({"role": msg.role, "parts": content})
         elif msg.role == "system":
             content[0]["text"] = re.sub(r"_+", "_", content[0]["text"])
-            systemInstruction = {"parts": content}
+            state["systemInstruction"] = {"parts": content}
+
+    state = {"systemInstruction": None, "function_arguments": None}
+    scope = get_message_cache_scope(request, engine, provider, model)
+    messages = await convert_messages(request, provider, scope, state, convert_message)
+    systemInstruction = state["systemInstruction"]
 
     if "gemini-2.0-flash-exp" in model or "gemini-1.5" in model:
         safety_settings = "OFF"
@@ -228,7 +361,9 @@ async def get_gemini_payload(request, engine, provider):
             first_message = safe_get(payload, "contents", 0, "parts", 0, "text", default=None)
             system_instruction = safe_get(systemInstruction, "parts", 0, "text", default=None)
             if first_message and system_instruction:
-                payload["contents"][0]["parts"][0]["text"] = system_instruction + "\n" + first_message
+                # contents 中的消息来自转换缓存，复制后再修改
+                first_content = payload["contents"][0]
+                payload["contents"][0] = {**first_content, "parts": [{**first_content["parts"][0], "text": system_instruction + "\n" + first_message}] + first_content["parts"][1:]}
 
     miss_fields = [
         'model',
@@ -361,7 +496,7 @@ async def get_vertex_gemini_payload(request, engine, provider):
         'Content-Type': 'application/json'
     }
     if provider.get("client_email") and provider.get("private_key"):
-        access_token = get_access_token(provider['client_email'], provider['private_key'])
+        access_token = await asyncio.to_thread(get_access_token, provider['client_email'], provider['private_key'])
         headers['Authorization'] = f"Bearer {access_token}"
     if provider.get("project_id"):
         project_id = provider.get("project_id")
@@ -380,10 +515,7 @@ async def get_vertex_gemini_payload(request, engine, provider):
 
     url = "https://{LOCATION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}/locations/{LOCATION}/publishers/google/models/{MODEL_ID}:{stream}".format(LOCATION=await location.next(), PROJECT_ID=project_id, MODEL_ID=model, stream=gemini_stream)
 
-    messages = []
-    systemInstruction = None
-    function_arguments = None
-    for msg in request.messages:
+    async def convert_message(msg, messages, state):
         if msg.role == "assistant":
             msg.role = "model"
         tool_calls = None
@@ -402,7 +534,7 @@ async def get_vertex_gemini_payload(request, engine, provider):
 
         if tool_calls:
             tool_call = tool_calls[0]
-            function_arguments = {
+            state["function_arguments"] = {
                 "functionCall": {
                     "name": tool_call.function.name,
                     "args": json.loads(tool_call.function.arguments)
@@ -411,11 +543,11 @@ async def get_vertex_gemini_payload(request, engine, provider):
             messages.append(
                 {
                     "role": "model",
-                    "parts": [function_arguments]
+                    "parts": [state["function_arguments"]]
                 }
             )
         elif msg.role == "tool":
-            function_call_name = function_arguments["functionCall"]["name"]
+            function_call_name = state["function_arguments"]["functionCall"]["name"]
             messages.append(
                 {
                     "role": "function",
@@ -435,7 +567,12 @@ async def get_vertex_gemini_payload(request, engine, provider):
         elif msg.role != "system":
             messages.append({"role": msg.role, "parts": content})
         elif msg.role == "system":
-            systemInstruction = {"parts": content}
+            state["systemInstruction"] = {"parts": content}
+
+    state = {"systemInstruction": None, "function_arguments": None}
+    scope = get_message_cache_scope(request, engine, provider, model)
+    messages = await convert_messages(request, provider, scope, state, convert_message)
+    systemInstruction = state["systemInstruction"]
 
 
     payload = {
@@ -517,7 +654,7 @@ async def get_vertex_claude_payload(request, engine, provider):
         'Content-Type': 'application/json',
     }
     if provider.get("client_email") and provider.get("private_key"):
-        access_token = get_access_token(provider['client_email'], provider['private_key'])
+        access_token = await asyncio.to_thread(get_access_token, provider['client_email'], provider['private_key'])
         headers['Authorization'] = f"Bearer {access_token}"
     if provider.get("project_id"):
         project_id = provider.get("project_id")
@@ -536,10 +673,7 @@ async def get_vertex_claude_payload(request, engine, provider):
     claude_stream = "streamRawPredict"
     url = "https://{LOCATION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}/locations/{LOCATION}/publishers/anthropic/models/{MODEL}:{stream}".format(LOCATION=await location.next(), PROJECT_ID=project_id, MODEL=model, stream=claude_stream)
 
-    messages = []
-    system_prompt = None
-    tool_id = None
-    for msg in request.messages:
+    async def convert_message(msg, messages, state):
         tool_call_id = None
         tool_calls = None
         if isinstance(msg.content, list):
@@ -554,7 +688,7 @@ async def get_vertex_claude_payload(request, engine, provider):
         else:
             content = msg.content
             tool_calls = msg.tool_calls
-            tool_id = tool_calls[0].id if tool_calls else None or tool_id
+            state["tool_id"] = tool_calls[0].id if tool_calls else None or state["tool_id"]
             tool_call_id = msg.tool_call_id
 
         if tool_calls:
@@ -570,7 +704,7 @@ async def get_vertex_claude_payload(request, engine, provider):
         elif tool_call_id:
             messages.append({"role": "user", "content": [{
                 "type": "tool_result",
-                "tool_use_id": tool_id,
+                "tool_use_id": state["tool_id"],
                 "content": content
             }]})
         elif msg.role == "function":
@@ -588,25 +722,13 @@ async def get_vertex_claude_payload(request, engine, provider):
         elif msg.role != "system":
             messages.append({"role": msg.role, "content": content})
         elif msg.role == "system":
-            system_prompt = content
+            state["system_prompt"] = content
 
-    conversation_len = len(messages) - 1
-    message_index = 0
-    while message_index < conversation_len:
-        if messages[message_index]["role"] == messages[message_index + 1]["role"]:
-            if messages[message_index].get("content"):
-                if isinstance(messages[message_index]["content"], list):
-                    messages[message_index]["content"].extend(messages[message_index + 1]["content"])
-                elif isinstance(messages[message_index]["content"], str) and isinstance(messages[message_index + 1]["content"], list):
-                    content_list = [{"type": "text", "text": messages[message_index]["content"]}]
-                    content_list.extend(messages[message_index + 1]["content"])
-                    messages[message_index]["content"] = content_list
-                else:
-                    messages[message_index]["content"] += messages[message_index + 1]["content"]
-            messages.pop(message_index + 1)
-            conversation_len = conversation_len - 1
-        else:
-            message_index = message_index + 1
+    state = {"system_prompt": None, "tool_id": None}
+    scope = get_message_cache_scope(request, engine, provider, model)
+    messages = await convert_messages(request, provider, scope, state, convert_message)
+    messages = merge_same_role_messages(messages)
+    system_prompt = state["system_prompt"]
 
     model_dict = get_model_dict(provider)
     model = model_dict[request.model]
@@ -661,6 +783,10 @@ async def get_vertex_claude_payload(request, engine, provider):
         payload.pop("tools", None)
         payload.pop("tool_choice", None)
 
+    prompt_cache = get_prompt_cache_config(provider, model)
+    if prompt_cache:
+        add_claude_cache_control(payload, **prompt_cache)
+
     return url, headers, payload
 
 async def get_gpt_payload(request, engine, provider):
@@ -677,8 +803,7 @@ async def get_gpt_payload(request, engine, provider):
 
     url = provider['base_url']
 
-    messages = []
-    for msg in request.messages:
+    async def convert_message(msg, messages, state):
         tool_calls = None
         tool_call_id = None
         if isinstance(msg.content, list):
@@ -714,9 +839,12 @@ async def get_gpt_payload(request, engine, provider):
         else:
             messages.append({"role": msg.role, "content": content})
 
+    scope = get_message_cache_scope(request, engine, provider, model)
+    messages = await convert_messages(request, provider, scope, {}, convert_message)
+
     if ("o1-mini" in model or "o1-preview" in model) and len(messages) > 1 and messages[0]["role"] == "system":
         system_msg = messages.pop(0)
-        messages[0]["content"] = system_msg["content"] + messages[0]["content"]
+        messages[0] = {**messages[0], "content": system_msg["content"] + messages[0]["content"]}
 
     payload = {
         "model": model,
@@ -1066,10 +1194,7 @@ async def get_claude_payload(request, engine, provider):
     }
     url = provider['base_url']
 
-    messages = []
-    system_prompt = None
-    tool_id = None
-    for msg in request.messages:
+    async def convert_message(msg, messages, state):
         tool_call_id = None
         tool_calls = None
         if isinstance(msg.content, list):
@@ -1084,7 +1209,7 @@ async def get_claude_payload(request, engine, provider):
         else:
             content = msg.content
             tool_calls = msg.tool_calls
-            tool_id = tool_calls[0].id if tool_calls else None or tool_id
+            state["tool_id"] = tool_calls[0].id if tool_calls else None or state["tool_id"]
             tool_call_id = msg.tool_call_id
 
         if tool_calls:
@@ -1100,7 +1225,7 @@ async def get_claude_payload(request, engine, provider):
         elif tool_call_id:
             messages.append({"role": "user", "content": [{
                 "type": "tool_result",
-                "tool_use_id": tool_id,
+                "tool_use_id": state["tool_id"],
                 "content": content
             }]})
         elif msg.role == "function":
@@ -1118,25 +1243,13 @@ async def get_claude_payload(request, engine, provider):
         elif msg.role != "system":
             messages.append({"role": msg.role, "content": content})
         elif msg.role == "system":
-            system_prompt = content
+            state["system_prompt"] = content
 
-    conversation_len = len(messages) - 1
-    message_index = 0
-    while message_index < conversation_len:
-        if messages[message_index]["role"] == messages[message_index + 1]["role"]:
-            if messages[message_index].get("content"):
-                if isinstance(messages[message_index]["content"], list):
-                    messages[message_index]["content"].extend(messages[message_index + 1]["content"])
-                elif isinstance(messages[message_index]["content"], str) and isinstance(messages[message_index + 1]["content"], list):
-                    content_list = [{"type": "text", "text": messages[message_index]["content"]}]
-                    content_list.extend(messages[message_index + 1]["content"])
-                    messages[message_index]["content"] = content_list
-                else:
-                    messages[message_index]["content"] += messages[message_index + 1]["content"]
-            messages.pop(message_index + 1)
-            conversation_len = conversation_len - 1
-        else:
-            message_index = message_index + 1
+    state = {"system_prompt": None, "tool_id": None}
+    scope = get_message_cache_scope(request, engine, provider, model)
+    messages = await convert_messages(request, provider, scope, state, convert_message)
+    messages = merge_same_role_messages(messages)
+    system_prompt = state["system_prompt"]
 
     model_dict = get_model_dict(provider)
     model = model_dict[request.model]
@@ -1192,10 +1305,84 @@ async def get_claude_payload(request, engine, provider):
         payload.pop("tools", None)
         payload.pop("tool_choice", None)
 
+    prompt_cache = get_prompt_cache_config(provider, model)
+    if prompt_cache:
+        add_claude_cache_control(payload, **prompt_cache)
+        headers["anthropic-beta"] += ",prompt-caching-2024-07-31"
+
     # print("payload", json.dumps(payload, indent=2, ensure_ascii=False))
 
     return url, headers, payload
 
+def get_prompt_cache_config(provider, model):
+    """读取渠道的 prompt_cache 偏好，true 表示使用默认阈值"""
+    prompt_cache = safe_get(provider, "preferences", "prompt_cache", default=None)
+    if not prompt_cache:
+        return None
+    if not isinstance(prompt_cache, dict):
+        prompt_cache = {}
+    return {
+        # Anthropic 要求缓存前缀至少 1024 token，haiku 为 2048
+        "min_tokens": prompt_cache.get("min_tokens", 2048 if "haiku" in model else 1024),
+        "message_breakpoints": prompt_cache.get("messages", 2),
+    }
+
+def estimate_claude_tokens(value):
+    if isinstance(value, str):
+        return len(value) // 4
+    if isinstance(value, list):
+        return sum(estimate_claude_tokens(item) for item in value)
+    if isinstance(value, dict):
+        if value.get("type") == "image":
+            return 1600
+        return sum(estimate_claude_tokens(item) for item in value.values())
+    return 0
+
+def with_cache_control(content):
+    """返回最后一个内容块带 cache_control 的副本"""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+    return content[:-1] + [{**content[-1], "cache_control": {"type": "ephemeral"}}]
+
+def add_claude_cache_control(payload, min_tokens=1024, message_breakpoints=2):
+    """
+    按 Anthropic 的缓存前缀顺序 tools -> system -> messages 自动插入 cache_control 断点，最多 4 个。
+    前缀长度不足 min_tokens 的位置不标记；消息只标记最后几个 user 回合，
+    最新一轮写入缓存，上一轮读取上次请求写入的缓存。
+    """
+    breakpoints = 0
+    prefix_tokens = 0
+
+    tools = payload.get("tools")
+    if tools:
+        prefix_tokens += estimate_claude_tokens(tools)
+        if prefix_tokens >= min_tokens:
+            payload["tools"] = with_cache_control(tools)
+            breakpoints += 1
+
+    system = payload.get("system")
+    if system:
+        prefix_tokens += estimate_claude_tokens(system)
+        if prefix_tokens >= min_tokens:
+            payload["system"] = with_cache_control(system)
+            breakpoints += 1
+
+    messages = payload.get("messages") or []
+    message_tokens = []
+    for message in messages:
+        prefix_tokens += estimate_claude_tokens(message["content"])
+        message_tokens.append(prefix_tokens)
+    user_indexes = [index for index, message in enumerate(messages) if message["role"] == "user" and message["content"]]
+    budget = min(message_breakpoints, 4 - breakpoints)
+    if budget <= 0:
+        return payload
+    for index in reversed(user_indexes[-budget:]):
+        if message_tokens[index] < min_tokens:
+            break
+        # 消息可能来自转换缓存，复制后再修改
+        messages[index] = {**messages[index], "content": with_cache_control(messages[index]["content"])}
+    return payload
+
 async def get_dalle_payload(request, engine, provider):
     model_dict = get_model_dict(provider)
     model = model_dict[request.model]
@@ -1277,11 +1464,10 @@ async def get_embedding_payload(request, engine, provider):
         "model": model,
     }
 
-    if request.encoding_format:
-        if url.startswith("https://api.jina.ai"):
-            payload["embedding_type"] = request.encoding_format
-        else:
-            payload["encoding_format"] = request.encoding_format
+    # encoding_format 不转发给上游，由 format_embedding_response 在本地转换
+    # 上游不支持 dimensions 时同样在本地截断
+    if request.dimensions and safe_get(provider, "preferences", "embedding_dimensions", default="text-embedding-3" in model):
+        payload["dimensions"] = request.dimensions
 
     return url, headers, payload
 
@@ -1313,6 +1499,8 @@ async def get_tts_payload(request, engine, provider):
 
 
 async def get_payload(request: RequestModel, engine, provider):
+    if engine not in MESSAGE_CACHE_ENGINES:
+        await prefetch_images(getattr(request, "messages", None), provider)
     if engine == "gemini":
         return await get_gemini_payload(request, engine, provider)
     elif engine == "vertex-gemini":
@@ -7,6 +7,7 @@ from datetime import datetime
 from log_config import logger
 
 from utils import safe_get, generate_sse_response, generate_no_stream_response, end_of_line
+from audio import MultipartFileBody
 
 async def check_response(response, error_log):
     if response and not (200 <= response.status_code < 300):
@@ -261,6 +262,8 @@ async def fetch_claude_response_stream(client, url, headers, payload, model):
             return
         buffer = ""
         input_tokens = 0
+        cache_read_tokens = 0
+        cache_creation_tokens = 0
         async for chunk in response.aiter_text():
             buffer += chunk
             while "\n" in buffer:
@@ -268,15 +271,13 @@ async def fetch_claude_response_stream(client, url, headers, payload, model):
                 if line.startswith("data:"):
                     line = line.lstrip("data: ")
                     try:
-                        resp = json.loads(line)
-                        if "stop_reason" in resp:
-                            sse_string = await generate_sse_response(timestamp, model, finish_reason=resp["stop_reason"])
-                            yield sse_string
+                        resp: dict = json.loads(line)
                     except json.JSONDecodeError:
                         logger.error(f"Failed to parse Claude response JSON: {line}")
-                if line.startswith("data:"):
-                    line = line.lstrip("data: ")
-                    resp: dict = json.loads(line)
+                        continue
+                    if "stop_reason" in resp:
+                        sse_string = await generate_sse_response(timestamp, model, finish_reason=resp["stop_reason"])
+                        yield sse_string
                     message = resp.get("message")
                     if message:
                         role = message.get("role")
@@ -285,12 +286,18 @@ async def fetch_claude_response_stream(client, url, headers, payload, model):
                             yield sse_string
                         tokens_use = message.get("usage")
                         if tokens_use:
-                            input_tokens = tokens_use.get("input_tokens", 0)
+                            # input_tokens 不含缓存部分，按 OpenAI 的口径把缓存读写计入 prompt_tokens
+                            cache_read_tokens = tokens_use.get("cache_read_input_tokens") or 0
+                            cache_creation_tokens = tokens_use.get("cache_creation_input_tokens") or 0
+                            input_tokens = tokens_use.get("input_tokens", 0) + cache_read_tokens + cache_creation_tokens
                     usage = resp.get("usage")
                     if usage:
                         output_tokens = usage.get("output_tokens", 0)
                         total_tokens = input_tokens + output_tokens
-                        sse_string = await generate_sse_response(timestamp, model, None, None, None, None, None, total_tokens, input_tokens, output_tokens)
+                        prompt_tokens_details = None
+                        if cache_read_tokens or cache_creation_tokens:
+                            prompt_tokens_details = {"cached_tokens": cache_read_tokens, "cache_creation_tokens": cache_creation_tokens}
+                        sse_string = await generate_sse_response(timestamp, model, None, None, None, None, None, total_tokens, input_tokens, output_tokens, prompt_tokens_details=prompt_tokens_details)
                         yield sse_string
                         # print("\n\rtotal_tokens", total_tokens)
 
@@ -319,11 +326,28 @@ async def fetch_claude_response_stream(client, url, headers, payload, model):
                         yield sse_string
         yield "data: [DONE]" + end_of_line
 
+async def fetch_audio_stream(client, url, headers, payload):
+    """边收边转发上游返回的音频字节，内存占用与音频长度无关"""
+    async with client.stream('POST', url, headers=headers, json=payload) as response:
+        error_message = await check_response(response, "fetch_audio_stream")
+        if error_message:
+            yield error_message
+            return
+        async for chunk in response.aiter_bytes():
+            if chunk:
+                yield chunk
+
 async def fetch_response(client, url, headers, payload, engine, model):
+    if engine == "tts":
+        async for chunk in fetch_audio_stream(client, url, headers, payload):
+            yield chunk
+        return
+
     response = None
     if payload.get("file"):
-        file = payload.pop("file")
-        response = await client.post(url, headers=headers, data=payload, files={"file": file})
+        # 文件按块流式上传，不在内存中拼接完整的 multipart 请求体
+        body = MultipartFileBody(payload, payload.pop("file"))
+        response = await client.post(url, headers={**headers, **body.headers}, content=body)
     else:
         response = await client.post(url, headers=headers, json=payload)
     error_message = await check_response(response, "fetch_response")
@@ -331,10 +355,7 @@ async def fetch_response(client, url, headers, payload, engine, model):
         yield error_message
         return
 
-    if engine == "tts":
-        yield response.read()
-
-    elif engine == "gemini" or engine == "vertex-gemini":
+    if engine == "gemini" or engine == "vertex-gemini":
         response_json = response.json()
 
         if isinstance(response_json, str):
@@ -0,0 +1,306 @@
+"""
+统计数据的追加写入和列式导出。
+
+SegmentStatsSink 把每条请求记录和渠道记录缓存在内存中，按批次在线程池中追加到滚动的 JSONL 分段文件：
+    {目录}/{kind}-{YYYYMMDD}-{HHMMSS}-{pid}-{序号}.jsonl.open   正在写入的分段
+    {目录}/{kind}-{YYYYMMDD}-{HHMMSS}-{pid}-{序号}.jsonl        已封存的分段（超过大小、跨天、超过一小时或进程退出时封存）
+compact_segments 把已封存的分段按天合并成 Parquet 分区，iter_parquet 按时间范围以 Parquet 流的形式导出。
+合并会删除分段文件，与导出通过 segment_lock 互斥：导出可以并发进行，合并等待所有导出结束。
+Parquet 相关功能需要安装 pyarrow。
+
+python stats_sink.py compact --dir ./data/segments
+python stats_sink.py export --dir ./data/segments --kind request --start 2024-10-01 --end 2024-10-08 -o week.parquet
+"""
+import io
+import os
+import json
+import glob
+import time
+import uuid
+import asyncio
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from log_config import logger
+
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+SEGMENT_MAX_AGE = 3600
+# 超过该时间没有写入的 .open 分段视为进程异常退出遗留，可以直接合并
+STALE_SEGMENT_AGE = 2 * SEGMENT_MAX_AGE
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow
+    except ImportError:
+        logger.error("pyarrow package is required for Parquet compaction and export")
+        raise ImportError("Please install pyarrow package for Parquet compaction and export: pip install pyarrow")
+
+def schema_from_table(table):
+    """由 SQLAlchemy 表结构生成记录字段类型，保证每个 Parquet 分区的 schema 一致"""
+    from sqlalchemy.sql import sqltypes
+    type_map = {
+        sqltypes.Integer: "int64",
+        sqltypes.Float: "float64",
+        sqltypes.Boolean: "bool",
+        sqltypes.DateTime: "timestamp",
+    }
+    return {name: type_map.get(type(column.type), "string") for name, column in table.columns.items() if name != "id"}
+
+class SegmentLock:
+    """分段目录的读写锁。导出的生成器每次迭代可能在不同的线程中执行，所以不能用 RLock"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writing:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+segment_lock = SegmentLock()
+
+class SegmentStatsSink:
+    """kind 为 request 或 channel，record 为字段字典"""
+    def __init__(self, directory, batch_size=256, flush_interval=1.0, max_segment_bytes=SEGMENT_MAX_BYTES, max_segment_age=SEGMENT_MAX_AGE):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.buffers = {}
+        self.segments = {}  # {kind: [路径, 日期, 已写字节数, 创建时间]}
+        self.sequence = 0  # 同一秒内滚动的分段用序号区分
+        self.lock = asyncio.Lock()
+        self.flush_task = None
+        os.makedirs(directory, exist_ok=True)
+
+    async def write(self, kind, record):
+        buffer = self.buffers.setdefault(kind, [])
+        buffer.append(record)
+        if len(buffer) >= self.batch_size:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.delayed_flush())
+
+    async def delayed_flush(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+        finally:
+            self.flush_task = None
+
+    async def flush(self):
+        async with self.lock:
+            batches = {kind: records for kind, records in self.buffers.items() if records}
+            if not batches:
+                return
+            self.buffers = {}
+            await asyncio.to_thread(self.write_batches, batches)
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+        await self.flush()
+        async with self.lock:
+            for kind in list(self.segments):
+                self.seal(kind)
+
+    def write_batches(self, batches):
+        for kind, records in batches.items():
+            data = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records).encode("utf-8")
+            path = self.current_segment(kind, len(data))
+            with open(path, "ab") as file:
+                file.write(data)
+            self.segments[kind][2] += len(data)
+
+    def current_segment(self, kind, incoming):
+        now = datetime.now(timezone.utc)
+        day = now.strftime("%Y%m%d")
+        segment = self.segments.get(kind)
+        if segment and (segment[1] != day or segment[2] + incoming > self.max_segment_bytes or time.time() - segment[3] > self.max_segment_age):
+            self.seal(kind)
+            segment = None
+        if segment is None:
+            self.sequence += 1
+            path = os.path.join(self.directory, f"{kind}-{now.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.sequence}.jsonl.open")
+            segment = self.segments[kind] = [path, day, 0, time.time()]
+        return segment[0]
+
+    def seal(self, kind):
+        path = self.segments.pop(kind)[0]
+        if os.path.exists(path):
+            os.replace(path, path[:-len(".open")])
+
+def read_segment(path):
+    with open(path, "rb") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程异常退出时最后一行可能不完整
+                    continue
+
+def parse_timestamp(value):
+    if not value:
+        return None
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+def build_table(records, fields):
+    pa = require_pyarrow()
+    types = {"int64": pa.int64(), "float64": pa.float64(), "bool": pa.bool_(), "timestamp": pa.timestamp("us", tz="UTC"), "string": pa.string()}
+    schema = pa.schema([(name, types[type_name]) for name, type_name in fields.items()])
+    columns = {name: [] for name in fields}
+    for record in records:
+        for name, type_name in fields.items():
+            value = record.get(name)
+            if type_name == "timestamp" and isinstance(value, str):
+                value = parse_timestamp(value)
+            elif type_name == "string" and value is not None and not isinstance(value, str):
+                value = json.dumps(value, ensure_ascii=False, default=str)
+            columns[name].append(value)
+    return pa.table(columns, schema=schema)
+
+def sealed_segments(directory, kind):
+    paths = sorted(glob.glob(os.path.join(directory, f"{kind}-*.jsonl")))
+    now = time.time()
+    stale = [path for path in glob.glob(os.path.join(directory, f"{kind}-*.jsonl.open")) if now - os.path.getmtime(path) > STALE_SEGMENT_AGE]
+    return paths + sorted(stale)
+
+def compact_segments(directory, fields_by_kind):
+    """把已封存的分段按天写入 {目录}/parquet/{kind}/date=YYYY-MM-DD/part-*.parquet，成功后删除分段，返回合并的记录数"""
+    require_pyarrow()
+    with segment_lock.write():
+        return _compact_segments(directory, fields_by_kind)
+
+def _compact_segments(directory, fields_by_kind):
+    import pyarrow.parquet as pq
+    compacted = {}
+    for kind, fields in fields_by_kind.items():
+        paths = sealed_segments(directory, kind)
+        if not paths:
+            continue
+        days = {}
+        for path in paths:
+            for record in read_segment(path):
+                timestamp = parse_timestamp(record.get("timestamp")) or datetime.now(timezone.utc)
+                days.setdefault(timestamp.strftime("%Y-%m-%d"), []).append(record)
+        for day, records in days.items():
+            partition = os.path.join(directory, "parquet", kind, f"date={day}")
+            os.makedirs(partition, exist_ok=True)
+            pq.write_table(build_table(records, fields), os.path.join(partition, f"part-{uuid.uuid4().hex}.parquet"), compression="zstd")
+        for path in paths:
+            os.remove(path)
+        compacted[kind] = sum(len(records) for records in days.values())
+    return compacted
+
+class ChunkBuffer(io.RawIOBase):
+    """ParquetWriter 的输出目标，写入的数据在每个分区写完后取出发送"""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_parquet(directory, kind, fields, start, end):
+    """按时间范围 [start, end) 导出 Parquet 流：先读按天的 Parquet 分区，再读尚未合并的分段，每个来源写成一个 row group"""
+    require_pyarrow()
+    # 导出期间持有读锁，合并不会删除已经列出的分段，也不会把同一批记录同时放进分区和分段
+    with segment_lock.read():
+        yield from _iter_parquet(directory, kind, fields, start, end)
+
+def _iter_parquet(directory, kind, fields, start, end):
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    buffer = ChunkBuffer()
+    schema = build_table([], fields).schema
+    writer = pq.ParquetWriter(buffer, schema, compression="zstd")
+
+    day = start.astimezone(timezone.utc).date()
+    while day <= end.astimezone(timezone.utc).date():
+        for path in sorted(glob.glob(os.path.join(directory, "parquet", kind, f"date={day.isoformat()}", "*.parquet"))):
+            table = pq.read_table(path, schema=schema)
+            if "timestamp" in fields:
+                table = table.filter(pc.and_(pc.greater_equal(table["timestamp"], start), pc.less(table["timestamp"], end)))
+            if table.num_rows:
+                writer.write_table(table)
+                yield buffer.drain()
+        day += timedelta(days=1)
+
+    for path in sorted(glob.glob(os.path.join(directory, f"{kind}-*.jsonl")) + glob.glob(os.path.join(directory, f"{kind}-*.jsonl.open"))):
+        records = [record for record in read_segment(path) if start <= (parse_timestamp(record.get("timestamp")) or start) < end]
+        if records:
+            writer.write_table(build_table(records, fields))
+            yield buffer.drain()
+    writer.close()
+    yield buffer.drain()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Compact or export uni-api stats segments")
+    parser.add_argument("command", choices=["compact", "export"])
+    parser.add_argument("--dir", default=os.getenv("STATS_SEGMENT_DIR", "./data/segments"))
+    parser.add_argument("--kind", default="request", choices=["request", "channel"])
+    parser.add_argument("--start", help="ISO 格式的开始时间（包含），默认 7 天前")
+    parser.add_argument("--end", help="ISO 格式的结束时间（不包含），默认当前时间")
+    parser.add_argument("-o", "--output", default="-", help="导出的 Parquet 文件，默认写到标准输出")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DISABLE_DATABASE", "true")
+    from main import STATS_FIELDS
+
+    if args.command == "compact":
+        print(json.dumps(compact_segments(args.dir, STATS_FIELDS)))
+        return
+    end = parse_timestamp(args.end) or datetime.now(timezone.utc)
+    start = parse_timestamp(args.start) or end - timedelta(days=7)
+    output = open(args.output, "wb") if args.output != "-" else os.fdopen(os.dup(1), "wb")
+    with output:
+        for chunk in iter_parquet(args.dir, args.kind, STATS_FIELDS[args.kind], start, end):
+            output.write(chunk)
+
+if __name__ == "__main__":
+    main()
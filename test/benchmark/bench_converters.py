@@ -0,0 +1,235 @@
+"""
+request.py / response.py 中每个请求都要执行的 CPU 热点的微基准：
+    payload.*   200 轮带工具调用和图片的对话加 50 个工具定义，各渠道解析请求和 get_payload 的耗时（每次清空消息转换缓存）
+    images.*    一条消息带 8 张图片时构建请求体的耗时（图片已在规范化缓存中）
+    tools.*     gpt2claude_tools_json 转换 50 个工具定义
+    stream.*    各渠道录制的 20k token 流式响应经过 fetch_*_response_stream 转换的耗时
+    sse.*       generate_sse_response 单次调用
+
+先保存基线，修改代码后对比，任意用例的中位耗时变慢超过阈值时以非零状态退出：
+
+python test/benchmark/bench_converters.py --save baseline.json
+python test/benchmark/bench_converters.py --compare baseline.json --threshold 0.15
+python test/benchmark/bench_converters.py -k stream.claude
+"""
+import os
+import io
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import statistics
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(os.path.dirname(BENCHMARK_DIR)))
+sys.path.append(BENCHMARK_DIR)
+
+import httpx
+from PIL import Image
+
+import request as request_module
+from models import RequestModel
+from request import get_payload, gpt2claude_tools_json
+from response import fetch_response_stream
+from utils import ThreadSafeCircularList, provider_api_circular_list, generate_sse_response
+from mock_upstream import Behavior, openai_response, claude_response, gemini_response, cohere_response, cloudflare_response
+
+PROVIDERS = {
+    "gpt": {"provider": "bench-gpt", "base_url": "https://api.openai.com/v1/chat/completions", "model": ["gpt-4o"], "tools": True},
+    "azure": {"provider": "bench-azure", "base_url": "https://bench.openai.azure.com", "api": "key", "model": ["gpt-4o"], "tools": True},
+    "claude": {"provider": "bench-claude", "base_url": "https://api.anthropic.com/v1/messages", "model": ["claude-3-5-sonnet"], "tools": True},
+    "gemini": {"provider": "bench-gemini", "base_url": "https://generativelanguage.googleapis.com/v1beta", "model": ["gemini-1.5-pro"], "tools": True},
+    "openrouter": {"provider": "bench-openrouter", "base_url": "https://openrouter.ai/api/v1/chat/completions", "model": ["llama-3.1-70b"], "tools": True},
+}
+
+# 流式用例：渠道 -> (模拟上游的响应函数, fetch_response_stream 的 engine)
+STREAMS = {
+    "gpt": (openai_response, "gpt"),
+    "azure": (openai_response, "azure"),
+    "claude": (claude_response, "claude"),
+    "gemini": (gemini_response, "gemini"),
+    "cohere": (cohere_response, "cohere"),
+    "cloudflare": (cloudflare_response, "cloudflare"),
+}
+
+def make_images(count, size=256):
+    images = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        Image.new("RGB", (size, size), (i * 37 % 256, 64, 128)).save(buffer, format="PNG")
+        images.append("data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode())
+    return images
+
+def make_tools(count):
+    return [{
+        "type": "function",
+        "function": {
+            "name": f"tool_{i}",
+            "description": f"Tool number {i}. " + "Looks up records and returns structured results. " * 3,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "Search query"},
+                    "limit": {"type": "integer", "description": "Maximum number of results", "default": 10},
+                    "filters": {"type": "array", "items": {"type": "string"}, "description": "Optional filters"},
+                    "options": {"type": "object", "properties": {"exact": {"type": "boolean"}, "lang": {"type": "string", "enum": ["en", "zh", "ja"]}}},
+                },
+                "required": ["query"],
+            },
+        },
+    } for i in range(count)]
+
+def make_conversation(turns, images, image_every=10):
+    messages = [{"role": "system", "content": "You are a helpful agent. " * 20}]
+    for i in range(turns):
+        content = [{"type": "text", "text": f"step {i}: " + "please continue the analysis with more context " * 8}]
+        if i % image_every == 0:
+            content.append({"type": "image_url", "image_url": {"url": images[i // image_every % len(images)]}})
+        messages.extend([
+            {"role": "user", "content": content},
+            {"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call_{i}", "type": "function",
+                "function": {"name": f"tool_{i % 50}", "arguments": json.dumps({"query": f"q{i}", "filters": [f"f{j}" for j in range(10)]})},
+            }]},
+            {"role": "tool", "tool_call_id": f"call_{i}", "content": "result line\n" * 40},
+            {"role": "assistant", "content": f"answer {i}: " + "the analysis shows the following points " * 6},
+        ])
+    messages.append({"role": "user", "content": "Summarize everything."})
+    return messages
+
+async def record_stream(response_func, tokens):
+    """用模拟上游生成完整的流式响应，按上游实际发送的块切分"""
+    behavior = Behavior(ttft=0, tokens=tokens, tokens_per_second=0)
+    response = await response_func(behavior, {"model": "bench", "stream": True})
+    chunks = []
+    async for chunk in response.body_iterator:
+        chunks.append(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+    return chunks
+
+def make_stream_client(chunks):
+    async def replay():
+        for chunk in chunks:
+            yield chunk
+
+    def handler(request):
+        return httpx.Response(200, content=replay())
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+async def measure(func, min_time, min_rounds):
+    """至少运行 min_rounds 次且总时长不少于 min_time 秒，返回每次耗时列表"""
+    await func()  # 预热
+    timings = []
+    total = 0.0
+    while len(timings) < min_rounds or total < min_time:
+        start = time.perf_counter()
+        await func()
+        elapsed = time.perf_counter() - start
+        timings.append(elapsed)
+        total += elapsed
+    return timings
+
+def build_cases(args):
+    images = make_images(20)
+    tools = make_tools(50)
+    conversation = make_conversation(args.turns, images)
+    cases = {}
+
+    for engine, provider in PROVIDERS.items():
+        async def payload_case(engine=engine, provider=provider):
+            request = RequestModel(model=provider["model"][0], messages=conversation, tools=tools)
+            request_module.message_cache.clear()
+            await get_payload(request, engine, provider)
+        cases[f"payload.{engine}"] = (payload_case, None)
+
+    multi_image = [{"role": "user", "content": [{"type": "text", "text": "Compare these images."}] + [
+        {"type": "image_url", "image_url": {"url": image}} for image in images[:8]
+    ]}]
+    for engine in ("gpt", "claude", "gemini"):
+        provider = PROVIDERS[engine]
+        async def image_case(engine=engine, provider=provider):
+            request = RequestModel(model=provider["model"][0], messages=multi_image)
+            request_module.message_cache.clear()
+            await get_payload(request, engine, provider)
+        cases[f"images.{engine}"] = (image_case, None)
+
+    async def tools_case():
+        for tool in tools:
+            await gpt2claude_tools_json(tool["function"])
+    cases["tools.gpt2claude"] = (tools_case, None)
+
+    for name, (response_func, engine) in STREAMS.items():
+        chunks = asyncio.run(record_stream(response_func, args.stream_tokens))
+        async def stream_case(chunks=chunks, engine=engine):
+            async with make_stream_client(chunks) as client:
+                async for _ in fetch_response_stream(client, "http://mock/stream", {}, {}, engine, "bench"):
+                    pass
+        cases[f"stream.{name}"] = (stream_case, args.stream_tokens)
+
+    timestamp = int(time.time())
+    async def sse_case():
+        for _ in range(1000):
+            await generate_sse_response(timestamp, "bench", content="hello ")
+    cases["sse.generate_sse_response_x1000"] = (sse_case, 1000)
+    return cases
+
+def compare(report, baseline, threshold):
+    regressions = []
+    for name, result in report["cases"].items():
+        base = baseline.get("cases", {}).get(name)
+        if not base:
+            continue
+        change = result["median_ms"] / base["median_ms"] - 1
+        result["change"] = round(change, 4)
+        if change > threshold:
+            regressions.append(f"{name}: {base['median_ms']} ms -> {result['median_ms']} ms (+{change:.1%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", dest="keyword", help="只运行名称包含该字符串的用例")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--stream-tokens", type=int, default=20000)
+    parser.add_argument("--min-time", type=float, default=1.0, help="每个用例至少运行的秒数")
+    parser.add_argument("--min-rounds", type=int, default=5)
+    parser.add_argument("--save", help="把结果保存为基线 JSON")
+    parser.add_argument("--compare", help="与基线 JSON 对比")
+    parser.add_argument("--threshold", type=float, default=0.15, help="中位耗时变慢超过该比例视为退化")
+    args = parser.parse_args()
+
+    for provider in PROVIDERS.values():
+        provider_api_circular_list[provider["provider"]] = ThreadSafeCircularList(["key"])
+
+    cases = build_cases(args)
+    report = {"python": sys.version.split()[0], "cases": {}}
+    for name, (func, items) in cases.items():
+        if args.keyword and args.keyword not in name:
+            continue
+        timings = asyncio.run(measure(func, args.min_time, args.min_rounds))
+        median = statistics.median(timings)
+        result = {
+            "rounds": len(timings),
+            "median_ms": round(median * 1000, 4),
+            "min_ms": round(min(timings) * 1000, 4),
+            "stdev_ms": round(statistics.stdev(timings) * 1000, 4) if len(timings) > 1 else 0,
+        }
+        if items:
+            result["items_per_second"] = round(items / median, 1)
+        report["cases"][name] = result
+        print(f"{name:36} {result['median_ms']:10.3f} ms" + (f"  {result['items_per_second']:12.1f}/s" if items else ""), file=sys.stderr)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+    print(json.dumps(report, indent=2))
+    if regressions:
+        print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+对比逐条请求和微批合并两种方式请求本地 mock embedding 服务的吞吐和延迟。
+
+python test/benchmark/bench_embedding_batcher.py --requests 2000 --concurrency 500
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from response import fetch_response
+from embedding import EmbeddingBatcher, fetch_batched_embedding_response
+
+def create_mock_embedding_app(latency, max_concurrency, dim):
+    semaphore = None
+
+    async def embeddings(request):
+        nonlocal semaphore
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(max_concurrency)
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        async with semaphore:
+            await asyncio.sleep(latency)
+        data = [{"object": "embedding", "index": i, "embedding": [0.1] * dim} for i in range(len(inputs))]
+        tokens = sum(len(item) // 4 + 1 for item in inputs)
+        return JSONResponse({"object": "list", "data": data, "model": body["model"], "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    return Starlette(routes=[Route("/v1/embeddings", embeddings, methods=["POST"])])
+
+def start_server(app, port):
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="error")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def run(mode, url, requests, concurrency, batcher):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=100)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def one(i):
+            payload = {"input": f"document number {i} " * 8, "model": "text-embedding-3-small"}
+            async with semaphore:
+                start = time.perf_counter()
+                if mode == "batched":
+                    generator = fetch_batched_embedding_response(batcher, "bench", client, url, {}, payload, payload["model"])
+                else:
+                    generator = fetch_response(client, url, {}, payload, "embedding", payload["model"])
+                result = await anext(generator)
+                assert "error" not in result, result
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests)])
+        elapsed = time.perf_counter() - start
+
+    report = {
+        "mode": mode,
+        "requests": requests,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+    if batcher:
+        report["upstream_calls"] = batcher.batches
+        report["avg_batch_size"] = round(batcher.batched_items / max(batcher.batches, 1), 1)
+    else:
+        report["upstream_calls"] = requests
+    return report
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--upstream-concurrency", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--max-items", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    start_server(create_mock_embedding_app(args.latency_ms / 1000, args.upstream_concurrency, args.dim), args.port)
+    url = f"http://127.0.0.1:{args.port}/v1/embeddings"
+
+    reports = [
+        asyncio.run(run("single", url, args.requests, args.concurrency, None)),
+        asyncio.run(run("batched", url, args.requests, args.concurrency, EmbeddingBatcher(max_items=args.max_items, max_wait_ms=args.max_wait_ms))),
+    ]
+    print(json.dumps(reports, indent=2))
+
+if __name__ == "__main__":
+    main()
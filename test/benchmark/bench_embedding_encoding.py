@@ -0,0 +1,59 @@
+"""
+对比 embedding 响应的 JSON float 列表和本地 base64 float32 编码的序列化耗时与每条向量字节数。
+
+python test/benchmark/bench_embedding_encoding.py --batch 100 --dim 3072
+"""
+import os
+import sys
+import json
+import time
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import numpy as np
+
+from embedding import format_embedding_response
+
+def make_response(batch, dim):
+    vectors = np.random.default_rng(0).standard_normal((batch, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    # 模拟上游返回的 JSON：float32 数值以 Python float 形式出现
+    return json.dumps({
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(vectors.astype(np.float64).tolist())],
+        "model": "text-embedding-3-large",
+        "usage": {"prompt_tokens": batch, "total_tokens": batch},
+    })
+
+def bench(upstream_body, encoding_format, dimensions, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        response = format_embedding_response(json.loads(upstream_body), encoding_format, dimensions)
+        body = json.dumps(response)
+    elapsed = (time.perf_counter() - start) / rounds
+    batch = len(response["data"])
+    return {
+        "encoding_format": encoding_format,
+        "dimensions": dimensions,
+        "serialize_ms": round(elapsed * 1000, 2),
+        "bytes_per_vector": len(body) // batch,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    upstream_body = make_response(args.batch, args.dim)
+    reports = [
+        bench(upstream_body, "float", None, args.rounds),
+        bench(upstream_body, "base64", None, args.rounds),
+        bench(upstream_body, "float", args.dim // 4, args.rounds),
+        bench(upstream_body, "base64", args.dim // 4, args.rounds),
+    ]
+    print(json.dumps(reports, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+测量 uni-api 自身带来的开销：启动本地模拟上游（mock_upstream.py）和 uni-api（run_gateway.py），
+按设定的并发分别直连模拟上游和经过 uni-api 请求每种渠道，输出 JSON 报告：
+
+    baseline          直连模拟上游的首 token 时间（TTFT）
+    engines.*         各渠道经过 uni-api 的 TTFT、与直连相比增加的 p50/p99 TTFT、每个 CPU 核每秒转发的 token 数
+    failover.*        第一个渠道返回 500/429 时切换到下一个渠道额外花费的时间（单并发测量）
+    gateway           uni-api 进程的 CPU 时间和内存（RSS，读取 /proc，仅支持 Linux）
+
+模拟上游的 TTFT 对所有渠道相同，因此各渠道都和直连 OpenAI 格式接口的结果比较。
+Cloudflare 和 Vertex 的地址写死在代码里，由 run_gateway.py 改写到模拟上游。
+
+python test/benchmark/bench_gateway.py --concurrency 32 --requests 500 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+
+API_KEY = "sk-bench-gateway"
+ENGINES = ["openai", "azure", "claude", "gemini", "vertex-gemini", "vertex-claude", "cohere", "cloudflare"]
+FAILOVER_SCENARIOS = ["fail500", "fail429"]
+
+def generate_private_key():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+def make_config(mock_port):
+    mock = f"http://127.0.0.1:{mock_port}"
+    vertex = {
+        "base_url": "https://aiplatform.googleapis.com/",
+        "project_id": "bench-project",
+        "client_email": "bench@bench-project.iam.gserviceaccount.com",
+        "private_key": generate_private_key(),
+    }
+    providers = [
+        {"provider": "openai", "base_url": f"{mock}/ok/v1/chat/completions", "api": "sk-mock", "model": [{"gpt-4o": "bench-openai"}]},
+        {"provider": "azure", "base_url": f"{mock}/ok", "api": "mock", "engine": "azure", "model": [{"gpt-4o": "bench-azure"}]},
+        {"provider": "claude", "base_url": f"{mock}/ok/v1/messages", "api": "sk-ant-mock", "model": [{"claude-3-5-sonnet-20241022": "bench-claude"}]},
+        {"provider": "gemini", "base_url": f"{mock}/ok/v1beta", "api": "mock", "model": [{"gemini-1.5-pro": "bench-gemini"}]},
+        {"provider": "vertex-gemini", "engine": "vertex-gemini", **vertex, "model": [{"gemini-1.5-pro": "bench-vertex-gemini"}]},
+        {"provider": "vertex-claude", "engine": "vertex-claude", **vertex, "model": [{"claude-3-5-sonnet@20240620": "bench-vertex-claude"}]},
+        {"provider": "cohere", "base_url": f"{mock}/ok/v1/chat", "api": "mock", "engine": "cohere", "model": [{"command-r-plus": "bench-cohere"}]},
+        {"provider": "cloudflare", "base_url": "https://api.cloudflare.com/", "api": "mock", "engine": "cloudflare", "cf_account_id": "bench", "model": [{"@cf/meta/llama-3.1-8b-instruct": "bench-cloudflare"}]},
+    ]
+    for scenario in FAILOVER_SCENARIOS:
+        # 同名模型的两个渠道，按顺序先请求失败的渠道
+        providers.append({"provider": f"{scenario}-bad", "base_url": f"{mock}/{scenario}/v1/chat/completions", "api": "sk-mock", "model": [{"gpt-4o": f"bench-{scenario}"}]})
+        providers.append({"provider": f"{scenario}-good", "base_url": f"{mock}/ok/v1/chat/completions", "api": "sk-mock", "model": [{"gpt-4o": f"bench-{scenario}"}]})
+    return {
+        "providers": providers,
+        "api_keys": [{"api": API_KEY, "role": "admin", "model": ["all"], "preferences": {"SCHEDULING_ALGORITHM": "fixed_priority"}}],
+        # 关闭渠道冷却，每次请求都会先失败再切换，才能测到切换耗时
+        "preferences": {"cooldown_period": 0},
+    }
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process exited with code {process.returncode}")
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise TimeoutError(f"port {port} not ready")
+
+class ProcessStats:
+    """读取 /proc 中的 CPU 时间和内存"""
+    def __init__(self, pid):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.peak_rss = 0
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        # utime 和 stime 是第 14、15 个字段，去掉 pid 和进程名后下标为 11、12
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+
+    def rss_bytes(self):
+        with open(f"/proc/{self.pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                    self.peak_rss = max(self.peak_rss, rss)
+                    return rss
+        return 0
+
+    async def sample_rss(self, interval=0.1):
+        while True:
+            self.rss_bytes()
+            await asyncio.sleep(interval)
+
+async def run_request(client, url, headers, payload):
+    """返回 (是否成功, 首 token 时间, 总耗时, token 数)"""
+    start = time.perf_counter()
+    ttft = None
+    tokens = 0
+    if not payload.get("stream"):
+        response = await client.post(url, headers=headers, json=payload)
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            return False, None, elapsed, 0
+        data = response.json()
+        usage = data.get("usage") or {}
+        tokens = usage.get("completion_tokens") or usage.get("output_tokens") or 0
+        return True, elapsed, elapsed, tokens
+
+    async with client.stream("POST", url, headers=headers, json=payload) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return False, None, time.perf_counter() - start, 0
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            choices = chunk.get("choices") or [{}]
+            if (choices[0].get("delta") or {}).get("content"):
+                tokens += 1
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+    return ttft is not None, ttft, time.perf_counter() - start, tokens
+
+async def run_load(url, headers, payload, requests, concurrency):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        queue = asyncio.Queue()
+        for _ in range(requests):
+            queue.put_nowait(None)
+        results = []
+
+        async def worker():
+            while not queue.empty():
+                queue.get_nowait()
+                try:
+                    results.append(await run_request(client, url, headers, payload))
+                except httpx.HTTPError:
+                    results.append((False, None, 0, 0))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return results, time.perf_counter() - start
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def summarize(results, wall_time):
+    ttfts = [ttft for ok, ttft, _, _ in results if ok]
+    latencies = [latency for ok, _, latency, _ in results if ok]
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for ok, *_ in results if not ok),
+        "ttft_ms": {"p50": to_ms(percentile(ttfts, 50)), "p99": to_ms(percentile(ttfts, 99)), "mean": to_ms(statistics.fmean(ttfts) if ttfts else None)},
+        "latency_ms": {"p50": to_ms(percentile(latencies, 50)), "p99": to_ms(percentile(latencies, 99))},
+        "tokens": sum(tokens for *_, tokens in results),
+        "requests_per_second": round(len(results) / wall_time, 2) if wall_time else None,
+    }
+
+def delta(summary, baseline):
+    result = {}
+    for key in ("p50", "p99"):
+        value, base = summary["ttft_ms"][key], baseline["ttft_ms"][key]
+        result[key] = None if value is None or base is None else round(value - base, 3)
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def benchmark(args, gateway_port, mock_port, gateway_stats):
+    messages = [{"role": "user", "content": "Say something."}]
+    gateway_url = f"http://127.0.0.1:{gateway_port}/v1/chat/completions"
+    gateway_headers = {"Authorization": f"Bearer {API_KEY}"}
+    report = {"engines": {}, "failover": {}}
+    sampler = asyncio.create_task(gateway_stats.sample_rss())
+
+    try:
+        # 预热：让 uni-api 完成 ensure_config 的初始化、建立到上游的连接
+        for engine in ENGINES + [f"{scenario}" for scenario in FAILOVER_SCENARIOS]:
+            await run_load(gateway_url, gateway_headers, {"model": f"bench-{engine}", "messages": messages, "stream": args.stream}, args.warmup, 1)
+
+        payload = {"model": "gpt-4o", "messages": messages, "stream": args.stream}
+        results, wall_time = await run_load(f"http://127.0.0.1:{mock_port}/ok/v1/chat/completions", {}, payload, args.requests, args.concurrency)
+        baseline = summarize(results, wall_time)
+        report["baseline"] = baseline
+
+        for engine in args.engines:
+            payload = {"model": f"bench-{engine}", "messages": messages, "stream": args.stream}
+            cpu_start = gateway_stats.cpu_seconds()
+            results, wall_time = await run_load(gateway_url, gateway_headers, payload, args.requests, args.concurrency)
+            cpu_seconds = gateway_stats.cpu_seconds() - cpu_start
+            summary = summarize(results, wall_time)
+            summary["ttft_delta_ms"] = delta(summary, baseline)
+            summary["gateway_cpu_seconds"] = round(cpu_seconds, 3)
+            # uni-api 是单进程，CPU 时间即占用单核的时间
+            summary["tokens_per_second_per_core"] = round(summary["tokens"] / cpu_seconds, 1) if cpu_seconds else None
+            report["engines"][engine] = summary
+
+        if args.failover:
+            # 切换耗时按单个请求计算，不加并发，和紧挨着测的正常渠道比较
+            reference_payload = {"model": "bench-openai", "messages": messages, "stream": args.stream}
+            for scenario in FAILOVER_SCENARIOS:
+                results, wall_time = await run_load(gateway_url, gateway_headers, reference_payload, args.failover_requests, 1)
+                reference = summarize(results, wall_time)
+                payload = {"model": f"bench-{scenario}", "messages": messages, "stream": args.stream}
+                results, wall_time = await run_load(gateway_url, gateway_headers, payload, args.failover_requests, 1)
+                summary = summarize(results, wall_time)
+                summary["reference_ttft_ms"] = reference["ttft_ms"]
+                summary["failover_ms"] = delta(summary, reference)
+                report["failover"][scenario] = summary
+    finally:
+        sampler.cancel()
+
+    report["gateway"] = {
+        "cpu_seconds": round(gateway_stats.cpu_seconds(), 3),
+        "rss_mb": round(gateway_stats.rss_bytes() / 1024 / 1024, 1),
+        "peak_rss_mb": round(gateway_stats.peak_rss / 1024 / 1024, 1),
+    }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engines", default=",".join(ENGINES), help="逗号分隔，可选 " + ",".join(ENGINES))
+    parser.add_argument("--requests", type=int, default=200, help="每种渠道的请求数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--no-failover", dest="failover", action="store_false")
+    parser.add_argument("--failover-requests", type=int, default=20, help="测量切换耗时时每个场景的请求数")
+    parser.add_argument("--ttft", type=float, default=0.05)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--disable-database", action="store_true", help="不写统计数据库")
+    parser.add_argument("--output", help="JSON 报告的保存路径，默认打印到标准输出")
+    parser.add_argument("--verbose", action="store_true", help="显示模拟上游和 uni-api 的日志")
+    args = parser.parse_args()
+    args.engines = [engine.strip() for engine in args.engines.split(",") if engine.strip()]
+    unknown = set(args.engines) - set(ENGINES)
+    if unknown:
+        parser.error(f"unknown engines: {', '.join(sorted(unknown))}")
+
+    mock_port, gateway_port = free_port(), free_port()
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "api.yaml"), "w") as file:
+            # JSON 也是合法的 YAML
+            json.dump(make_config(mock_port), file, indent=2)
+        env = dict(os.environ)
+        log_output = None if args.verbose else subprocess.DEVNULL
+        if args.disable_database:
+            env["DISABLE_DATABASE"] = "true"
+        try:
+            mock = subprocess.Popen([
+                sys.executable, os.path.join(BENCHMARK_DIR, "mock_upstream.py"), "--port", str(mock_port),
+                "--ttft", str(args.ttft), "--tokens", str(args.tokens),
+                "--tokens-per-second", str(args.tokens_per_second), "--error-rate", str(args.error_rate),
+            ], stdout=log_output, stderr=log_output)
+            processes.append(mock)
+            gateway = subprocess.Popen([
+                sys.executable, os.path.join(BENCHMARK_DIR, "run_gateway.py"),
+                "--port", str(gateway_port), "--mock-port", str(mock_port), "--workdir", workdir,
+            ], env=env, stdout=log_output, stderr=log_output)
+            processes.append(gateway)
+            wait_for_port(mock_port, mock)
+            wait_for_port(gateway_port, gateway)
+
+            report = asyncio.run(benchmark(args, gateway_port, mock_port, ProcessStats(gateway.pid)))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=10)
+
+    report["config"] = {
+        "commit": git_commit(),
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "stream": args.stream,
+        "ttft": args.ttft,
+        "tokens": args.tokens,
+        "tokens_per_second": args.tokens_per_second,
+        "error_rate": args.error_rate,
+        "database": not args.disable_database,
+        "cpu_count": os.cpu_count(),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+模拟 200 轮带图片和工具调用的对话，对比每轮重新转换全部历史消息和使用增量转换缓存时构建请求体的耗时。
+
+python test/benchmark/bench_message_cache.py --turns 200 --engine claude
+"""
+import os
+import io
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from PIL import Image
+
+import request as request_module
+from models import RequestModel
+from request import get_payload
+from utils import ThreadSafeCircularList, provider_api_circular_list
+
+PROVIDERS = {
+    "gpt": {"provider": "bench", "base_url": "https://api.openai.com/v1/chat/completions", "model": ["gpt-4o"], "tools": True},
+    "claude": {"provider": "bench", "base_url": "https://api.anthropic.com/v1/messages", "api": "key", "model": ["claude-3-5-sonnet"], "tools": True},
+    "gemini": {"provider": "bench", "base_url": "https://generativelanguage.googleapis.com/v1beta", "api": "key", "model": ["gemini-1.5-pro"], "tools": True},
+}
+
+def make_images(count, size):
+    images = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        Image.new("RGB", (size, size), (i % 256, 64, 128)).save(buffer, format="WEBP")
+        images.append("data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode())
+    return images
+
+def make_turn(i, images, image_every):
+    content = [{"type": "text", "text": f"step {i}: " + "context " * 50}]
+    if i % image_every == 0:
+        content.append({"type": "image_url", "image_url": {"url": images[i // image_every]}})
+    return [
+        {"role": "user", "content": content},
+        {"role": "assistant", "content": None, "tool_calls": [
+            {"id": f"call_{i}", "type": "function", "function": {"name": "search", "arguments": json.dumps({"query": f"q{i}", "filters": list(range(20))})}}
+        ]},
+        {"role": "tool", "tool_call_id": f"call_{i}", "content": "result " * 100},
+        {"role": "assistant", "content": f"answer {i}"},
+    ]
+
+async def run(engine, turns, image_every, images, cached):
+    provider = PROVIDERS[engine]
+    messages = [{"role": "system", "content": "You are a helpful agent."}]
+    request_module.message_cache.clear()
+    timings = []
+    for i in range(turns):
+        messages.extend(make_turn(i, images, image_every))
+        request = RequestModel(model=provider["model"][0], messages=messages)
+        if not cached:
+            # 清空缓存模拟每轮重新转换全部历史
+            request_module.message_cache.clear()
+            request_module.image_cache.clear()
+        start = time.perf_counter()
+        await get_payload(request, engine, provider)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def summarize(timings):
+    tail = timings[-10:]
+    return {
+        "total_ms": round(sum(timings) * 1000, 1),
+        "last_10_turns_avg_ms": round(sum(tail) / len(tail) * 1000, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--image-every", type=int, default=5)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--engine", choices=list(PROVIDERS), default="claude")
+    args = parser.parse_args()
+
+    provider_api_circular_list["bench"] = ThreadSafeCircularList(["key"])
+    images = make_images(args.turns // args.image_every + 1, args.image_size)
+    report = {"engine": args.engine, "turns": args.turns}
+    report["full_rebuild"] = summarize(asyncio.run(run(args.engine, args.turns, args.image_every, images, False)))
+    report["incremental"] = summarize(asyncio.run(run(args.engine, args.turns, args.image_every, images, True)))
+    report["message_cache_items"] = len(request_module.message_cache)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
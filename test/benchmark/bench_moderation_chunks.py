@@ -0,0 +1,72 @@
+"""
+模拟耗时随输入长度增长的审查接口，对比 100KB 输入整段审查和按句子切块并发审查的耗时。
+
+python test/benchmark/bench_moderation_chunks.py --size 100000 --chunk-size 8000 --parallelism 4
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+from main import app, StatsMiddleware
+
+def make_text(size, flagged_at=None):
+    sentences = []
+    length = 0
+    while length < size:
+        sentence = f"This is sentence number {len(sentences)} of a long document. "
+        if flagged_at is not None and length >= flagged_at:
+            # 只插入一句违规内容
+            sentence = "bad " + sentence
+            flagged_at = None
+        sentences.append(sentence)
+        length += len(sentence)
+    return "".join(sentences)
+
+def make_moderate_content(base_latency, per_kb_latency, calls):
+    async def moderate_content(self, content, api_index):
+        calls.append(len(content))
+        await asyncio.sleep(base_latency + per_kb_latency * len(content) / 1024)
+        return {"results": [{"flagged": "bad" in content}]}
+    return moderate_content
+
+async def measure(middleware, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        flagged = await middleware.is_flagged(text, 0)
+    return (time.perf_counter() - start) / repeat, flagged
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=8000)
+    parser.add_argument("--parallelism", type=int, default=4)
+    parser.add_argument("--base-latency", type=float, default=0.05)
+    parser.add_argument("--per-kb-latency", type=float, default=0.005)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    calls = []
+    StatsMiddleware.moderate_content = make_moderate_content(args.base_latency, args.per_kb_latency, calls)
+    app.state.moderation_cache = None
+    middleware = StatsMiddleware(app)
+
+    cases = [
+        ("clean", make_text(args.size)),
+        ("flagged at 10%", make_text(args.size, flagged_at=args.size // 10)),
+    ]
+    for name, text in cases:
+        for label, chunk_size in [("whole", 0), ("chunked", args.chunk_size)]:
+            app.state.config = {"api_keys": [{"preferences": {
+                "MODERATION_CHUNK_SIZE": chunk_size,
+                "MODERATION_PARALLELISM": args.parallelism,
+            }}]}
+            calls.clear()
+            elapsed, flagged = asyncio.run(measure(middleware, text, args.repeat))
+            print(f"{name:15} {label:8} {elapsed * 1000:8.1f} ms  flagged={flagged}  requests={len(calls) // args.repeat}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+本地模拟上游，按各家接口的真实格式返回流式和非流式响应，用于测量 uni-api 自身的开销。
+
+路径的第一段是场景：
+    /ok/...       正常响应，按 --ttft 延迟首个 token，按 --tokens-per-second 输出 --tokens 个 token
+    /fail500/...  返回 500
+    /fail429/...  返回 429
+/openai/deployments/... 是 Azure 的地址，固定为正常场景。
+其余部分按各家接口区分格式：
+    .../chat/completions                         OpenAI、Azure
+    .../messages、:streamRawPredict、:rawPredict   Claude、Vertex Claude
+    :streamGenerateContent、:generateContent       Gemini、Vertex Gemini
+    .../ai/run/{model}                           Cloudflare
+    .../chat                                     Cohere
+    .../token                                    Google OAuth（Vertex 获取 access token）
+
+python test/benchmark/mock_upstream.py --port 9100 --ttft 0.05 --tokens 64 --tokens-per-second 200
+"""
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse, Response
+from starlette.routing import Route
+
+class Behavior:
+    def __init__(self, ttft=0.05, tokens=64, tokens_per_second=200.0, error_rate=0.0, error_delay=0.0, prompt_tokens=32):
+        self.ttft = ttft
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_delay = error_delay
+        self.prompt_tokens = prompt_tokens
+
+    async def token_texts(self):
+        """首个 token 前等待 ttft，之后按固定速率输出，用截止时间计算避免 sleep 误差累积"""
+        await asyncio.sleep(self.ttft)
+        start = time.perf_counter()
+        for i in range(self.tokens):
+            if self.tokens_per_second and i:
+                delay = start + i / self.tokens_per_second - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield f"w{i} "
+
+    async def full_text(self):
+        await asyncio.sleep(self.ttft)
+        if self.tokens_per_second:
+            await asyncio.sleep(max(self.tokens - 1, 0) / self.tokens_per_second)
+        return "".join(f"w{i} " for i in range(self.tokens))
+
+    def usage(self):
+        return self.prompt_tokens, self.tokens
+
+def sse(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def openai_response(behavior, payload):
+    model = payload.get("model", "mock")
+    created = int(time.time())
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
+    prompt_tokens, completion_tokens = behavior.usage()
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    if not payload.get("stream"):
+        text = await behavior.full_text()
+        return JSONResponse({
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    async def stream():
+        def chunk(delta, finish_reason=None, **extra):
+            return sse({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+                **extra,
+            })
+        first = True
+        async for text in behavior.token_texts():
+            yield chunk({"role": "assistant", "content": text} if first else {"content": text})
+            first = False
+        yield chunk({}, "stop", usage=usage)
+        yield "data: [DONE]\n\n"
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+async def claude_response(behavior, payload):
+    model = payload.get("model", "mock")
+    message_id = f"msg_{uuid.uuid4().hex[:24]}"
+    prompt_tokens, completion_tokens = behavior.usage()
+    if not payload.get("stream"):
+        text = await behavior.full_text()
+        return JSONResponse({
+            "id": message_id, "type": "message", "role": "assistant", "model": model,
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens},
+        })
+
+    async def stream():
+        started = False
+        async for text in behavior.token_texts():
+            if not started:
+                yield sse({"type": "message_start", "message": {
+                    "id": message_id, "type": "message", "role": "assistant", "model": model, "content": [],
+                    "stop_reason": None, "stop_sequence": None,
+                    "usage": {"input_tokens": prompt_tokens, "output_tokens": 1},
+                }}, "message_start")
+                yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+                started = True
+            yield sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}}, "content_block_delta")
+        yield sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": completion_tokens}}, "message_delta")
+        yield sse({"type": "message_stop"}, "message_stop")
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+def gemini_chunk(text, finish_reason=None, usage=None):
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    candidate["index"] = 0
+    data = {"candidates": [candidate]}
+    if usage:
+        data["usageMetadata"] = usage
+    # 和官方接口一样输出带缩进的 JSON 数组，uni-api 按行解析
+    return json.dumps(data, indent=2)
+
+async def gemini_response(behavior, payload):
+    prompt_tokens, completion_tokens = behavior.usage()
+    usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": completion_tokens, "totalTokenCount": prompt_tokens + completion_tokens}
+
+    # streamGenerateContent 的流式和非流式调用返回的都是完整的 JSON 数组
+    async def stream():
+        separator = "["
+        async for text in behavior.token_texts():
+            yield separator + gemini_chunk(text)
+            separator = ",\r\n"
+        yield separator + gemini_chunk("", "STOP", usage) + "]"
+    return StreamingResponse(stream(), media_type="application/json")
+
+async def cohere_response(behavior, payload):
+    generation_id = str(uuid.uuid4())
+    prompt_tokens, completion_tokens = behavior.usage()
+    meta = {"billed_units": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens}}
+    if not payload.get("stream"):
+        text = await behavior.full_text()
+        return JSONResponse({"text": text, "generation_id": generation_id, "finish_reason": "COMPLETE", "meta": meta})
+
+    async def stream():
+        yield json.dumps({"is_finished": False, "event_type": "stream-start", "generation_id": generation_id}) + "\n"
+        texts = []
+        async for text in behavior.token_texts():
+            texts.append(text)
+            yield json.dumps({"is_finished": False, "event_type": "text-generation", "text": text}) + "\n"
+        yield json.dumps({"is_finished": True, "event_type": "stream-end", "finish_reason": "COMPLETE", "response": {
+            "text": "".join(texts), "generation_id": generation_id, "meta": meta,
+        }}) + "\n"
+    return StreamingResponse(stream(), media_type="application/stream+json")
+
+async def cloudflare_response(behavior, payload):
+    if not payload.get("stream"):
+        text = await behavior.full_text()
+        return JSONResponse({"result": {"response": text}, "success": True, "errors": [], "messages": []})
+
+    async def stream():
+        async for text in behavior.token_texts():
+            yield sse({"response": text, "p": "abcdefghijklmnopqrstuvwxyz0123456789"})
+        yield "data: [DONE]\n\n"
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+def get_handler(path):
+    if path.endswith("/token"):
+        return None
+    if path.endswith("/chat/completions"):
+        return openai_response
+    if path.endswith("/messages") or path.endswith(":streamRawPredict") or path.endswith(":rawPredict"):
+        return claude_response
+    if path.endswith(":streamGenerateContent") or path.endswith(":generateContent"):
+        return gemini_response
+    if "/ai/run/" in path:
+        return cloudflare_response
+    if path.endswith("/chat"):
+        return cohere_response
+    raise KeyError(path)
+
+def create_app(behavior):
+    async def handle(request: Request):
+        if "scenario" in request.path_params:
+            scenario = request.path_params["scenario"]
+            path = "/" + request.path_params["path"]
+        else:
+            scenario, path = "ok", request.url.path
+        try:
+            handler = get_handler(path)
+        except KeyError:
+            return JSONResponse({"error": {"message": f"Unknown mock path {path}"}}, status_code=404)
+
+        if handler is None:
+            return JSONResponse({"access_token": "mock-access-token", "expires_in": 3600, "token_type": "Bearer"})
+
+        if scenario == "fail500" or (scenario == "ok" and behavior.error_rate and random.random() < behavior.error_rate):
+            await asyncio.sleep(behavior.error_delay)
+            return JSONResponse({"error": {"message": "mock upstream error", "type": "server_error"}}, status_code=500)
+        if scenario == "fail429":
+            await asyncio.sleep(behavior.error_delay)
+            return JSONResponse({"error": {"message": "mock rate limit", "type": "rate_limit_error"}}, status_code=429, headers={"retry-after": "1"})
+        if scenario != "ok":
+            return JSONResponse({"error": {"message": f"Unknown scenario {scenario}"}}, status_code=404)
+
+        body = await request.body()
+        payload = json.loads(body) if body else {}
+        return await handler(behavior, payload)
+
+    async def health(request: Request):
+        return Response("ok")
+
+    return Starlette(routes=[
+        Route("/health", health),
+        # Azure 的地址由 urljoin 拼接，base_url 里的路径会被丢掉，只能走正常场景
+        Route("/openai/deployments/{path:path}", handle, methods=["POST"]),
+        Route("/{scenario}/{path:path}", handle, methods=["POST"]),
+    ])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", type=float, default=0.05, help="首个 token 的延迟（秒）")
+    parser.add_argument("--tokens", type=int, default=64, help="每个响应输出的 token 数")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="输出速率，0 表示不限速")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="/ok 场景随机返回 500 的比例")
+    parser.add_argument("--error-delay", type=float, default=0.0, help="错误响应前的延迟（秒）")
+    args = parser.parse_args()
+
+    behavior = Behavior(args.ttft, args.tokens, args.tokens_per_second, args.error_rate, args.error_delay)
+    uvicorn.run(create_app(behavior), host=args.host, port=args.port, log_level="warning", access_log=False)
+
+if __name__ == "__main__":
+    main()
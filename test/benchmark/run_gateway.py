@@ -0,0 +1,60 @@
+"""
+使用指定目录下的 api.yaml 启动 uni-api，统计数据库也写在该目录，供 bench_gateway.py 使用。
+
+Cloudflare 和 Vertex 的请求地址写死在 request.py 里，这里把发往这些域名的请求改写到本地模拟上游，
+其余请求不受影响。
+
+python test/benchmark/run_gateway.py --port 9200 --mock-port 9100 --workdir /tmp/bench
+"""
+import os
+import sys
+import argparse
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, REPO_ROOT)
+
+import httpx
+import uvicorn
+
+REDIRECT_HOSTS = ("api.cloudflare.com", "oauth2.googleapis.com")
+
+def should_redirect(host):
+    return host in REDIRECT_HOSTS or host.endswith("aiplatform.googleapis.com")
+
+def redirect(request, mock_port):
+    if should_redirect(request.url.host):
+        request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=mock_port, raw_path=b"/ok" + request.url.raw_path)
+        request.headers["Host"] = f"127.0.0.1:{mock_port}"
+
+def install_redirect(mock_port):
+    handle_async_request = httpx.AsyncHTTPTransport.handle_async_request
+    handle_request = httpx.HTTPTransport.handle_request
+
+    async def async_redirected(self, request):
+        redirect(request, mock_port)
+        return await handle_async_request(self, request)
+
+    def redirected(self, request):
+        redirect(request, mock_port)
+        return handle_request(self, request)
+
+    httpx.AsyncHTTPTransport.handle_async_request = async_redirected
+    httpx.HTTPTransport.handle_request = redirected
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--workdir", required=True, help="包含 api.yaml 的目录，统计数据库也写在这里")
+    args = parser.parse_args()
+
+    install_redirect(args.mock_port)
+    # main 导入时从仓库目录读取 VERSION 和 static，之后 api.yaml 按当前目录查找
+    os.environ.setdefault("DB_PATH", os.path.join(args.workdir, "data", "stats.db"))
+    os.chdir(REPO_ROOT)
+    from main import app
+    os.chdir(args.workdir)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", access_log=False)
+
+if __name__ == "__main__":
+    main()
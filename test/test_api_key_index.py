@@ -0,0 +1,29 @@
+import os
+import sys
+import random
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import ApiKeyIndex
+
+def linear_lookup(api_list, token):
+    try:
+        return api_list.index(token)
+    except ValueError:
+        return next((i for i, api in enumerate(api_list) if token.startswith(api)), None)
+
+def test_matches_linear_lookup():
+    random.seed(0)
+    api_list = ["sk-" + "".join(random.choices("ab", k=random.randint(1, 6))) for _ in range(200)]
+    api_list += ["sk-abc", "sk-ab", "sk-abc"]
+    index = ApiKeyIndex(api_list)
+    tokens = api_list + ["sk-abcdef", "sk-zzz", "", "sk", "sk-" + "a" * 10]
+    tokens += ["sk-" + "".join(random.choices("abc", k=random.randint(0, 8))) for _ in range(500)]
+    for token in tokens:
+        expected = linear_lookup(api_list, token) if token else None
+        assert index.lookup(token) == expected, token
+
+def test_exact_membership():
+    index = ApiKeyIndex(["sk-admin", "sk-user"])
+    assert "sk-user" in index
+    assert "sk-user-suffix" not in index
+    assert index.lookup("sk-user-suffix") == 1
@@ -0,0 +1,56 @@
+import os
+import sys
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from audio import get_audio_media_type
+from response import fetch_response
+from utils import error_handling_wrapper
+
+class ChunkedAudio(httpx.AsyncByteStream):
+    def __init__(self, chunks, sent):
+        self.chunks = chunks
+        self.sent = sent
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            self.sent.append(chunk)
+            yield chunk
+
+def test_speech_is_streamed_chunk_by_chunk():
+    chunks = [b"ID3" + b"\x00" * 100, b"\x01" * 100, b"\x02" * 100]
+    sent = []
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, stream=ChunkedAudio(chunks, sent)))
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            generator = fetch_response(client, "https://upstream.test/v1/audio/speech", {}, {"model": "tts-1", "input": "hi", "voice": "alloy"}, "tts", "tts-1")
+            wrapped, _ = await error_handling_wrapper(generator, "test", "tts", False, [])
+            first = await anext(wrapped)
+            # 拿到第一个块时上游还没有发完
+            assert len(sent) < len(chunks)
+            return [first] + [chunk async for chunk in wrapped]
+
+    assert asyncio.run(run()) == chunks
+
+def test_pcm_and_errors():
+    async def run(response):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: response)) as client:
+            generator = fetch_response(client, "https://upstream.test/v1/audio/speech", {}, {}, "tts", "tts-1")
+            try:
+                wrapped, _ = await error_handling_wrapper(generator, "test", "tts", False, [])
+            except Exception as e:
+                return e
+            return [chunk async for chunk in wrapped]
+
+    assert asyncio.run(run(httpx.Response(200, content=b"\x00\x01\xff\xfe"))) == [b"\x00\x01\xff\xfe"]
+    error = asyncio.run(run(httpx.Response(401, json={"error": {"message": "bad key"}})))
+    assert error.status_code == 401
+
+def test_media_type_from_first_chunk():
+    assert get_audio_media_type(b"ID3\x04", "opus") == "audio/mpeg"
+    assert get_audio_media_type(b"fLaC\x00", None) == "audio/flac"
+    assert get_audio_media_type(b"\x00\x01", "pcm") == "audio/pcm"
+    assert get_audio_media_type(b"OggS", "opus") == "audio/ogg"
@@ -0,0 +1,70 @@
+import os
+import sys
+import asyncio
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from audio import UploadLimiter
+from response import fetch_response
+
+def test_multipart_body_streams_file_and_can_be_resent():
+    audio = os.urandom(3 * 1024 * 1024 + 17)
+    file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    file.write(audio)
+
+    received = []
+    async def handler(http_request):
+        body = await http_request.aread()
+        assert len(body) == int(http_request.headers["Content-Length"])
+        received.append(body)
+        if len(received) == 1:
+            return httpx.Response(500, json={"error": "retry"})
+        # 用 Starlette 的表单解析器验证请求体格式
+        scope = {"type": "http", "method": "POST", "headers": [(b"content-type", http_request.headers["Content-Type"].encode())]}
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+        form = await Request(scope, receive).form()
+        assert form["model"] == "whisper-1"
+        assert form["language"] == "en"
+        assert await form["file"].read() == audio
+        assert form["file"].filename == "speech.mp3"
+        return httpx.Response(200, json={"text": "ok"})
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            results = []
+            for _ in range(2):
+                payload = {"model": "whisper-1", "language": "en", "file": ("speech.mp3", file, "audio/mpeg")}
+                results.append(await anext(fetch_response(client, "https://upstream.test/v1/audio/transcriptions", {}, payload, "whisper", "whisper-1")))
+            return results
+
+    results = asyncio.run(run())
+    assert results[0]["status_code"] == 500
+    assert results[1] == {"text": "ok"}
+    assert len(received[0]) == len(received[1])
+
+def test_upload_limiter_queues_and_rejects():
+    limiter = UploadLimiter(max_file_bytes=150, max_inflight_bytes=100)
+    order = []
+
+    async def upload(name, size, delay):
+        async with limiter.reserve(size):
+            order.append(f"start {name}")
+            await asyncio.sleep(delay)
+            order.append(f"end {name}")
+
+    async def run():
+        await asyncio.gather(upload("a", 60, 0.05), upload("b", 60, 0), upload("c", 120, 0))
+        with pytest.raises(HTTPException) as error:
+            async with limiter.reserve(151):
+                pass
+        assert error.value.status_code == 413
+
+    asyncio.run(run())
+    assert order[:3] == ["start a", "end a", "start b"]
+    assert limiter.inflight_bytes == 0
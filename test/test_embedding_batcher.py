@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from embedding import EmbeddingBatcher, fetch_batched_embedding_response, get_embedding_batch_key
+from utils import ThreadSafeCircularList, provider_api_circular_list
+
+def mock_embedding_client(calls, api_keys=None):
+    def handler(request):
+        inputs = json.loads(request.content)["input"]
+        calls.append(inputs)
+        if api_keys is not None:
+            api_keys.append(request.headers.get("Authorization"))
+        if any(item == "bad" for item in inputs):
+            return httpx.Response(400, json={"error": {"message": "invalid input"}})
+        if any(item == "busy" for item in inputs):
+            return httpx.Response(429, json={"error": {"message": "rate limited"}})
+        data = [{"object": "embedding", "index": i, "embedding": [float(len(item))]} for i, item in enumerate(inputs)]
+        return httpx.Response(200, json={"object": "list", "data": data, "model": "emb", "usage": {"prompt_tokens": 4 * len(inputs), "total_tokens": 4 * len(inputs)}})
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+async def embed_concurrently(batcher, inputs, calls):
+    async with mock_embedding_client(calls) as client:
+        async def embed(item):
+            payload = {"input": item, "model": "emb"}
+            generator = fetch_batched_embedding_response(batcher, "key", client, "http://upstream/v1/embeddings", {}, payload, "emb")
+            return await anext(generator)
+        return await asyncio.gather(*[embed(item) for item in inputs])
+
+def test_concurrent_requests_are_merged():
+    calls = []
+    batcher = EmbeddingBatcher(max_items=8, max_wait_ms=20)
+    results = asyncio.run(embed_concurrently(batcher, ["a", "bb", "ccc"], calls))
+    assert calls == [["a", "bb", "ccc"]]
+    assert [result["data"][0]["embedding"] for result in results] == [[1.0], [2.0], [3.0]]
+    assert all(result["data"][0]["index"] == 0 for result in results)
+
+def test_max_items_splits_batches():
+    calls = []
+    batcher = EmbeddingBatcher(max_items=2, max_wait_ms=20)
+    asyncio.run(embed_concurrently(batcher, ["a", "b", "c", "d", "e"], calls))
+    assert [len(call) for call in calls] == [2, 2, 1]
+
+def test_errors_only_reach_failing_items():
+    calls = []
+    batcher = EmbeddingBatcher(max_items=8, max_wait_ms=20)
+    results = asyncio.run(embed_concurrently(batcher, ["good", "bad", "fine"], calls))
+    assert results[0]["data"][0]["embedding"] == [4.0]
+    assert results[1]["status_code"] == 400
+    assert results[2]["data"][0]["embedding"] == [4.0]
+
+def test_batch_level_errors_are_not_retried_per_item():
+    calls = []
+    batcher = EmbeddingBatcher(max_items=8, max_wait_ms=20)
+    results = asyncio.run(embed_concurrently(batcher, ["good", "busy", "fine"], calls))
+    assert calls == [["good", "busy", "fine"]]
+    assert [result["status_code"] for result in results] == [429, 429, 429]
+
+def test_different_options_are_not_merged():
+    calls = []
+    batcher = EmbeddingBatcher(max_items=8, max_wait_ms=20)
+    url = "http://upstream/v1/embeddings"
+
+    async def run():
+        async with mock_embedding_client(calls) as client:
+            async def embed(item, headers, options):
+                payload = {"input": item, "model": "emb", **options}
+                batch_key = get_embedding_batch_key(url, "emb", headers, payload)
+                return await anext(fetch_batched_embedding_response(batcher, batch_key, client, url, headers, payload, "emb"))
+            await asyncio.gather(
+                embed("a", {"Authorization": "Bearer k1"}, {}),
+                embed("b", {"Authorization": "Bearer k1"}, {}),
+                embed("c", {"Authorization": "Bearer k1"}, {"dimensions": 256}),
+                embed("d", {"Authorization": "Bearer k1"}, {"user": "u1"}),
+                embed("e", {"Authorization": "Bearer k2"}, {}),
+            )
+
+    asyncio.run(run())
+    # API key 不同的请求也会合并
+    assert sorted(calls) == [["a", "b", "e"], ["c"], ["d"]]
+
+def test_one_api_key_per_batch(monkeypatch):
+    calls = []
+    api_keys = []
+    monkeypatch.setitem(provider_api_circular_list, "batch-test", ThreadSafeCircularList(["k1", "k2"]))
+    provider = {"provider": "batch-test", "api": ["k1", "k2"]}
+    batcher = EmbeddingBatcher(max_items=2, max_wait_ms=20)
+    url = "http://upstream/v1/embeddings"
+
+    async def run():
+        async with mock_embedding_client(calls, api_keys) as client:
+            async def embed(item):
+                payload = {"input": item, "model": "emb"}
+                batch_key = get_embedding_batch_key(url, "emb", {}, payload)
+                return await anext(fetch_batched_embedding_response(batcher, batch_key, client, url, {}, payload, "emb", provider))
+            await asyncio.gather(*[embed(item) for item in ["a", "b", "c", "d"]])
+
+    asyncio.run(run())
+    assert calls == [["a", "b"], ["c", "d"]]
+    assert api_keys == ["Bearer k1", "Bearer k2"]
@@ -0,0 +1,125 @@
+import os
+import sys
+import base64
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+from models import EmbeddingRequest
+from embedding import EmbeddingCache, get_cached_embeddings
+import main
+from main import app
+
+SCOPE = "openai/text-embedding-3-small"
+
+def fake_upstream(calls):
+    async def request_upstream(sub_request):
+        calls.append(list(sub_request.input))
+        data = [
+            {"object": "embedding", "index": i, "embedding": [float(len(text)), 1.0, 2.0]}
+            for i, text in enumerate(sub_request.input)
+        ]
+        return JSONResponse(content={
+            "object": "list",
+            "data": data,
+            "model": sub_request.model,
+            "usage": {"prompt_tokens": 10 * len(data), "total_tokens": 10 * len(data)},
+        })
+    return request_upstream
+
+def test_only_misses_are_sent_upstream():
+    cache = EmbeddingCache(max_items=100)
+    calls = []
+    upstream = fake_upstream(calls)
+
+    first = EmbeddingRequest(model="text-embedding-3-small", input=["a", "bb"])
+    result, status = asyncio.run(get_cached_embeddings(first, cache, upstream, SCOPE))
+    assert status == {"hits": 0, "misses": 2}
+
+    second = EmbeddingRequest(model="text-embedding-3-small", input=["ccc", "a", "bb", "ccc"])
+    result, status = asyncio.run(get_cached_embeddings(second, cache, upstream, SCOPE))
+    assert calls == [["a", "bb"], ["ccc"]]
+    assert status == {"hits": 2, "misses": 1}
+    assert [item["index"] for item in result["data"]] == [0, 1, 2, 3]
+    assert [item["embedding"][0] for item in result["data"]] == [3.0, 1.0, 2.0, 3.0]
+    assert result["usage"]["prompt_tokens"] == 10
+    assert cache.stats()["saved_tokens"] == 20
+
+def test_base64_and_dimensions_are_separate_entries():
+    cache = EmbeddingCache(max_items=100)
+    calls = []
+    upstream = fake_upstream(calls)
+
+    request = EmbeddingRequest(model="text-embedding-3-small", input="hello", encoding_format="base64")
+    result, _ = asyncio.run(get_cached_embeddings(request, cache, upstream, SCOPE))
+    vector = np.frombuffer(base64.b64decode(result["data"][0]["embedding"]), dtype=np.float32)
+    assert vector.tolist() == [5.0, 1.0, 2.0]
+
+    request = EmbeddingRequest(model="text-embedding-3-small", input="hello", dimensions=2)
+    asyncio.run(get_cached_embeddings(request, cache, upstream, SCOPE))
+    assert len(calls) == 2
+
+def test_lru_eviction_and_disk_store(tmp_path):
+    cache = EmbeddingCache(max_items=1, disk_path=str(tmp_path))
+    cache.set("k1", np.array([1, 2], dtype=np.float32), 3)
+    cache.set("k2", np.array([3, 4], dtype=np.float32), 4)
+    assert len(cache.memory) == 1
+
+    vector, tokens = cache.get("k1")
+    assert vector.tolist() == [1.0, 2.0] and tokens == 3
+
+    reloaded = EmbeddingCache(max_items=1, disk_path=str(tmp_path))
+    vector, tokens = reloaded.get("k2")
+    assert vector.tolist() == [3.0, 4.0] and tokens == 4
+
+def test_mismatched_upstream_count_returns_502(tmp_path):
+    cache = EmbeddingCache(max_items=100, disk_path=str(tmp_path))
+
+    async def short_upstream(sub_request):
+        return JSONResponse(content={"object": "list", "data": [{"index": 0, "embedding": [1.0]}], "model": sub_request.model})
+
+    request = EmbeddingRequest(model="text-embedding-3-small", input=["a", "b"])
+    response, status = asyncio.run(get_cached_embeddings(request, cache, short_upstream, SCOPE))
+    assert status is None and response.status_code == 502
+    assert len(cache.memory) == 0 and not cache.disk.index
+
+    request = EmbeddingRequest(model="text-embedding-3-small", input=["a", "b"])
+    asyncio.run(get_cached_embeddings(request, cache, fake_upstream([]), SCOPE))
+    assert len(cache.disk.index) == 2
+
+def test_cache_hit_requires_model_access(monkeypatch):
+    config = {
+        "api_keys": [
+            {"api": "sk-a", "model": ["emb"]},
+            {"api": "sk-b", "model": ["text-embedding-3-small"]},
+            {"api": "sk-c", "model": ["gpt-4o"]},
+        ],
+        "providers": [
+            {"provider": "openai", "base_url": "https://api.openai.com/v1", "api": "sk-x", "model": ["text-embedding-3-small", {"text-embedding-3-small": "emb"}]},
+        ],
+    }
+    calls = []
+    upstream = fake_upstream(calls)
+    async def request_model(request, api_index, endpoint=None):
+        return await upstream(request)
+    monkeypatch.setattr(app.state, "config", config, raising=False)
+    monkeypatch.setattr(app.state, "embedding_cache", EmbeddingCache(max_items=100), raising=False)
+    monkeypatch.setattr(main.model_handler, "request_model", request_model)
+
+    response = asyncio.run(main.embeddings(EmbeddingRequest(model="emb", input="hello"), 0))
+    assert response.headers["X-Embedding-Cache"] == "hits=0, misses=1"
+
+    # 别名和上游模型名相同的请求共享缓存
+    response = asyncio.run(main.embeddings(EmbeddingRequest(model="text-embedding-3-small", input="hello"), 1))
+    assert response.headers["X-Embedding-Cache"] == "hits=1, misses=0"
+
+    # 缓存已经预热，没有权限的 key 仍然返回 404
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.embeddings(EmbeddingRequest(model="text-embedding-3-small", input="hello"), 2))
+    assert error.value.status_code == 404
+    assert calls == [["hello"]]
@@ -0,0 +1,48 @@
+import os
+import sys
+import base64
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from models import EmbeddingRequest
+from request import get_payload
+from embedding import format_embedding_response
+
+def make_response(vectors):
+    return {
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(vectors)],
+        "model": "emb",
+    }
+
+def test_float_response_without_truncation_is_untouched():
+    response = make_response([[0.1, 0.2], [0.3, 0.4]])
+    assert format_embedding_response(response, "float", None)["data"][0]["embedding"] == [0.1, 0.2]
+
+def test_base64_encoding_matches_float32_bytes():
+    response = format_embedding_response(make_response([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]), "base64")
+    decoded = [np.frombuffer(base64.b64decode(item["embedding"]), dtype="<f4").tolist() for item in response["data"]]
+    assert decoded == [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]
+
+def test_dimensions_truncate_and_renormalize():
+    response = format_embedding_response(make_response([[3.0, 4.0, 12.0], [0.0, 0.0, 1.0]]), "float", 2)
+    assert np.allclose(response["data"][0]["embedding"], [0.6, 0.8])
+    assert response["data"][1]["embedding"] == [0.0, 0.0]
+
+def test_base64_upstream_is_decoded_before_truncation():
+    raw = base64.b64encode(np.array([3.0, 4.0, 12.0], dtype="<f4").tobytes()).decode()
+    response = format_embedding_response(make_response([raw]), "float", 2)
+    assert np.allclose(response["data"][0]["embedding"], [0.6, 0.8])
+
+def test_payload_does_not_forward_encoding_format():
+    provider = {"provider": "format-test", "base_url": "https://api.jina.ai/v1/embeddings", "model": ["jina-embeddings-v3", "text-embedding-3-large"]}
+    request = EmbeddingRequest(model="jina-embeddings-v3", input="hi", encoding_format="base64", dimensions=256)
+    _, _, payload = asyncio.run(get_payload(request, "embedding", provider))
+    assert "encoding_format" not in payload and "embedding_type" not in payload
+    assert "dimensions" not in payload
+
+    request = EmbeddingRequest(model="text-embedding-3-large", input="hi", dimensions=256)
+    _, _, payload = asyncio.run(get_payload(request, "embedding", provider))
+    assert payload["dimensions"] == 256
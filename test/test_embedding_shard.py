@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from models import EmbeddingRequest
+from utils import ThreadSafeCircularList, provider_api_circular_list
+from embedding import split_embedding_shards, get_embedding_shards, fetch_sharded_embedding_response
+
+def test_split_by_items_and_tokens():
+    shards = split_embedding_shards(["a"] * 5, max_items=2)
+    assert [(offset, len(items)) for offset, items in shards] == [(0, 2), (2, 2), (4, 1)]
+
+    shards = split_embedding_shards(["x" * 40, "x" * 40, "x" * 40], max_tokens=15)
+    assert [(offset, len(items)) for offset, items in shards] == [(0, 1), (1, 1), (2, 1)]
+
+def test_shards_use_every_key_and_reassemble_in_order():
+    provider = {
+        "provider": "shard-test",
+        "base_url": "https://upstream.test/v1/chat/completions",
+        "api": ["key-1", "key-2"],
+        "model": ["text-embedding-3-small"],
+        "preferences": {"embedding_shard": {"max_items": 3, "retries": 1}},
+    }
+    provider_api_circular_list["shard-test"] = ThreadSafeCircularList(["key-1", "key-2"])
+    request = EmbeddingRequest(model="text-embedding-3-small", input=[str(i) for i in range(8)])
+
+    keys = []
+    failed_once = set()
+    def handler(http_request):
+        keys.append(http_request.headers["Authorization"])
+        inputs = json.loads(http_request.content)["input"]
+        # 第一次请求包含 "3" 的分片时返回 429，验证分片级重试
+        if "3" in inputs and "3" not in failed_once:
+            failed_once.add("3")
+            return httpx.Response(429, json={"error": {"message": "rate limited"}})
+        data = [{"object": "embedding", "index": i, "embedding": [float(item)]} for i, item in enumerate(inputs)]
+        return httpx.Response(200, json={"object": "list", "data": data, "model": "emb", "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}})
+
+    async def run():
+        shards = get_embedding_shards(request, provider)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            generator = fetch_sharded_embedding_response(client, request, "embedding", provider, shards, "text-embedding-3-small")
+            return shards, await anext(generator)
+
+    shards, result = asyncio.run(run())
+    assert len(shards) == 3
+    assert [item["embedding"][0] for item in result["data"]] == [float(i) for i in range(8)]
+    assert [item["index"] for item in result["data"]] == list(range(8))
+    assert result["usage"]["prompt_tokens"] == 8
+    assert set(keys) == {"Bearer key-1", "Bearer key-2"}
+    assert len(keys) == 4
@@ -0,0 +1,59 @@
+import os
+import io
+import sys
+import base64
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from PIL import Image
+
+import request as request_module
+from models import RequestModel
+from request import get_image_message, get_payload
+
+def make_image(image_format):
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4), (255, 0, 0)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+def test_webp_data_uri_is_converted_once():
+    request_module.image_cache.clear()
+    webp = "data:image/webp;base64," + base64.b64encode(make_image("WEBP")).decode()
+    message = asyncio.run(get_image_message(webp, "claude"))
+    assert message["source"]["media_type"] == "image/png"
+    assert len(request_module.image_cache) == 1
+    assert asyncio.run(get_image_message(webp, "claude")) == message
+
+def test_remote_images_are_fetched_concurrently_and_cached():
+    request_module.image_cache.clear()
+    fetched = []
+    def handler(http_request):
+        fetched.append(str(http_request.url))
+        image_format = "PNG" if http_request.url.path.endswith(".png") else "JPEG"
+        return httpx.Response(200, content=make_image(image_format))
+
+    messages = [{"role": "user", "content": [
+        {"type": "text", "text": "compare"},
+        {"type": "image_url", "image_url": {"url": "https://images.test/a.png"}},
+        {"type": "image_url", "image_url": {"url": "https://images.test/b.jpg"}},
+        {"type": "image_url", "image_url": {"url": "https://images.test/a.png"}},
+    ]}]
+    provider = {"provider": "image-test", "base_url": "https://api.openai.com/v1/chat/completions", "model": ["gpt-4o"], "tools": True}
+
+    async def run():
+        request_module.image_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            for _ in range(2):
+                request = RequestModel(model="gpt-4o", messages=messages)
+                _, _, payload = await get_payload(request, "gpt", provider)
+        finally:
+            await request_module.close_image_client()
+        return payload
+
+    payload = asyncio.run(run())
+    assert sorted(fetched) == ["https://images.test/a.png", "https://images.test/b.jpg"]
+    urls = [item["image_url"]["url"] for item in payload["messages"][0]["content"][1:]]
+    assert urls[0].startswith("data:image/png;base64,")
+    assert urls[1].startswith("data:image/jpeg;base64,")
+    assert urls[2] == urls[0]
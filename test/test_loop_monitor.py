@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loop_monitor import LoopLagMonitor
+from metrics import metrics
+
+def blocking_call(seconds):
+    time.sleep(seconds)
+
+def test_shedding_hysteresis():
+    monitor = LoopLagMonitor(interval_ms=100, shed_ms=200, shed_after=2, retry_after=3)
+    monitor.record(0.5)
+    assert not monitor.shedding
+    monitor.record(0.3)
+    assert monitor.shedding
+    # 单次低于阈值不会立即恢复
+    monitor.record(0.01)
+    monitor.record(0.4)
+    monitor.record(0.01)
+    assert monitor.shedding
+    monitor.record(0.02)
+    assert not monitor.shedding
+    assert metrics.load_shedding.values[()] == 0
+    assert "uniapi_event_loop_lag_seconds 0.02" in metrics.render()
+
+def test_watchdog_logs_blocking_stack(caplog):
+    async def run():
+        monitor = LoopLagMonitor.from_config({"interval_ms": 20, "warn_ms": 100})
+        monitor.start()
+        await asyncio.sleep(0.05)
+        blocking_call(0.4)
+        await asyncio.sleep(0.05)
+        monitor.stop()
+        return monitor
+
+    with caplog.at_level(logging.WARNING, logger="uni-api"):
+        monitor = asyncio.run(run())
+    assert monitor.lag < 0.1
+    blocked = [record.getMessage() for record in caplog.records if "Event loop blocked" in record.getMessage()]
+    assert len(blocked) == 1 and "blocking_call" in blocked[0]
+
+def test_lag_warning_is_rate_limited(caplog):
+    monitor = LoopLagMonitor(interval_ms=100, warn_ms=200, log_interval=60)
+    with caplog.at_level(logging.WARNING, logger="uni-api"):
+        for _ in range(20):
+            monitor.record(0.5)
+    assert len([record for record in caplog.records if record.getMessage().startswith("Event loop lag")]) == 1
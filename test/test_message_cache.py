@@ -0,0 +1,104 @@
+import os
+import io
+import sys
+import json
+import base64
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import request as request_module
+from models import RequestModel
+from request import get_payload
+
+def make_webp():
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4), (0, 0, 255)).save(buffer, format="WEBP")
+    return "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+def make_conversation(turns):
+    messages = [{"role": "system", "content": "be brief"}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": [
+            {"type": "text", "text": f"question {i}"},
+            {"type": "image_url", "image_url": {"url": make_webp()}},
+        ]})
+        messages.append({"role": "assistant", "content": None, "tool_calls": [
+            {"id": f"call_{i}", "type": "function", "function": {"name": "lookup", "arguments": json.dumps({"i": i})}}
+        ]})
+        messages.append({"role": "tool", "tool_call_id": f"call_{i}", "content": f"result {i}"})
+        # 连续的 user 消息会在 Claude 格式里合并，用来检查缓存中的消息没有被原地修改
+        messages.append({"role": "user", "content": "continue"})
+    return messages
+
+def build(engine, provider, messages):
+    request = RequestModel(model=provider["model"][0], messages=messages)
+    return asyncio.run(get_payload(request, engine, provider))[2]
+
+def spy_image_calls(monkeypatch):
+    calls = []
+    original = request_module.get_image_message
+    async def get_image_message(url, engine=None):
+        calls.append(url)
+        return await original(url, engine)
+    monkeypatch.setattr(request_module, "get_image_message", get_image_message)
+    return calls
+
+def test_only_new_messages_are_converted(monkeypatch):
+    request_module.message_cache.clear()
+    request_module.provider_api_circular_list["cache-claude"] = request_module.ThreadSafeCircularList(["key"])
+    provider = {"provider": "cache-claude", "base_url": "https://api.anthropic.com/v1/messages", "api": "key", "model": ["claude-3-5-sonnet"], "tools": True}
+    calls = spy_image_calls(monkeypatch)
+
+    build("claude", provider, make_conversation(3))
+    assert len(calls) == 3
+    warm = build("claude", provider, make_conversation(5))
+    assert len(calls) == 5
+
+    request_module.message_cache.clear()
+    cold = build("claude", provider, make_conversation(5))
+    assert warm == cold
+    # 再次命中缓存时结果保持一致
+    assert build("claude", provider, make_conversation(5)) == cold
+
+def test_state_is_restored_from_cached_prefix():
+    request_module.message_cache.clear()
+    request_module.provider_api_circular_list["cache-gemini"] = request_module.ThreadSafeCircularList(["key"])
+    provider = {"provider": "cache-gemini", "base_url": "https://generativelanguage.googleapis.com/v1beta", "api": "key", "model": ["gemini-1.5-pro"]}
+    messages = make_conversation(1)
+    build("gemini", provider, messages[:3])
+    payload = build("gemini", provider, messages)
+    assert payload["contents"][2]["parts"][0]["functionResponse"]["name"] == "lookup"
+    assert payload["systemInstruction"] == {"parts": [{"text": "be brief"}]}
+
+def test_scope_separates_providers():
+    request_module.message_cache.clear()
+    messages = make_conversation(1)
+    with_image = {"provider": "cache-gpt", "base_url": "https://api.openai.com/v1/chat/completions", "model": ["gpt-4o"], "tools": True}
+    without_image = {**with_image, "image": False}
+    build("gpt", with_image, messages)
+    payload = build("gpt", without_image, messages)
+    assert payload["messages"][1]["content"] == [{"type": "text", "text": "question 0"}]
+
+def test_scope_separates_requests_with_tools():
+    request_module.message_cache.clear()
+    request_module.provider_api_circular_list["cache-claude"] = request_module.ThreadSafeCircularList(["key"])
+    provider = {"provider": "cache-claude", "base_url": "https://api.anthropic.com/v1/messages", "api": "key", "model": ["claude-3-5-sonnet"], "tools": True}
+    messages = make_conversation(1)
+    tools = [{"type": "function", "function": {"name": "lookup", "parameters": {"type": "object", "properties": {}}}}]
+    build("claude", provider, messages)
+    asyncio.run(get_payload(RequestModel(model="claude-3-5-sonnet", messages=messages, tools=tools), "claude", provider))
+    scopes = {key[0] for key in request_module.message_cache.items}
+    assert {scope[-1] for scope in scopes} == {False, True}
+
+def test_cache_size_counts_converted_images(monkeypatch):
+    request_module.message_cache.clear()
+    image = "data:image/png;base64," + "A" * 100000
+    async def get_normalized_image(url):
+        return image
+    monkeypatch.setattr(request_module, "get_normalized_image", get_normalized_image)
+    provider = {"provider": "cache-gpt", "base_url": "https://api.openai.com/v1/chat/completions", "model": ["gpt-4o"]}
+    # 请求里只有图片链接，缓存的转换结果里是完整的 base64
+    build("gpt", provider, [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": "https://example.com/cat.png"}}]}])
+    assert request_module.message_cache.total_bytes > 100000
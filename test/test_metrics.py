@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Counter, Histogram, MetricsRegistry
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "Latency.", ("provider",), (0.1, 1, 10))
+    for value in (0.05, 0.1, 0.5, 20):
+        histogram.observe(("p",), value)
+    lines = list(histogram.collect())
+    assert 'latency_seconds_bucket{provider="p",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{provider="p",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{provider="p",le="10"} 3' in lines
+    assert 'latency_seconds_bucket{provider="p",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{provider="p"} 20.65' in lines
+    assert 'latency_seconds_count{provider="p"} 4' in lines
+
+    counter = Counter("errors_total", "Errors.", ("model",))
+    counter.inc(('gpt"4\n',))
+    assert 'errors_total{model="gpt\\"4\\n"} 1' in list(counter.collect())
+
+def test_observe_request():
+    registry = MetricsRegistry()
+    info = {
+        "provider": "openai", "model": "gpt-4o", "role": "team", "success": True,
+        "prompt_tokens": 10, "completion_tokens": 50, "first_response_time": 0.5, "process_time": 1.5,
+    }
+    registry.observe_request(info, 200)
+    registry.observe_request({**info, "provider": None, "success": False, "completion_tokens": 0, "first_response_time": -1}, 502)
+    registry.observe_request({"model": None, "process_time": 0.1}, 200)
+    # 命中缓存的请求不经过上游，没有 success 标记
+    registry.observe_request({"model": "gpt-4o", "role": "team", "process_time": 0.01}, 200)
+
+    text = registry.render()
+    labels = 'provider="openai",model="gpt-4o",role="team"'
+    assert f"uniapi_requests_total{{{labels}}} 1" in text
+    assert 'uniapi_request_errors_total{provider="",model="gpt-4o",role="team",status="502"} 1' in text
+    assert 'status="200"' not in text
+    assert f'uniapi_tokens_total{{{labels},type="completion"}} 50' in text
+    assert f"uniapi_completion_tokens_per_second_sum{{{labels}}} 50" in text
+    assert f"uniapi_time_to_first_token_seconds_count{{{labels}}} 1" in text
+    assert 'uniapi_time_to_first_token_seconds_count{provider=""' not in text
+    assert "# TYPE uniapi_request_duration_seconds histogram" in text
+    assert text.count("uniapi_requests_total{") == 2
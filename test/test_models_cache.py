@@ -0,0 +1,89 @@
+import os
+import sys
+import gzip
+import json
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+from starlette.requests import Request
+
+import main
+from main import app, list_models
+
+def make_request(headers):
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/v1/models",
+        "headers": [(key.lower().encode(), value.encode()) for key, value in headers.items()],
+    })
+
+def setup_state(monkeypatch, calls):
+    config = {"api_keys": [{"api": "sk-a", "model": ["gpt-4o", "claude-3-5-sonnet"]}], "providers": []}
+    def post_all_models(api_index, config, api_list, models_list):
+        calls.append(api_index)
+        return [{"id": model, "object": "model"} for model in config["api_keys"][api_index]["model"]]
+    monkeypatch.setattr(main, "post_all_models", post_all_models)
+    monkeypatch.setattr(app.state, "config", config, raising=False)
+    monkeypatch.setattr(app.state, "api_list", ["sk-a"], raising=False)
+    monkeypatch.setattr(app.state, "models_list", {}, raising=False)
+    monkeypatch.setattr(app.state, "models_responses", {}, raising=False)
+
+def test_models_response_is_cached_with_etag(monkeypatch):
+    calls = []
+    setup_state(monkeypatch, calls)
+
+    response = asyncio.run(list_models(make_request({}), 0))
+    assert response.status_code == 200
+    assert [model["id"] for model in json.loads(response.body)["data"]] == ["gpt-4o", "claude-3-5-sonnet"]
+    etag = response.headers["etag"]
+
+    response = asyncio.run(list_models(make_request({"If-None-Match": etag}), 0))
+    assert response.status_code == 304
+    assert response.body == b""
+
+    response = asyncio.run(list_models(make_request({"If-None-Match": '"stale"'}), 0))
+    assert response.status_code == 200
+    assert calls == [0]
+
+def test_models_response_gzip(monkeypatch):
+    calls = []
+    setup_state(monkeypatch, calls)
+
+    response = asyncio.run(list_models(make_request({"Accept-Encoding": "br, gzip"}), 0))
+    assert response.headers["content-encoding"] == "gzip"
+    assert json.loads(gzip.decompress(response.body))["object"] == "list"
+    gzip_etag = response.headers["etag"]
+
+    response = asyncio.run(list_models(make_request({"Accept-Encoding": "gzip;q=0"}), 0))
+    assert "content-encoding" not in response.headers
+    assert response.headers["etag"] != gzip_etag
+
+    response = asyncio.run(list_models(make_request({"Accept-Encoding": "gzip", "If-None-Match": gzip_etag}), 0))
+    assert response.status_code == 304
+
+def test_frontend_edits_invalidate_models_response(monkeypatch):
+    calls = []
+    setup_state(monkeypatch, calls)
+    app.state.config["providers"] = [{"provider": "a", "model": ["gpt-4o"]}, {"provider": "b", "model": ["claude-3-5-sonnet"]}]
+    def post_all_models(api_index, config, api_list, models_list):
+        return [{"id": model, "object": "model"} for provider in config["providers"] for model in provider["model"]]
+    async def root():
+        return ""
+    monkeypatch.setattr(main, "post_all_models", post_all_models)
+    monkeypatch.setattr(main, "root", root)
+
+    response = asyncio.run(list_models(make_request({}), 0))
+    etag = response.headers["etag"]
+
+    asyncio.run(main.delete_row("1"))
+    response = asyncio.run(list_models(make_request({"If-None-Match": etag}), 0))
+    assert response.status_code == 200
+    assert [model["id"] for model in json.loads(response.body)["data"]] == ["gpt-4o"]
+    etag = response.headers["etag"]
+
+    asyncio.run(main.duplicate_row("0"))
+    response = asyncio.run(list_models(make_request({"If-None-Match": etag}), 0))
+    assert response.status_code == 200
+    assert [model["id"] for model in json.loads(response.body)["data"]] == ["gpt-4o", "gpt-4o"]
@@ -0,0 +1,90 @@
+import os
+import sys
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+import utils
+from utils import LRUCache, split_moderation_text, split_moderation_input
+from main import app, StatsMiddleware, request_info
+
+def test_lru_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(utils, "time", lambda: now[0])
+    cache = LRUCache(max_items=2, ttl=10)
+    cache.set("a", 1)
+    now[0] += 5
+    assert cache.get("a") == 1
+    now[0] += 6
+    assert cache.get("a") is None
+    assert len(cache) == 0 and cache.expires == {}
+
+def test_verdicts_are_cached_by_content(monkeypatch):
+    calls = []
+    async def moderate_content(self, content, api_index):
+        calls.append(content)
+        return {"results": [{"flagged": content == "bad"}]}
+    monkeypatch.setattr(StatsMiddleware, "moderate_content", moderate_content)
+    monkeypatch.setattr(app.state, "moderation_cache", LRUCache(max_items=10, ttl=60), raising=False)
+    monkeypatch.setattr(app.state, "config", {"api_keys": [{}]}, raising=False)
+    middleware = StatsMiddleware(app)
+
+    async def run():
+        return [await middleware.is_flagged(content, 0) for content in ["ok", "bad", "ok", "bad"]]
+
+    assert asyncio.run(run()) == [False, True, False, True]
+    assert calls == ["ok", "bad"]
+
+def test_background_moderation_does_not_touch_request_info(monkeypatch):
+    async def moderate_content(self, content, api_index):
+        # 审查请求本身会写入统计信息
+        request_info.get()["provider"] = "moderation-provider"
+        await asyncio.sleep(0)
+        return {"results": [{"flagged": False}]}
+    monkeypatch.setattr(StatsMiddleware, "moderate_content", moderate_content)
+    monkeypatch.setattr(app.state, "moderation_cache", None, raising=False)
+    monkeypatch.setattr(app.state, "config", {"api_keys": [{}]}, raising=False)
+    middleware = StatsMiddleware(app)
+
+    async def run():
+        current_info = {"provider": None}
+        request_info.set(current_info)
+        task = asyncio.create_task(middleware.moderate_in_background("hello", 0))
+        current_info["provider"] = "chat-provider"
+        assert await task is False
+        return current_info
+
+    assert asyncio.run(run())["provider"] == "chat-provider"
+
+def test_split_moderation_text_on_sentence_boundaries():
+    text = "First sentence. Second one! 第三句。" + "x" * 25
+    chunks = split_moderation_text(text, 20)
+    assert "".join(chunks) == text
+    assert all(len(chunk) <= 20 for chunk in chunks)
+    assert chunks[0] == "First sentence. "
+    assert split_moderation_text("short", 20) == ["short"]
+
+def test_token_id_input_is_one_chunk():
+    assert split_moderation_input([1, 2, 3], 2) == [[1, 2, 3]]
+    assert split_moderation_input([[1, 2], [3]], 1) == [[[1, 2], [3]]]
+    assert split_moderation_input(["aa. bb.", "cc"], 4) == ["aa. ", "bb.", "cc"]
+
+def test_long_input_is_moderated_in_parallel_chunks(monkeypatch):
+    calls = []
+    async def moderate_content(self, content, api_index):
+        calls.append(content)
+        if "bad" in content:
+            return {"results": [{"flagged": True}]}
+        await asyncio.sleep(0.05)
+        return {"results": [{"flagged": False}]}
+    monkeypatch.setattr(StatsMiddleware, "moderate_content", moderate_content)
+    monkeypatch.setattr(app.state, "moderation_cache", None, raising=False)
+    monkeypatch.setattr(app.state, "config", {"api_keys": [{"preferences": {"MODERATION_CHUNK_SIZE": 12, "MODERATION_PARALLELISM": 2}}]}, raising=False)
+    middleware = StatsMiddleware(app)
+
+    assert asyncio.run(middleware.is_flagged("fine text. " * 4, 0)) is False
+    assert len(calls) == 4
+    calls.clear()
+    # 第一块违规时不再等待后面的块
+    assert asyncio.run(middleware.is_flagged("bad text. " + "fine text. " * 10, 0)) is True
+    assert len(calls) <= 3
@@ -0,0 +1,43 @@
+import os
+import sys
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import RequestModel
+from utils import ThreadSafeCircularList, prefix_affinity, rendezvous_order, get_prefix_affinity_key
+
+def conversation(*turns):
+    messages = [{"role": "system", "content": "agent rules"}]
+    for turn in turns:
+        messages.append({"role": "user", "content": turn})
+        messages.append({"role": "assistant", "content": f"reply to {turn}"})
+    return RequestModel(model="gpt-4o", messages=messages[:-1])
+
+def test_affinity_key_is_stable_across_turns():
+    first = get_prefix_affinity_key(conversation("hello"))
+    assert first == get_prefix_affinity_key(conversation("hello", "more", "and more"))
+    assert first != get_prefix_affinity_key(conversation("another topic"))
+    assert get_prefix_affinity_key(conversation("hello"), 2) != get_prefix_affinity_key(conversation("hello", "more"), 2)
+
+def test_rendezvous_order_only_moves_keys_of_removed_item():
+    items = ["a", "b", "c", "d"]
+    keys = [str(i) for i in range(200)]
+    before = {key: rendezvous_order(items, key)[0] for key in keys}
+    after = {key: rendezvous_order(["a", "b", "d"], key)[0] for key in keys}
+    assert all(before[key] == after[key] for key in keys if before[key] != "c")
+    assert len(set(before.values())) == 4
+
+def test_keys_are_pinned_and_fall_back_when_cooling():
+    keys = ThreadSafeCircularList(["k1", "k2", "k3"])
+
+    async def run():
+        prefix_affinity.set("conversation-1")
+        picked = [await keys.next("gpt-4o") for _ in range(5)]
+        assert await keys.after_next_current() == picked[0]
+        await keys.set_cooling(picked[0], cooling_time=60)
+        fallback = await keys.next("gpt-4o")
+        return picked, fallback
+
+    picked, fallback = asyncio.run(run())
+    assert len(set(picked)) == 1
+    assert fallback == rendezvous_order(["k1", "k2", "k3"], "conversation-1")[1]
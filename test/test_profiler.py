@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiler import Profiler
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def test_slow_requests_keep_stacks():
+    profiler = Profiler(slow_request_ms=50, interval_ms=1)
+    assert profiler.request_enabled
+
+    fast = {"request_id": "fast", "endpoint": "POST /v1/chat/completions", "model": "gpt-4o"}
+    profiler.start_request(fast)
+    profiler.finish_request(fast)
+
+    slow = {"request_id": "slow", "endpoint": "POST /v1/chat/completions", "model": "gpt-4o"}
+    profiler.start_request(slow)
+    busy(0.2)
+    profiler.finish_request(slow)
+    profiler.finish_request(slow)
+
+    assert [item["request_id"] for item in profiler.list_requests()] == ["slow"]
+    assert profiler.window is None and profiler.sampler.thread is None
+    collapsed, media_type = profiler.export(profiler.get_request("slow")["stacks"], "slow", "collapsed")
+    assert "busy (test_profiler.py:" in collapsed and media_type.startswith("text/plain")
+
+def test_filter_and_process_profile():
+    profiler = Profiler(request_filter={"model": "claude"}, interval_ms=1)
+    info = {"request_id": "a", "model": "claude"}
+    profiler.start_request(info)
+    busy(0.05)
+    profiler.finish_request(info)
+    assert profiler.list_requests()[0]["reason"] == "filter"
+
+    profiler.configure()
+    assert not profiler.request_enabled
+
+    profiler.start_process(5)
+    busy(0.1)
+    profiler.stop_process()
+    status = profiler.process_status()
+    assert status["finished"] and status["samples"] > 0
+    content, _ = profiler.export(profiler.process_profile.stacks, "process")
+    speedscope = json.loads(content)
+    assert speedscope["profiles"][0]["type"] == "sampled"
+    assert any(frame["name"].startswith("thread ") for frame in speedscope["shared"]["frames"])
+
+def test_dispatch_finishes_profile_when_body_read_fails(monkeypatch):
+    import asyncio
+    import pytest
+    os.environ.setdefault("DISABLE_DATABASE", "true")
+    from starlette.requests import Request, ClientDisconnect
+    from main import app, StatsMiddleware, ApiKeyIndex
+    from loop_monitor import LoopLagMonitor
+
+    profiler = Profiler(slow_request_ms=1000, interval_ms=1)
+    monkeypatch.setattr(app.state, "profiler", profiler, raising=False)
+    monkeypatch.setattr(app.state, "config", {"api_keys": [{"api": "sk-a"}]}, raising=False)
+    monkeypatch.setattr(app.state, "api_key_index", ApiKeyIndex(["sk-a"]), raising=False)
+    monkeypatch.setattr(app.state, "loop_monitor", LoopLagMonitor(enabled=False), raising=False)
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    request = Request({
+        "type": "http", "method": "POST", "path": "/v1/chat/completions", "query_string": b"",
+        "headers": [(b"authorization", b"Bearer sk-a"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1234),
+    }, receive)
+
+    async def call_next(request):
+        raise AssertionError("should not be reached")
+
+    with pytest.raises(ClientDisconnect):
+        asyncio.run(StatsMiddleware(app).dispatch(request, call_next))
+    assert profiler.inflight == 0 and profiler.window is None and profiler.sampler.thread is None
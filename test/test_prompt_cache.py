@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+import request as request_module
+from models import RequestModel
+from request import get_payload, add_claude_cache_control
+from response import fetch_claude_response_stream
+from utils import ThreadSafeCircularList, provider_api_circular_list
+
+def count_breakpoints(payload):
+    return json.dumps(payload).count("cache_control")
+
+def test_breakpoints_follow_prefix_order_and_limit():
+    payload = {
+        "tools": [{"name": "a", "description": "x" * 4000}, {"name": "b", "description": "y"}],
+        "system": "s" * 100,
+        "messages": [
+            {"role": "user", "content": "first " * 10},
+            {"role": "assistant", "content": "ok"},
+            {"role": "user", "content": [{"type": "text", "text": "second"}]},
+            {"role": "assistant", "content": "ok"},
+            {"role": "user", "content": "third"},
+        ],
+    }
+    add_claude_cache_control(payload, min_tokens=1000, message_breakpoints=3)
+    assert "cache_control" in payload["tools"][-1]
+    assert "cache_control" in payload["system"][-1]
+    assert payload["messages"][4]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert "cache_control" in payload["messages"][2]["content"][-1]
+    assert payload["messages"][0]["content"] == "first " * 10
+    assert count_breakpoints(payload) == 4
+
+def test_short_prefix_is_not_marked():
+    payload = {"system": "short", "messages": [{"role": "user", "content": "hi"}]}
+    add_claude_cache_control(payload, min_tokens=1024)
+    assert count_breakpoints(payload) == 0
+
+def test_claude_payload_opt_in_does_not_touch_cached_messages():
+    request_module.message_cache.clear()
+    provider_api_circular_list["prompt-cache"] = ThreadSafeCircularList(["key"])
+    provider = {
+        "provider": "prompt-cache",
+        "base_url": "https://api.anthropic.com/v1/messages",
+        "api": "key",
+        "model": ["claude-3-5-sonnet"],
+        "preferences": {"prompt_cache": {"min_tokens": 10}},
+    }
+    messages = [
+        {"role": "system", "content": "rules " * 20},
+        {"role": "user", "content": "question " * 20},
+    ]
+    _, headers, payload = asyncio.run(get_payload(RequestModel(model="claude-3-5-sonnet", messages=messages), "claude", provider))
+    assert "prompt-caching" in headers["anthropic-beta"]
+    assert count_breakpoints(payload) == 2
+    (cached_messages, _), _ = next(iter(request_module.message_cache.items.values()))
+    assert "cache_control" not in json.dumps(cached_messages)
+
+    _, _, plain = asyncio.run(get_payload(RequestModel(model="claude-3-5-sonnet", messages=messages), "claude", {**provider, "preferences": {}}))
+    assert count_breakpoints(plain) == 0
+
+def test_stream_usage_reports_cached_tokens():
+    events = [
+        {"type": "message_start", "message": {"role": "assistant", "usage": {"input_tokens": 10, "cache_read_input_tokens": 900, "cache_creation_input_tokens": 100}}},
+        {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 5}},
+    ]
+    body = "".join(f"data: {json.dumps(event)}\n\n" for event in events)
+
+    async def run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, text=body))
+        async with httpx.AsyncClient(transport=transport) as client:
+            return [chunk async for chunk in fetch_claude_response_stream(client, "https://api.anthropic.com/v1/messages", {}, {}, "claude")]
+
+    chunks = asyncio.run(run())
+    usage = [json.loads(chunk[6:])["usage"] for chunk in chunks if '"usage": {' in chunk][0]
+    assert usage["prompt_tokens"] == 1010
+    assert usage["prompt_tokens_details"] == {"cached_tokens": 900, "cache_creation_tokens": 100}
@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+import httpx
+
+from utils import RequestTimings
+from main import request_info, trace_upstream_request
+
+def test_server_timing_and_stats():
+    timings = RequestTimings()
+    timings.stages["auth"] = 0.5
+    timings.start_attempt("bad")
+    timings.attempts[-1]["stages"].update({"payload": 1.0, "connect": 2.0})
+    timings.end_attempt(500)
+    timings.start_attempt('go"od')
+    timings.attempts[-1]["stages"].update({"payload": 3.0, "ttfb": 40.0})
+    timings.end_attempt(200)
+
+    header = timings.server_timing(include_provider=True)
+    assert header.startswith("auth;dur=0.50, a1-payload;dur=1.00;desc=\"bad\"")
+    assert 'a2-ttfb;dur=40.00;desc="good"' in header
+    assert header.split(", ")[-1].startswith("total;dur=")
+    header = timings.server_timing()
+    assert "desc=" not in header and "a2-ttfb;dur=40.00, " in header
+
+    stats = timings.to_stats()
+    assert stats["auth_time"] == 0.0005
+    assert stats["payload_time"] == 0.003 and stats["upstream_ttfb"] == 0.04
+    assert stats["failover_time"] == 0.003
+    assert stats["attempts"] == 2
+    assert [attempt["status"] for attempt in json.loads(stats["stage_timings"])["attempts"]] == [500, 200]
+
+def test_trace_hook_records_current_attempt():
+    timings = RequestTimings()
+    timings.start_attempt("openai")
+
+    async def run():
+        request_info.set({"timings": timings})
+        request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+        await trace_upstream_request(request)
+        trace = request.extensions["trace"]
+        await trace("http11.send_request_headers.started", {})
+        await trace("http11.receive_response_headers.complete", {})
+
+    asyncio.run(run())
+    assert set(timings.attempts[-1]["stages"]) == {"connect", "ttfb"}
@@ -0,0 +1,85 @@
+import os
+import sys
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+import pytest
+from fastapi import HTTPException
+from starlette.responses import StreamingResponse
+
+import main
+from audio import SpeechCache
+from models import TextToSpeechRequest
+
+async def upstream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+def consume(generator, limit=None):
+    async def run():
+        received = []
+        async for chunk in generator:
+            received.append(chunk)
+            if limit and len(received) >= limit:
+                await generator.aclose()
+                break
+        return received
+    return asyncio.run(run())
+
+def test_speech_is_cached_after_complete_stream(tmp_path):
+    cache = SpeechCache(path=str(tmp_path), max_bytes=1000)
+    request = TextToSpeechRequest(model="tts-1", input="hello", voice="alloy")
+    key = cache.make_key(request, "openai/tts-1")
+    assert key != cache.make_key(request.model_copy(update={"voice": "echo"}), "openai/tts-1")
+    assert key != cache.make_key(request, "azure/tts-1")
+    assert cache.get(key) is None
+
+    assert consume(cache.tee(key, upstream([b"ID3", b"abc"]), "audio/mpeg")) == [b"ID3", b"abc"]
+    file_path, media_type = cache.get(key)
+    assert media_type == "audio/mpeg"
+    with open(file_path, "rb") as file:
+        assert file.read() == b"ID3abc"
+
+    reloaded = SpeechCache(path=str(tmp_path), max_bytes=1000)
+    assert reloaded.get(key)[0] == file_path
+
+def test_aborted_stream_is_not_cached(tmp_path):
+    cache = SpeechCache(path=str(tmp_path))
+    consume(cache.tee("partial", upstream([b"a", b"b", b"c"]), "audio/mpeg"), limit=1)
+    assert cache.get("partial") is None
+    assert os.listdir(tmp_path) == []
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    cache = SpeechCache(path=str(tmp_path), max_bytes=10)
+    for key in ["a", "b"]:
+        consume(cache.tee(key, upstream([b"12345"]), "audio/wav"))
+    cache.get("a")
+    consume(cache.tee("c", upstream([b"12345"]), "audio/wav"))
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+    assert cache.total_bytes == 10
+
+def test_cache_hit_requires_model_access(tmp_path, monkeypatch):
+    config = {
+        "api_keys": [{"api": "sk-a", "model": ["tts-1"]}, {"api": "sk-b", "model": ["gpt-4o"]}],
+        "providers": [{"provider": "openai", "base_url": "https://api.openai.com/v1", "api": "sk-x", "model": ["tts-1"]}],
+    }
+    calls = []
+    async def request_model(request, api_index, endpoint=None):
+        calls.append(api_index)
+        return StreamingResponse(upstream([b"ID3", b"abc"]), media_type="audio/mpeg")
+    monkeypatch.setattr(main.app.state, "config", config, raising=False)
+    monkeypatch.setattr(main.app.state, "speech_cache", SpeechCache(path=str(tmp_path)), raising=False)
+    monkeypatch.setattr(main.model_handler, "request_model", request_model)
+
+    request = TextToSpeechRequest(model="tts-1", input="hello", voice="alloy")
+    response = asyncio.run(main.audio_speech(request, 0))
+    assert consume(response.body_iterator) == [b"ID3", b"abc"]
+    assert asyncio.run(main.audio_speech(request, 0)).headers["X-TTS-Cache"] == "hit"
+
+    # 缓存已经存在，没有权限的 key 仍然返回 404
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.audio_speech(request, 1))
+    assert error.value.status_code == 404
+    assert calls == [0]
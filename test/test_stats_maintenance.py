@@ -0,0 +1,52 @@
+import os
+import sys
+import asyncio
+import sqlite3
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from main import Base, set_sqlite_pragma, run_stats_maintenance
+
+def test_retention_archives_and_vacuums(tmp_path):
+    db_path, archive_path = str(tmp_path / "stats.db"), str(tmp_path / "archive.db")
+
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite:///" + db_path)
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragma)
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.execute(text(
+                "INSERT INTO request_stats (model, text, timestamp) VALUES "
+                "('old', 'x', '2000-01-01 00:00:00'), ('new', 'y', CURRENT_TIMESTAMP)"
+            ))
+            await conn.execute(text(
+                "INSERT INTO channel_stats (provider, success, timestamp) VALUES ('old', 1, '2000-01-01 00:00:00')"
+            ))
+            await conn.execute(text(
+                "INSERT INTO request_rollups (granularity, bucket, provider, model, endpoint, api_key, client_ip, scheduling, request_count) VALUES "
+                "('minute', '2000-01-01 00:00:00.000000', '', 'old', '', '', '', '', 1), "
+                "('hour', '2000-01-01 00:00:00.000000', '', 'old', '', '', '', '', 1)"
+            ))
+        deleted = await run_stats_maintenance(engine, retention_days=30, rollup_retention_days=31, archive_path=archive_path)
+        async with engine.connect() as conn:
+            journal_mode = (await conn.exec_driver_sql("PRAGMA journal_mode")).scalar()
+            models = [row[0] for row in (await conn.exec_driver_sql("SELECT model FROM request_stats")).fetchall()]
+            granularities = [row[0] for row in (await conn.exec_driver_sql("SELECT granularity FROM request_rollups")).fetchall()]
+            indexes = {row[1] for row in (await conn.exec_driver_sql("PRAGMA index_list(request_stats)")).fetchall()}
+        await engine.dispose()
+        return deleted, journal_mode, models, granularities, indexes
+
+    deleted, journal_mode, models, granularities, indexes = asyncio.run(run())
+    assert deleted == {"request_stats": 1, "channel_stats": 1, "request_rollups": 1, "channel_rollups": 0}
+    assert journal_mode == "wal"
+    assert models == ["new"] and granularities == ["hour"]
+    assert {"ix_request_stats_timestamp", "ix_request_stats_provider_model", "ix_request_stats_api_key"} <= indexes
+
+    archive = sqlite3.connect(archive_path)
+    assert archive.execute("SELECT model, text FROM request_stats").fetchall() == [("old", "x")]
+    assert archive.execute("SELECT provider FROM channel_stats").fetchall() == [("old",)]
+    archive.close()
@@ -0,0 +1,91 @@
+import os
+import sys
+import asyncio
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+from sqlalchemy import select, func, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from main import (
+    Base, RequestRollup, ChannelRollup, add_request_rollups, add_channel_rollups,
+    backfill_rollups, rollup_window, build_stats, build_hourly_chart,
+)
+
+def test_rollups_upsert_and_stats():
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            # 已有的原始记录在首次创建预聚合表时补齐
+            await conn.execute(text(
+                "INSERT INTO request_stats (endpoint, client_ip, provider, model, api_key, is_flagged, prompt_tokens, "
+                "cache_read_tokens, first_response_time, timestamp) VALUES "
+                "('POST /v1/chat/completions', '1.1.1.1', 'old', 'gpt-4o', 'sk-a', 0, 100, 40, 0.5, CURRENT_TIMESTAMP)"
+            ))
+            await backfill_rollups(conn)
+        session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        async with session_maker() as session:
+            info = {
+                "provider": "openai", "model": "gpt-4o", "endpoint": "POST /v1/chat/completions", "api_key": "sk-a",
+                "client_ip": "1.1.1.1", "scheduling": "prefix_affinity", "success": True, "prompt_tokens": 100,
+                "cache_read_tokens": 80, "first_response_time": 0.2, "process_time": 1.0,
+            }
+            await add_request_rollups(session, info)
+            await add_request_rollups(session, {**info, "first_response_time": 0.4})
+            await add_request_rollups(session, {**info, "provider": None, "model": "claude", "success": False, "first_response_time": -1, "client_ip": "2.2.2.2", "cache_read_tokens": 0})
+            for success in (True, True, False):
+                await add_channel_rollups(session, "openai", "gpt-4o", "sk-a", success)
+            await session.commit()
+
+            # 每个维度组合在每种粒度下只有一行
+            count = await session.scalar(select(func.count()).select_from(RequestRollup).where(RequestRollup.granularity == "minute"))
+            assert count == 3
+
+            start_time = datetime.now(timezone.utc) - timedelta(hours=1)
+            channel_rows = (await session.execute(
+                select(ChannelRollup.provider, ChannelRollup.model, func.sum(ChannelRollup.total).label("total"), func.sum(ChannelRollup.success_count).label("success_count"))
+                .where(rollup_window(ChannelRollup, start_time)).group_by(ChannelRollup.provider, ChannelRollup.model)
+            )).fetchall()
+            request_rows = (await session.execute(
+                select(
+                    RequestRollup.provider, RequestRollup.model, RequestRollup.endpoint, RequestRollup.client_ip, RequestRollup.scheduling,
+                    func.sum(RequestRollup.request_count).label("count"), func.sum(RequestRollup.prompt_tokens).label("prompt_tokens"),
+                    func.sum(RequestRollup.cache_read_tokens).label("cache_read_tokens"), func.sum(RequestRollup.cache_creation_tokens).label("cache_creation_tokens"),
+                    func.sum(RequestRollup.first_response_time_sum).label("first_response_time_sum"), func.sum(RequestRollup.first_response_count).label("first_response_count"),
+                )
+                .where(rollup_window(RequestRollup, start_time))
+                .group_by(RequestRollup.provider, RequestRollup.model, RequestRollup.endpoint, RequestRollup.client_ip, RequestRollup.scheduling)
+            )).fetchall()
+        await engine.dispose()
+        return channel_rows, request_rows
+
+    channel_rows, request_rows = asyncio.run(run())
+    stats = build_stats(channel_rows, request_rows, 1)
+    assert stats["channel_success_rates"] == [{"provider": "openai", "success_rate": 2 / 3, "total_requests": 3}]
+    assert stats["model_request_counts"] == [{"model": "gpt-4o", "count": 3}, {"model": "claude", "count": 1}]
+    assert stats["ip_request_counts"][0] == {"ip": "1.1.1.1", "count": 3}
+    assert {item["provider"]: item["cached_ratio"] for item in stats["prompt_cache"]} == {"openai": 0.8, "old": 0.4}
+    scheduling = stats["scheduling_stats"][0]
+    assert scheduling["count"] == 3 and abs(scheduling["avg_first_response_time"] - 0.3) < 1e-9
+
+def test_rollup_window_uses_minutes_for_partial_hour():
+    start_time = datetime(2024, 1, 1, 10, 15, 30, tzinfo=timezone.utc)
+    clause = str(rollup_window(RequestRollup, start_time).compile(compile_kwargs={"literal_binds": True}))
+    assert "bucket >= '2024-01-01 11:00:00'" in clause
+    assert "bucket >= '2024-01-01 10:16:00' AND request_rollups.bucket < '2024-01-01 11:00:00'" in clause
+
+def test_build_hourly_chart():
+    first_hour = datetime(2024, 1, 1, 0)
+    rows = [
+        SimpleNamespace(bucket=first_hour, model="a", count=2),
+        SimpleNamespace(bucket=first_hour + timedelta(hours=23), model="b", count=5),
+        SimpleNamespace(bucket=first_hour + timedelta(hours=3), model="", count=9),
+    ]
+    chart_data, models = build_hourly_chart(rows, first_hour)
+    assert models == ["a", "b"] and len(chart_data) == 24
+    assert chart_data[0]["a"] == 2 and chart_data[0]["b"] == 0
+    assert chart_data[23]["b"] == 5
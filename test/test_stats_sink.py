@@ -0,0 +1,80 @@
+import os
+import sys
+import glob
+import asyncio
+from datetime import datetime, timedelta, timezone
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+import pytest
+
+from stats_sink import SegmentStatsSink, read_segment, compact_segments, iter_parquet
+from main import STATS_FIELDS
+
+def test_segments_are_batched_and_rotated(tmp_path):
+    async def run():
+        sink = SegmentStatsSink(str(tmp_path), batch_size=3, flush_interval=60, max_segment_bytes=200)
+        for i in range(5):
+            await sink.write("request", {"request_id": str(i), "model": "gpt-4o", "timestamp": datetime.now(timezone.utc).isoformat()})
+        # 满 3 条才写入一次，剩下的留在内存中
+        assert len(sink.buffers["request"]) == 2
+        await sink.close()
+
+    asyncio.run(run())
+    assert not glob.glob(str(tmp_path / "*.open"))
+    segments = sorted(glob.glob(str(tmp_path / "request-*.jsonl")))
+    assert len(segments) == 2
+    assert [record["request_id"] for path in segments for record in read_segment(path)] == ["0", "1", "2", "3", "4"]
+
+def test_compact_and_export_parquet(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    now = datetime.now(timezone.utc)
+    async def run():
+        sink = SegmentStatsSink(str(tmp_path))
+        await sink.write("request", {"request_id": "old", "model": "a", "prompt_tokens": 5, "timestamp": (now - timedelta(days=2)).isoformat()})
+        await sink.write("request", {"request_id": "new", "model": "b", "prompt_tokens": 7, "timestamp": now.isoformat()})
+        await sink.close()
+        await sink.write("request", {"request_id": "pending", "model": "c", "timestamp": now.isoformat()})
+        await sink.flush()
+
+    asyncio.run(run())
+    assert compact_segments(str(tmp_path), STATS_FIELDS) == {"request": 2}
+    assert len(glob.glob(str(tmp_path / "parquet" / "request" / "date=*" / "*.parquet"))) == 2
+
+    output = tmp_path / "export.parquet"
+    with open(output, "wb") as file:
+        for chunk in iter_parquet(str(tmp_path), "request", STATS_FIELDS["request"], now - timedelta(days=1), now + timedelta(seconds=1)):
+            file.write(chunk)
+    table = pq.read_table(output)
+    # 已合并的分区和尚未合并的分段都会导出
+    assert sorted(table.column("request_id").to_pylist()) == ["new", "pending"]
+    assert table.schema.field("prompt_tokens").type == pa.int64()
+
+def test_compaction_waits_for_running_export(tmp_path):
+    pytest.importorskip("pyarrow")
+    import threading
+    import pyarrow.parquet as pq
+
+    now = datetime.now(timezone.utc)
+    async def run():
+        sink = SegmentStatsSink(str(tmp_path))
+        await sink.write("request", {"request_id": "a", "model": "a", "timestamp": now.isoformat()})
+        await sink.close()
+
+    asyncio.run(run())
+    export = iter_parquet(str(tmp_path), "request", STATS_FIELDS["request"], now - timedelta(days=1), now + timedelta(seconds=1))
+    chunks = [next(export)]
+    compaction = threading.Thread(target=compact_segments, args=(str(tmp_path), STATS_FIELDS))
+    compaction.start()
+    compaction.join(0.2)
+    # 导出还没结束，合并不能删除分段
+    assert compaction.is_alive() and glob.glob(str(tmp_path / "request-*.jsonl"))
+    chunks.extend(export)
+    compaction.join(5)
+    assert not compaction.is_alive() and not glob.glob(str(tmp_path / "request-*.jsonl"))
+
+    output = tmp_path / "export.parquet"
+    output.write_bytes(b"".join(chunks))
+    assert pq.read_table(output).column("request_id").to_pylist() == ["a"]
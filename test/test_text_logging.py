@@ -0,0 +1,37 @@
+import os
+import sys
+import asyncio
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISABLE_DATABASE", "true")
+
+from utils import prepare_logged_text, compress_text, decompress_text
+from main import app, get_logged_text
+
+def test_prepare_and_compress_text():
+    assert prepare_logged_text("hello world", max_chars=5) == "hello"
+    assert prepare_logged_text("hello", hash_text=True) == "sha256:2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824"
+    assert prepare_logged_text("hello", sample_rate=0) is None
+    assert prepare_logged_text(["a", "b"]) == '["a", "b"]'
+
+    text = "retrieved context paragraph. " * 200
+    compressed, encoding = compress_text(text, "zlib")
+    assert encoding == "zlib" and len(compressed) < len(text) / 5
+    assert decompress_text(compressed, encoding) == text
+    assert compress_text("short", "zlib") == ("short", None)
+    assert decompress_text("plain text") == "plain text"
+
+def test_plain_text_that_looks_compressed_is_returned_as_is():
+    for text in ("zlib: what is deflate?", "zstd:abc"):
+        assert decompress_text(text) == text
+    # 损坏的数据不抛出异常，返回原始值
+    assert decompress_text("not base64!", "zlib") == "not base64!"
+
+def test_logged_text_uses_api_key_preferences(monkeypatch):
+    monkeypatch.setattr(app.state, "config", {"api_keys": [
+        {"api": "sk-a"},
+        {"api": "sk-b", "preferences": {"TEXT_LOG_MAX_CHARS": 1000, "TEXT_LOG_COMPRESSION": "zlib"}},
+    ]}, raising=False)
+    text = "long document " * 500
+    assert asyncio.run(get_logged_text({"api_index": 0, "text": text})) == (text, None)
+    logged, encoding = asyncio.run(get_logged_text({"api_index": 1, "text": text}))
+    assert encoding == "zlib" and decompress_text(logged, encoding) == text[:1000]
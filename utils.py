@@ -1,4 +1,8 @@
 import json
+import zlib
+import base64
+import random
+import hashlib
 from fastapi import HTTPException
 import httpx
 
@@ -63,7 +67,231 @@ class InMemoryRateLimiter:
 
 rate_limiter = InMemoryRateLimiter()
 
+from collections import OrderedDict
+class LRUCache:
+    """按最近使用顺序淘汰的缓存，同时限制条目数和总字节数，设置 ttl（秒）后条目到期失效"""
+    def __init__(self, max_items=1024, max_bytes=None, ttl=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.items = OrderedDict()  # {key: (value, size)}
+        self.expires = {}  # {key: 过期时间}，仅在设置 ttl 时使用
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.items.get(key)
+        if entry is not None and self.ttl and self.expires[key] <= time():
+            self.pop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, size=0):
+        if key in self.items:
+            self.pop(key)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        self.items[key] = (value, size)
+        if self.ttl:
+            self.expires[key] = time() + self.ttl
+        self.total_bytes += size
+        while self.items and (
+            len(self.items) > self.max_items
+            or (self.max_bytes and self.total_bytes > self.max_bytes)
+        ):
+            self.pop(next(iter(self.items)))
+
+    def pop(self, key, default=None):
+        entry = self.items.pop(key, None)
+        if entry is None:
+            return default
+        self.expires.pop(key, None)
+        self.total_bytes -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self.items.clear()
+        self.expires.clear()
+        self.total_bytes = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+# 句子结尾：标点（含中文标点）或换行，连同后面的空白
+SENTENCE_PATTERN = re.compile(r".*?(?:[.!?;。！？；\n]+\s*|$)", re.S)
+
+def split_moderation_text(text, max_chars):
+    """按句子边界把文本切成不超过 max_chars 个字符的块，单个句子超长时在空白处（没有空白则直接）截断"""
+    if not max_chars or len(text) <= max_chars:
+        return [text]
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_PATTERN.findall(text):
+        if not sentence:
+            continue
+        if len(current) + len(sentence) <= max_chars:
+            current += sentence
+            continue
+        if current:
+            chunks.append(current)
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars) + 1 or max_chars
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:]
+        current = sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+def split_moderation_input(content, max_chars):
+    """审查内容可以是字符串或字符串列表，返回切分后的所有块；token id 等其他输入不切分，整体作为一块"""
+    if isinstance(content, str):
+        return split_moderation_text(content, max_chars)
+    if isinstance(content, list) and content and all(isinstance(item, str) for item in content):
+        return [chunk for item in content for chunk in split_moderation_text(item, max_chars)]
+    return [content]
+
+# 短文本压缩后加上 base64 反而更长，不压缩
+TEXT_COMPRESS_MIN_CHARS = 256
+# 独立的随机数生成器，不受其他地方 random.seed 的影响
+text_log_random = random.Random()
+
+def prepare_logged_text(text, sample_rate=1.0, max_chars=0, hash_text=False):
+    """按 API key 的日志策略处理写入 RequestStat.text 的文本，返回 None 表示不记录"""
+    if not text:
+        return None
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    if sample_rate < 1 and text_log_random.random() >= sample_rate:
+        return None
+    if hash_text:
+        return "sha256:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+    if max_chars and len(text) > max_chars:
+        text = text[:max_chars]
+    return text
+
+def compress_text(text, method="zlib"):
+    """
+    返回 (存入文本列的值, 编码)，编码为 None（未压缩）、"zlib" 或 "zstd"，压缩结果以 base64 存储。
+    编码单独存入 text_encoding 列，不从文本内容推断。CPU 密集，应放在线程池中执行。
+    """
+    if len(text) < TEXT_COMPRESS_MIN_CHARS:
+        return text, None
+    data = text.encode("utf-8")
+    if method == "zstd":
+        try:
+            import zstandard
+            return base64.b64encode(zstandard.ZstdCompressor().compress(data)).decode("ascii"), "zstd"
+        except ImportError:
+            logger.warning("zstandard package is not installed, falling back to zlib for request text compression")
+    return base64.b64encode(zlib.compress(data, 6)).decode("ascii"), "zlib"
+
+def decompress_text(value, encoding=None):
+    """还原 compress_text 的结果，未压缩的文本原样返回，无法解码时也返回原始值"""
+    if not value or not encoding:
+        return value
+    try:
+        data = base64.b64decode(value)
+        if encoding == "zstd":
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+        return zlib.decompress(data).decode("utf-8")
+    except Exception as e:
+        logger.warning(f"Error decompressing request text ({encoding}): {str(e)}")
+        return value
+
+from time import perf_counter
+
+# 写入统计表的阶段耗时列（秒）：请求级阶段和最后一次上游尝试的阶段
+REQUEST_STAGE_COLUMNS = {"auth": "auth_time", "parse": "parse_time", "moderation": "moderation_time", "routing": "routing_time", "stream": "stream_time"}
+ATTEMPT_STAGE_COLUMNS = {"payload": "payload_time", "connect": "connect_time", "ttfb": "upstream_ttfb"}
+
+class RequestTimings:
+    """
+    记录一个请求各阶段的耗时（毫秒）。请求级阶段：auth、parse、moderation、routing、stream；
+    每次上游尝试（重试、切换渠道）单独记录 payload、connect、ttfb、first_chunk。
+    """
+    def __init__(self):
+        self.start = perf_counter()
+        self.stages = {}
+        self.attempts = []
+
+    def add(self, stage, start):
+        """累加从 start（perf_counter）到现在的耗时"""
+        self.stages[stage] = self.stages.get(stage, 0) + (perf_counter() - start) * 1000
+
+    def start_attempt(self, provider):
+        self.attempts.append({"provider": provider, "status": None, "stages": {}})
+
+    def add_attempt(self, stage, start):
+        if not self.attempts:
+            return
+        stages = self.attempts[-1]["stages"]
+        stages[stage] = stages.get(stage, 0) + (perf_counter() - start) * 1000
+
+    def end_attempt(self, status):
+        if self.attempts:
+            self.attempts[-1]["status"] = status
+
+    def server_timing(self, include_provider=False):
+        """include_provider 为 False 时不输出渠道名，避免向普通客户端暴露内部渠道"""
+        metrics = [f"{stage};dur={duration:.2f}" for stage, duration in self.stages.items()]
+        for index, attempt in enumerate(self.attempts, 1):
+            desc = ';desc="' + str(attempt["provider"]).replace('"', "") + '"' if include_provider else ""
+            metrics.extend(
+                f'a{index}-{stage};dur={duration:.2f}{desc}'
+                for stage, duration in attempt["stages"].items()
+            )
+        metrics.append(f"total;dur={(perf_counter() - self.start) * 1000:.2f}")
+        return ", ".join(metrics)
+
+    def to_stats(self):
+        stats = {column: self.stages.get(stage, 0) / 1000 for stage, column in REQUEST_STAGE_COLUMNS.items()}
+        last_attempt = self.attempts[-1]["stages"] if self.attempts else {}
+        stats.update({column: last_attempt.get(stage, 0) / 1000 for stage, column in ATTEMPT_STAGE_COLUMNS.items()})
+        # 失败尝试花掉的时间
+        stats["failover_time"] = sum(sum(attempt["stages"].values()) for attempt in self.attempts[:-1]) / 1000
+        stats["attempts"] = len(self.attempts)
+        stats["stage_timings"] = json.dumps({"stages": self.stages, "attempts": self.attempts}, ensure_ascii=False)
+        return stats
+
 import asyncio
+import contextvars
+
+# 当前请求的前缀亲和哈希，prefix_affinity 调度时由 request_model 设置，选择 API key 时使用
+prefix_affinity = contextvars.ContextVar('prefix_affinity', default=None)
+
+def get_prefix_affinity_key(request, max_messages=1):
+    """系统提示词加前 max_messages 条非系统消息的哈希，同一个对话的后续轮次得到相同的值"""
+    messages = getattr(request, "messages", None)
+    if not messages:
+        return None
+    digest = hashlib.sha256(request.model.encode("utf-8"))
+    count = 0
+    for msg in messages:
+        if msg.role != "system":
+            if count >= max_messages:
+                break
+            count += 1
+        digest.update(msg.model_dump_json(exclude_none=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def rendezvous_order(items, affinity_key, name=str):
+    """
+    最高随机权重（rendezvous）一致性哈希：按 hash(affinity_key, item) 从大到小排序。
+    同一个 key 总是先选到同一个 item，增删 item 只影响原本落在该 item 上的 key，
+    排在后面的 item 就是被选中的 item 不可用时的回退顺序。
+    """
+    return sorted(items, key=lambda item: hashlib.sha256(f"{affinity_key}:{name(item)}".encode("utf-8")).digest(), reverse=True)
 
 class ThreadSafeCircularList:
     def __init__(self, items = [], rate_limit={"default": "999999/min"}, schedule_algorithm="round_robin"):
@@ -156,6 +384,9 @@ class ThreadSafeCircularList:
         return False
 
     async def next(self, model: str = None):
+        affinity_key = prefix_affinity.get()
+        if affinity_key and len(self.items) > 1:
+            return await self.next_by_affinity(affinity_key, model)
         async with self.lock:
             if self.schedule_algorithm == "fixed_priority":
                 self.index = 0
@@ -172,6 +403,17 @@ class ThreadSafeCircularList:
                     logger.warning(f"All API keys are rate limited!")
                     raise HTTPException(status_code=429, detail="Too many requests")
 
+    async def next_by_affinity(self, affinity_key, model: str = None):
+        """按一致性哈希固定选择同一个 item，被限速或冷却时按哈希顺序回退到下一个"""
+        async with self.lock:
+            for item in rendezvous_order(self.items, affinity_key):
+                if not await self.is_rate_limited(item, model):
+                    # 同步 index，保证 after_next_current 返回本次选中的 item
+                    self.index = (self.items.index(item) + 1) % len(self.items)
+                    return item
+            logger.warning("All API keys are rate limited!")
+            raise HTTPException(status_code=429, detail="Too many requests")
+
     async def after_next_current(self):
         # 返回当前取出的 API，因为已经调用了 next，所以当前API应该是上一个
         if len(self.items) == 0:
@@ -331,6 +573,42 @@ def update_config(config_data, use_config_url=False):
     # logger.info(json.dumps(config_data, indent=4, ensure_ascii=False))
     return config_data, api_keys_db, api_list
 
+class ApiKeyIndex:
+    """
+    API key 认证索引：完整 token 查哈希表，查不到时在前缀树里找 token 以之开头的 key。
+    结果与 api_list.index(token) 加 startswith 线性扫描一致：重复或多个前缀匹配时返回最小的下标。
+    """
+    def __init__(self, api_list):
+        self.exact = {}
+        self.trie = {}
+        for api_index, api in enumerate(api_list):
+            if not isinstance(api, str):
+                continue
+            self.exact.setdefault(api, api_index)
+            node = self.trie
+            for char in api:
+                node = node.setdefault(char, {})
+            node.setdefault(None, api_index)
+
+    def lookup(self, token):
+        if not token:
+            return None
+        api_index = self.exact.get(token)
+        if api_index is not None:
+            return api_index
+        node = self.trie
+        api_index = node.get(None)
+        for char in token:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node and (api_index is None or node[None] < api_index):
+                api_index = node[None]
+        return api_index
+
+    def __contains__(self, token):
+        return token in self.exact
+
 # 读取YAML配置文件
 async def load_config(app=None):
     import os
@@ -339,7 +617,7 @@ async def load_config(app=None):
             conf = yaml.load(file)
 
         if conf:
-            config, api_keys_db, api_list = update_config(conf, use_config_url=False)
+            config, api_keys_db, api_list = await asyncio.to_thread(update_config, conf, use_config_url=False)
         else:
             logger.error("配置文件 'api.yaml' 为空。请检查文件内容。")
             config, api_keys_db, api_list = {}, {}, []
@@ -390,7 +668,7 @@ async def load_config(app=None):
             # 更新配置
             # logger.info(config_data)
             if config_data:
-                config, api_keys_db, api_list = update_config(config_data, use_config_url=True)
+                config, api_keys_db, api_list = await asyncio.to_thread(update_config, config_data, use_config_url=True)
             else:
                 logger.error(f"Error fetching or parsing config from {config_url}")
                 config, api_keys_db, api_list = {}, {}, []
@@ -437,8 +715,13 @@ async def error_handling_wrapper(generator, channel_id, engine, stream, error_tr
         first_item_str = first_item
         # logger.info("first_item_str: %s :%s", type(first_item_str), first_item_str)
         if isinstance(first_item_str, (bytes, bytearray)):
-            if identify_audio_format(first_item_str) in ["MP3", "MP3 with ID3", "OPUS", "AAC (ADIF)", "AAC (ADTS)", "FLAC", "WAV"]:
-                return first_item, first_response_time
+            # 上游的错误响应已经在 check_response 中转成 dict，TTS 返回的字节都是音频（包括无法识别格式的 pcm）
+            if engine == "tts" or identify_audio_format(first_item_str) in ["MP3", "MP3 with ID3", "OPUS", "AAC (ADIF)", "AAC (ADTS)", "FLAC", "WAV"]:
+                async def audio_generator():
+                    yield first_item
+                    async for item in generator:
+                        yield item
+                return audio_generator(), first_response_time
             else:
                 first_item_str = first_item_str.decode("utf-8")
         if isinstance(first_item_str, str):
@@ -675,7 +958,7 @@ end_of_line = "\n\n"
 
 import random
 import string
-async def generate_sse_response(timestamp, model, content=None, tools_id=None, function_call_name=None, function_call_content=None, role=None, total_tokens=0, prompt_tokens=0, completion_tokens=0, finish_reason=None):
+async def generate_sse_response(timestamp, model, content=None, tools_id=None, function_call_name=None, function_call_content=None, role=None, total_tokens=0, prompt_tokens=0, completion_tokens=0, finish_reason=None, prompt_tokens_details=None):
     random.seed(timestamp)
     random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=29))
     sample_data = {
@@ -694,6 +977,8 @@ async def generate_sse_response(timestamp, model, content=None, tools_id=None, f
         "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": total_tokens} if total_tokens else None,
         "system_fingerprint": "fp_d576307f90",
     }
+    if prompt_tokens_details and sample_data["usage"]:
+        sample_data["usage"]["prompt_tokens_details"] = prompt_tokens_details
     if function_call_content:
         sample_data["choices"][0]["delta"] = {"tool_calls":[{"index":0,"function":{"arguments": function_call_content}}]}
     if tools_id and function_call_name: